@@ -16,11 +16,13 @@ from PyQt4 import QtGui, QtCore
 import sys
 import os
 import json
+import multiprocessing
 
 from lib.waitindicator import WaitOverlay
 from lib.annotation import AnnObjectType
 from lib.canvas import Canvas
-from lib.worker import BatchConvertToBoundariesWorker
+from lib.worker import BatchConvertToBoundariesWorker, PrefetchWorker, LabelSaveWorker
+from lib.prefetch import PrefetchCache, neighbourIndices
 
 class InstanceLabelTool(QtGui.QMainWindow):
     def __init__(self):
@@ -36,9 +38,22 @@ class InstanceLabelTool(QtGui.QMainWindow):
         # Ground truth extension after labeling occlusion orientation
         self.gtExt = '.polygons.json'
 
+        # Number of processes used by batch conversion, see config.json
+        self.batchConvertJobs = multiprocessing.cpu_count()
+        # How label files are written, see config.json
+        self.saveOptions = {}
+        # Tolerance in pixels to simplify converted boundaries with, see
+        # config.json
+        self.simplifyTolerance = 0.0
+        # Number of images before and after the current one loaded
+        # ahead of time, see config.json
+        self.prefetchCount = 2
+
         # Current image as QImage
         self.image = QtGui.QImage()
         self.initUI()
+        self.initPrefetch()
+        self.initLabelSaver()
 
     def initUI(self):
         self.canvas = Canvas(parent=self)
@@ -233,6 +248,75 @@ class InstanceLabelTool(QtGui.QMainWindow):
         # Show the application
         self.show()
 
+    # Start the thread that loads the neighbouring images and labels
+    def initPrefetch(self):
+        # An image and its labels for each neighbour, and the current ones
+        self.prefetchCache = PrefetchCache(capacity=4 * self.prefetchCount + 2)
+        self.prefetchThread = None
+        self.prefetchWorker = None
+        if (self.prefetchCount <= 0):
+            return
+        self.prefetchThread = QtCore.QThread()
+        self.prefetchWorker = PrefetchWorker(self.prefetchCache)
+        self.prefetchWorker.moveToThread(self.prefetchThread)
+        self.prefetchThread.start(QtCore.QThread.LowPriority)
+        QtGui.qApp.aboutToQuit.connect(self.stopPrefetch)
+
+    @QtCore.pyqtSlot()
+    def stopPrefetch(self):
+        if (self.prefetchThread is None):
+            return
+        self.prefetchWorker.stop()
+        self.prefetchThread.quit()
+        self.prefetchThread.wait()
+        self.prefetchThread = None
+
+    # Ask the prefetch thread for the images around the current one
+    def prefetchNeighbours(self):
+        if (self.prefetchThread is None or not self.imageList):
+            return
+        files = [(self.getImageFilename(k), self.getLabelFilename(k))
+                 for k in neighbourIndices(self.idx, self.prefetchCount, len(self.imageList))]
+        self.prefetchWorker.request(files)
+
+    # Start the thread that writes the label files
+    def initLabelSaver(self):
+        self.labelSaveThread = QtCore.QThread()
+        self.labelSaveWorker = LabelSaveWorker()
+        self.labelSaveWorker.moveToThread(self.labelSaveThread)
+        self.labelSaveWorker.saved.connect(self.labelsSaved)
+        self.labelSaveWorker.failed.connect(self.labelsSaveFailed)
+        self.labelSaveThread.start()
+        self.canvas.labelSaver = self.labelSaveWorker
+        QtGui.qApp.aboutToQuit.connect(self.stopLabelSaver)
+
+    # Stop the saver thread and write what is still queued
+    @QtCore.pyqtSlot()
+    def stopLabelSaver(self):
+        if (self.labelSaveThread is None):
+            return
+        self.labelSaveThread.quit()
+        self.labelSaveThread.wait()
+        self.labelSaveThread = None
+        self.labelSaveWorker.writePending()
+
+    @QtCore.pyqtSlot(str)
+    def labelsSaved(self, filename):
+        filename = str(filename)
+        # The labels loaded ahead of time are outdated
+        self.prefetchCache.discard(filename)
+        self.statusBarShowMessage("Saved labels to {0}".format(filename))
+
+    @QtCore.pyqtSlot(str, str)
+    def labelsSaveFailed(self, filename, message):
+        filename = str(filename)
+        self.statusBarShowMessage(message)
+        if (filename == self.getLabelFilename()):
+            # Still shown, let the user save again
+            self.canvas.setChanges()
+        else:
+            QtGui.QMessageBox.warning(self, "Save label", message)
+
     def setTip(self, action, tip):
         shortcuts = "', '".join([str(s.toString()) for s in action.shortcuts()])
         if (not shortcuts):
@@ -279,26 +363,33 @@ class InstanceLabelTool(QtGui.QMainWindow):
         success = False
         message = self.defaultStatusbar
         if self.imageList:
-            filename = self.imageList[self.idx]
-            filename = os.path.join(self.imageDir, filename)
+            filename = self.getImageFilename()
             self.numLabel.setText('{0}/{1}'.format(self.idx+1, len(self.imageList)))
-            success = self.canvas.loadImage(filename)
+            success = self.canvas.loadImage(filename, self.prefetchCache.takeFile(filename))
             if (not success):
                 message = "failed to read image: {0}".format(filename)
             else:
                 message = filename
             self.loadLabels()
             self.canvas.update()
+            self.prefetchNeighbours()
         else:
             self.numLabel.setText('')
         self.statusBarShowMessage(message)
 
-    # Get the filename where to load/save labels
+    # Get the filename of the image idx, the current one by default
+    def getImageFilename(self, idx=None):
+        idx = self.idx if idx is None else idx
+        return os.path.join(self.imageDir, self.imageList[idx])
+
+    # Get the filename where to load/save labels of the image idx,
+    # the current one by default
     # Returns empty string  if not possible
-    def getLabelFilename(self):
+    def getLabelFilename(self, idx=None):
+        idx = self.idx if idx is None else idx
         filename = ""
         if (self.imageList):
-            filename = self.imageList[self.idx]
+            filename = self.imageList[idx]
             filename = os.path.join(self.imageDir, filename)
             imageExt = os.path.splitext(filename)[1]
             filename = filename.replace(imageExt, self.gtExt)
@@ -308,10 +399,15 @@ class InstanceLabelTool(QtGui.QMainWindow):
     # Load the labels from json file
     def loadLabels(self):
         filename = self.getLabelFilename()
+        # Labels saved but not written yet
+        pending = self.labelSaveWorker.pendingAnnotation(filename) if filename else None
+        if (pending is not None):
+            self.canvas.loadLabels(filename, pending.copy())
+            return
         if (not filename or not os.path.isfile(filename)):
             self.canvas.clearAnnotation()
             return
-        self.canvas.loadLabels(filename)
+        self.canvas.loadLabels(filename, self.prefetchCache.takeFile(filename))
 
     # Save the labels to json file
     def saveLabels(self):
@@ -365,6 +461,20 @@ class InstanceLabelTool(QtGui.QMainWindow):
                 categories = [c['name'] for c in jsonDict['categories']]
                 self.labelSetComboBox.addItems(categories)
                 self.canvas.setCurrentLabelName(categories[0])
+                # Optional, 0 means use all cores
+                jobs = int(jsonDict.get('batchConvertJobs', 0))
+                if (jobs > 0):
+                    self.batchConvertJobs = jobs
+                # Optional, compact json and coordinate precision of saved labels
+                self.saveOptions['compact'] = bool(jsonDict.get('compactJson', False))
+                precision = jsonDict.get('coordinatePrecision')
+                self.saveOptions['precision'] = None if precision is None else int(precision)
+                self.canvas.saveOptions = self.saveOptions
+                # Optional, 0 disables loading ahead
+                self.prefetchCount = int(jsonDict.get('prefetchImages', self.prefetchCount))
+                # Optional, 0 keeps a point per boundary pixel
+                self.simplifyTolerance = float(jsonDict.get('simplifyBoundaries', self.simplifyTolerance))
+                self.canvas.simplifyTolerance = self.simplifyTolerance
         except StandardError as e:
             msgBox = QtGui.QMessageBox(self)
             msgBox.setWindowTitle("Error")
@@ -408,7 +518,9 @@ class InstanceLabelTool(QtGui.QMainWindow):
         self.progressDialog.canceled.connect(self.batchConvertStop)
 
         self.batchConvertThread = QtCore.QThread()
-        self.batchConvertWorker = BatchConvertToBoundariesWorker(self.imageList, self.imageDir, self.gtExt)
+        self.batchConvertWorker = BatchConvertToBoundariesWorker(
+            self.imageList, self.imageDir, self.gtExt, self.batchConvertJobs, self.saveOptions,
+            self.simplifyTolerance)
         self.batchConvertWorker.information.connect(self.dealwithBatchConvertUserOperation)
         self.batchConvertWorker.updateProgress.connect(self.updateBatchConvertProgressDialog)
         self.batchConvertWorker.finished.connect(self.batchConvertStop)
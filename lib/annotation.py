@@ -17,12 +17,76 @@ from abc import ABCMeta, abstractmethod
 import json
 import datetime
 import os
+import io
+import copy
 import numpy as np
 
 
 # A point in a polygon
 Point = namedtuple('Point', ['x', 'y'])
 
+class PolygonRing(object):
+    """
+    The points of one polygon as a contiguous (N, 2) array of x, y in
+    points. Integer coordinates are kept as int64 until a non integer
+    point is stored, all others are float64. Indexing and iterating give
+    Point, and it supports the list operations the tools use, so code
+    written for a list of points keeps working. An int64 or float64
+    array is used as it is, without a copy.
+    """
+    def __init__(self, points=()):
+        points = np.asarray(points)
+        if (points.dtype.kind in 'biu'):
+            points = points.astype(np.int64, copy=False)
+        else:
+            points = points.astype(np.float64, copy=False)
+        self.points = np.ascontiguousarray(points.reshape(-1, 2))
+
+    def __len__(self):
+        return len(self.points)
+
+    def __iter__(self):
+        for x, y in self.points.tolist():
+            yield Point(x, y)
+
+    def __getitem__(self, idx):
+        if (isinstance(idx, slice)):
+            return PolygonRing(self.points[idx].copy())
+        x, y = self.points[idx].tolist()
+        return Point(x, y)
+
+    def __setitem__(self, idx, pt):
+        pts = self.fitPoints([pt])
+        self.points[idx] = pts
+
+    def __delitem__(self, idx):
+        self.points = np.delete(self.points, idx, axis=0)
+
+    def __repr__(self):
+        return 'PolygonRing({0})'.format(self.points.tolist())
+
+    def insert(self, idx, pt):
+        # Same as list.insert for an index past either end
+        if (idx < 0):
+            idx = max(idx + len(self.points), 0)
+        idx = min(idx, len(self.points))
+        pts = self.fitPoints([pt])
+        self.points = np.insert(self.points, idx, pts, axis=0)
+
+    def append(self, pt):
+        self.insert(len(self.points), pt)
+
+    def reverse(self):
+        self.points = np.ascontiguousarray(self.points[::-1])
+
+    # Points as an array that can be stored without loss, changes the
+    # ring to float64 for non integer points
+    def fitPoints(self, pts):
+        pts = np.asarray(pts)
+        if (self.points.dtype.kind == 'i' and pts.dtype.kind not in 'biu'):
+            self.points = self.points.astype(np.float64)
+        return pts
+
 def enum(*args):
     enums = dict(zip(args, range(len(args))))
     return type('Enum', (), enums)
@@ -36,6 +100,10 @@ class AnnObject:
 
     def __init__(self, objType):
         self.objectType = objType
+        # Data derived from the polygon, e.g. the polygons ready to draw,
+        # keyed by name. Not read from or written to JSON
+        # Cleared when the polygon is set or invalidateGeometry is called
+        self.geometry = {}
         
         # If deleted or not
         self.deleted  = 0
@@ -58,7 +126,53 @@ class AnnObject:
     def fromJsonText(self, jsonText, objId=-1): pass
 
     @abstractmethod
-    def toJsonText(self): pass
+    def toJsonText(self, precision=None): pass
+
+    # The polygons as a list of PolygonRing, lists of points are converted
+    @property
+    def polygon(self):
+        if (self._polygonLoader is not None):
+            self.polygon = self._polygonLoader()
+        return self._polygon
+
+    @polygon.setter
+    def polygon(self, polygon):
+        self._polygonLoader = None
+        self._polygon = [poly if isinstance(poly, PolygonRing) else PolygonRing(poly)
+                         for poly in polygon]
+        self.invalidateGeometry()
+
+    # Decode the polygon on first use, loader returns the list of rings
+    def setPolygonLoader(self, loader):
+        self._polygon = []
+        self._polygonLoader = loader
+        self.invalidateGeometry()
+
+    # Must be called after changing the polygon in place
+    def invalidateGeometry(self):
+        self.geometry = {}
+
+    # A copy that does not change with this object, e.g. to write it out
+    # on another thread. A polygon that is not loaded yet keeps its loader
+    def copy(self):
+        obj = copy.copy(self)
+        obj.geometry = {}
+        if (self._polygonLoader is None):
+            obj._polygon = [PolygonRing(poly.points.copy()) for poly in self._polygon]
+        return obj
+
+    # The polygon as lists of x, y values for json, rounded to precision
+    # decimals if given
+    def polygonToJson(self, precision=None):
+        return list(self.polygonRingsToJson(precision))
+
+    # Same as polygonToJson, but one ring at a time
+    def polygonRingsToJson(self, precision=None):
+        for poly in self.polygon:
+            if (precision is None):
+                yield poly.points.ravel().tolist()
+            else:
+                yield np.round(poly.points, precision).ravel().tolist()
 
     def updateDate( self ):
         self.date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -73,7 +187,7 @@ class AnnInstance(AnnObject):
     # Constructor
     def __init__(self):
         AnnObject.__init__(self, AnnObjectType.INSTANCE)
-        # the polygon as list of points
+        # the polygon as list of PolygonRing
         self.polygon    = []
         # the object ID
         self.id         = -1
@@ -95,13 +209,8 @@ class AnnInstance(AnnObject):
     def fromJsonText(self, jsonText, objId):
         self.id = objId
         self.label = str(jsonText['label'])
-        self.polygon = []
-        for polygon in jsonText['polygon']:
-            polygon = np.array(polygon).reshape((int(len(polygon)/2), 2))
-            newPoly = []
-            for i in range(polygon.shape[0]):
-                newPoly.append(Point(polygon[i][0], polygon[i][1]))
-            self.polygon.append(newPoly)
+        self.polygon = [PolygonRing(np.array(polygon).reshape((int(len(polygon)/2), 2)))
+                        for polygon in jsonText['polygon']]
         if ('deleted' in jsonText.keys()):
             self.deleted = jsonText['deleted']
         else:
@@ -123,7 +232,7 @@ class AnnInstance(AnnObject):
         else:
             self.draw = True
 
-    def toJsonText(self):
+    def toJsonText(self, precision=None):
         objDict = {}
         objDict['label'] = self.label
         objDict['id'] = self.id
@@ -131,13 +240,7 @@ class AnnInstance(AnnObject):
         objDict['verified'] = self.verified
         objDict['user'] = self.user
         objDict['date'] = self.date
-        objDict['polygon'] = []
-        for poly in self.polygon:
-            newPoly = []
-            for pt in poly:
-                newPoly.append(pt.x)
-                newPoly.append(pt.y)
-            objDict['polygon'].append(newPoly)
+        objDict['polygon'] = self.polygonToJson(precision)
 
         return objDict
 
@@ -146,7 +249,7 @@ class AnnBoundary(AnnObject):
     # Constructor
     def __init__(self):
         AnnObject.__init__(self, AnnObjectType.OCCLUSION_BOUNDARY)
-        # the polygon as list of points
+        # the polygon as list of PolygonRing
         self.polygon    = []
 
     def __str__(self):
@@ -160,13 +263,8 @@ class AnnBoundary(AnnObject):
         return text
 
     def fromJsonText(self, jsonText, objId = -1):
-        self.polygon = []
-        for polygon in jsonText['polygon']:
-            polygon = np.array(polygon).reshape((int(len(polygon)/2), 2))
-            newPoly = []
-            for i in range(polygon.shape[0]):
-                newPoly.append(Point(polygon[i][0], polygon[i][1]))
-            self.polygon.append(newPoly)
+        self.polygon = [PolygonRing(np.array(polygon).reshape((int(len(polygon)/2), 2)))
+                        for polygon in jsonText['polygon']]
         if ('deleted' in jsonText.keys()):
             self.deleted = jsonText['deleted']
         else:
@@ -188,19 +286,19 @@ class AnnBoundary(AnnObject):
         else:
             self.draw = True
 
-    def toJsonText(self):
+    def toJsonText(self, precision=None):
+        objDict = self.attributesToJson()
+        objDict['polygon'] = self.polygonToJson(precision)
+
+        return objDict
+
+    # The json dict without the polygon
+    def attributesToJson(self):
         objDict = {}
         objDict['deleted'] = self.deleted
         objDict['verified'] = self.verified
         objDict['user'] = self.user
         objDict['date'] = self.date
-        objDict['polygon'] = []
-        for poly in self.polygon:
-            newPoly = []
-            for pt in poly:
-                newPoly.append(pt.x)
-                newPoly.append(pt.y)
-            objDict['polygon'].append(newPoly)
 
         return objDict
 
@@ -219,8 +317,18 @@ class Annotation:
         assert objType in AnnObjectType.__dict__.values()
         self.objectType = objType
 
+    # A copy that does not change with this annotation
+    def copy(self):
+        annotation = copy.copy(self)
+        annotation.objects = [obj.copy() for obj in self.objects]
+        if (self.boundaries):
+            annotation.boundaries = self.boundaries.copy()
+        return annotation
+
     def fromJsonText(self, jsonText):
-        jsonDict = json.loads(jsonText)
+        self.fromJsonDict(json.loads(jsonText))
+
+    def fromJsonDict(self, jsonDict):
         self.imgWidth  = int(jsonDict['imgWidth'])
         self.imgHeight = int(jsonDict['imgHeight'])
         self.objects   = []
@@ -234,19 +342,79 @@ class Annotation:
             self.boundaries = AnnBoundary()
             self.boundaries.fromJsonText(jsonDict['boundaries'])
 
-    def toJsonText(self):
-        jsonDict = {}
-        jsonDict['imgWidth'] = self.imgWidth
-        jsonDict['imgHeight'] = self.imgHeight
-        jsonDict['objects'] = []
-        for obj in self.objects:
-            objDict = obj.toJsonText()
-            jsonDict['objects'].append(objDict)
+    # The json text of the annotation. By default it is indented by 4 with
+    # sorted keys, compact leaves out all whitespace, and precision rounds
+    # the coordinates to that many decimals
+    def toJsonText(self, compact=False, precision=None):
+        f = io.BytesIO()
+        self.writeJson(f, compact, precision)
+        return f.getvalue()
+
+    # Write the json text to the file object f one object at a time, so the
+    # whole text is never in memory. Same options as toJsonText
+    def writeJson(self, f, compact=False, precision=None):
+        if (compact):
+            itemSeparator, keySeparator = ',', ':'
+        else:
+            itemSeparator, keySeparator = ', ', ': '
+
+        # Line break and indentation of the given nesting level
+        def newline(level):
+            if (compact):
+                return ''
+            return '\n' + ' ' * (4 * level)
+
+        # A value nested at the given level
+        def dump(value, level):
+            if (compact):
+                # json only uses its fast encoder without sort_keys,
+                # so sort the keys here
+                if (isinstance(value, dict)):
+                    return '{' + itemSeparator.join(json.dumps(key) + keySeparator + dump(value[key], level + 1)
+                                                    for key in sorted(value)) + '}'
+                return json.dumps(value, default=lambda o: o.__dict__,
+                                  separators=(itemSeparator, keySeparator))
+            text = json.dumps(value, default=lambda o: o.__dict__, sort_keys=True, indent=4)
+            return text.replace('\n', newline(level))
+
+        # A json list written one item at a time
+        def writeList(items, level):
+            n = -1
+            for n, item in enumerate(items):
+                f.write((itemSeparator if n > 0 else '[') + newline(level + 1) + dump(item, level + 1))
+            f.write('[]' if n < 0 else newline(level) + ']')
+
+        # The boundaries are written like the objects: the attributes as
+        # they are, the polygon one ring at a time
+        def writeBoundaries(level):
+            attributes = self.boundaries.attributesToJson()
+            f.write('{')
+            for n, key in enumerate(sorted(list(attributes) + ['polygon'])):
+                if (n > 0):
+                    f.write(itemSeparator)
+                f.write(newline(level + 1) + json.dumps(key) + keySeparator)
+                if (key == 'polygon'):
+                    writeList(self.boundaries.polygonRingsToJson(precision), level + 1)
+                else:
+                    f.write(dump(attributes[key], level + 1))
+            f.write(newline(level) + '}')
+
+        keys = ['imgWidth', 'imgHeight', 'objects']
         if (self.boundaries):
-            jsonDict['boundaries'] = self.boundaries.toJsonText()
-  
-        jsonText = json.dumps(jsonDict, default=lambda o: o.__dict__, sort_keys=True, indent=4)
-        return jsonText
+            keys.append('boundaries')
+
+        f.write('{')
+        for n, key in enumerate(sorted(keys)):
+            if (n > 0):
+                f.write(itemSeparator)
+            f.write(newline(1) + json.dumps(key) + keySeparator)
+            if (key == 'objects'):
+                writeList((obj.toJsonText(precision) for obj in self.objects), 1)
+            elif (key == 'boundaries'):
+                writeBoundaries(1)
+            else:
+                f.write(dump(getattr(self, key), 1))
+        f.write(newline(0) + '}')
 
     # Read a json formatted polygon file and return the annotation
     def fromJsonFile(self, jsonFile):
@@ -254,9 +422,8 @@ class Annotation:
             print('Given json file not found: {}'.format(jsonFile))
             return
         with open(jsonFile, 'r') as f:
-            jsonText = f.read()
-            self.fromJsonText(jsonText)
+            self.fromJsonDict(json.load(f))
 
-    def toJsonFile(self, jsonFile):
+    def toJsonFile(self, jsonFile, compact=False, precision=None):
         with open(jsonFile, 'w') as f:
-            f.write(self.toJsonText())
+            self.writeJson(f, compact, precision)
@@ -0,0 +1,299 @@
+"""
+Benchmark the stages of the occlusion boundary conversion.
+
+Usage: python -m lib.benchmark [--sizes vga,hd,fhd,4k] [--instances N]
+                               [--vertices M] [--repeat R]
+                               [--save result.json] [--compare base.json]
+
+Every stage is timed on synthetic annotations (N star shaped instances with
+M vertices each) for the given image sizes and on the bundled
+data/000000000063.polygons.json. The time is the best of R runs, the
+memory is the peak resident memory the stage adds on its first run. The
+stages within edgelink are the ones it records with its timer, they have
+no memory of their own. With
+--compare the exit status is 1 if a stage got slower or bigger than the
+saved result by more than --tolerance.
+
+Copyright (c) 2018- Guoxia Wang
+mingzilaochongtu at gmail com
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+The Software is provided "as is", without warranty of any kind.
+
+"""
+import numpy as np
+import scipy
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import ctypes
+import ctypes.util
+import gc
+
+from edgelink import edgelink
+from stagetimer import StageTimer
+from annotation import Annotation, AnnInstance
+from convert import BoundariesConverter
+from geometry import simplifyPolylines
+
+# Image sizes as (width, height)
+IMAGE_SIZES = {
+    'vga': (640, 480),
+    'hd': (1280, 720),
+    'fhd': (1920, 1080),
+    '4k': (3840, 2160),
+}
+
+DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'data', '000000000063.polygons.json')
+
+# Make an annotation with star shaped instances at random positions
+def syntheticAnnotation(width, height, instances, vertices, seed=0):
+    rng = np.random.RandomState(seed)
+    annotation = Annotation()
+    annotation.imgWidth = width
+    annotation.imgHeight = height
+    for objId in range(instances):
+        center = rng.rand(2) * [width, height]
+        radius = rng.uniform(0.02, 0.15) * min(width, height)
+        angles = np.sort(rng.rand(vertices)) * 2 * np.pi
+        radii = radius * rng.uniform(0.6, 1.0, vertices)
+        x = np.clip(center[0] + radii * np.cos(angles), 0, width - 1)
+        y = np.clip(center[1] + radii * np.sin(angles), 0, height - 1)
+        obj = AnnInstance()
+        obj.fromJsonText({'label': 'synthetic',
+                          'polygon': [np.column_stack([x, y]).ravel().tolist()]}, objId)
+        annotation.objects.append(obj)
+    return annotation
+
+# Peak resident memory of this process in bytes. Resets the peak
+# first if reset is set and the system supports it (Linux).
+def peakMemory(reset=False):
+    try:
+        if (reset):
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if (line.startswith('VmHWM:')):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+# Give freed memory back to the system where possible, so that the
+# next stage does not reuse it unnoticed
+def releaseMemory():
+    gc.collect()
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        libc.malloc_trim(0)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+# Current resident memory in bytes, or the peak if unknown
+def currentMemory():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if (line.startswith('VmRSS:')):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return peakMemory()
+
+# The stages of BoundariesConverter.convertToBoundaries and edgelink,
+# each takes the outputs of the previous ones from the context
+def stageRasterize(ctx):
+    annotation = ctx['annotation']
+    converter = BoundariesConverter(annotation.objects)
+    converter.setSegmentMap(annotation.imgHeight, annotation.imgWidth)
+    ctx['converter'] = converter
+    return converter.rasterize()
+
+def stageBoundaryMap(ctx):
+    return ctx['converter'].segmentationMapToBoundaryMap(ctx['rasterize'])
+
+# The former twice the resolution boundary map, for comparison
+def stageBoundaryMapFull(ctx):
+    return ctx['converter'].segmentationMapToBoundaryMapFull(ctx['rasterize'])
+
+def stageEdgelink(ctx):
+    timer = StageTimer()
+    ctx['edgelinkTimer'] = timer
+    edgelist, edgeim, etype = edgelink(ctx['boundaryMap'], timer=timer)
+    return [edge for edge in edgelist if len(edge) >= 5]
+
+def stageDirection(ctx):
+    return ctx['converter'].edgesNeedReverse(ctx['edgelink'])
+
+# Simplification of the directed edges as points (x, y), 1 pixel tolerance
+def stageSimplify(ctx):
+    return simplifyPolylines([np.asarray(edge)[:, ::-1] for edge in ctx['edgelink']], 1.0)
+
+def stageTotal(ctx):
+    annotation = ctx['annotation']
+    converter = BoundariesConverter(annotation.objects)
+    converter.setSegmentMap(annotation.imgHeight, annotation.imgWidth)
+    return converter.convertToBoundaries()
+
+STAGES = [
+    ('rasterize', stageRasterize),
+    ('boundaryMap', stageBoundaryMap),
+    ('boundaryMapFull', stageBoundaryMapFull),
+    ('edgelink', stageEdgelink),
+    ('direction', stageDirection),
+    ('simplify', stageSimplify),
+    ('total', stageTotal),
+]
+
+# The stages edgelink records with its timer, they are reported after it.
+# Their memory is not measured
+EDGELINK_STAGES = ['close', 'thin', 'junctions', 'track']
+
+# The names of the stages in the order they are reported
+def stageNames():
+    names = []
+    for name, stage in STAGES:
+        names.append(name)
+        if (name == 'edgelink'):
+            names.extend(EDGELINK_STAGES)
+    return names
+
+# Run all stages on one annotation, returns {stage: {'time', 'memory'}}
+def benchmarkAnnotation(annotation, repeat=3):
+    ctx = {'annotation': annotation}
+    results = {}
+    for name, stage in STAGES:
+        releaseMemory()
+        before = currentMemory()
+        peakMemory(reset=True)
+        start = time.time()
+        ctx[name] = stage(ctx)
+        best = time.time() - start
+        memory = max(peakMemory() - before, 0)
+        timers = [ctx.get('edgelinkTimer')]
+        for i in range(repeat - 1):
+            start = time.time()
+            stage(ctx)
+            best = min(best, time.time() - start)
+            timers.append(ctx.get('edgelinkTimer'))
+        results[name] = {'time': best, 'memory': memory}
+        if (name == 'edgelink'):
+            for subName in EDGELINK_STAGES:
+                times = [seconds for timer in timers
+                         for stageName, seconds, stats in timer.stages if stageName == subName]
+                results[subName] = {'time': min(times), 'memory': None}
+    return results
+
+def runBenchmarks(sizes, instances, vertices, repeat=3, data=True):
+    scenarios = []
+    for size in sizes:
+        width, height = IMAGE_SIZES[size]
+        name = '{0}-{1}x{2}'.format(size, instances, vertices)
+        scenarios.append((name, syntheticAnnotation(width, height, instances, vertices)))
+    if (data and os.path.isfile(DATA_FILE)):
+        annotation = Annotation()
+        annotation.fromJsonFile(DATA_FILE)
+        scenarios.append(('data-000000000063', annotation))
+
+    results = {}
+    for name, annotation in scenarios:
+        results[name] = benchmarkAnnotation(annotation, repeat)
+        printResults({name: results[name]})
+    return results
+
+def printResults(results):
+    for scenario in sorted(results):
+        for name in stageNames():
+            if (name not in results[scenario]):
+                continue
+            result = results[scenario][name]
+            if (result['memory'] is None):
+                memory = ''
+            else:
+                memory = '{0:>9.1f} MB'.format(result['memory'] / 1048576.0)
+            print('{0:<24} {1:<16} {2:>10.1f} ms {3}'.format(
+                scenario, name, result['time'] * 1000, memory).rstrip())
+        sys.stdout.flush()
+
+# Compare with a saved run, returns a list of regression messages.
+# Memory below minMemory bytes is too noisy to compare.
+def compareResults(results, baseline, tolerance, minMemory=1048576):
+    regressions = []
+    for scenario in sorted(results):
+        for name in sorted(results[scenario]):
+            if (name not in baseline.get(scenario, {})):
+                continue
+            new = results[scenario][name]
+            old = baseline[scenario][name]
+            if (new['time'] > old['time'] * (1 + tolerance)):
+                regressions.append('{0} {1}: time {2:.1f} ms -> {3:.1f} ms'.format(
+                    scenario, name, old['time'] * 1000, new['time'] * 1000))
+            if (new['memory'] is None or old['memory'] is None):
+                continue
+            if (max(new['memory'], old['memory']) >= minMemory and
+                new['memory'] > old['memory'] * (1 + tolerance)):
+                regressions.append('{0} {1}: memory {2:.1f} MB -> {3:.1f} MB'.format(
+                    scenario, name, old['memory'] / 1048576.0, new['memory'] / 1048576.0))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the occlusion boundary conversion stages")
+    parser.add_argument('--sizes', default='vga,hd,fhd,4k',
+                        help="image sizes, any of {0} (default: all)".format(
+                            ','.join(sorted(IMAGE_SIZES))))
+    parser.add_argument('--instances', type=int, default=20,
+                        help="instances per synthetic image (default: 20)")
+    parser.add_argument('--vertices', type=int, default=50,
+                        help="vertices per synthetic instance (default: 50)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs per stage, the best time is kept (default: 3)")
+    parser.add_argument('--no-data', dest='data', action='store_false',
+                        help="skip the bundled annotation")
+    parser.add_argument('--save', help="write the results to a json file")
+    parser.add_argument('--compare', help="compare with a json file written by --save")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed relative slow down for --compare (default: 0.2)")
+    args = parser.parse_args(argv)
+
+    sizes = [s for s in args.sizes.split(',') if s]
+    for size in sizes:
+        if (size not in IMAGE_SIZES):
+            parser.error("unknown size {0}".format(size))
+
+    print('python {0}, numpy {1}, scipy {2}'.format(
+        platform.python_version(), np.__version__, scipy.__version__))
+    print('{0:<24} {1:<16} {2:>13} {3:>12}'.format('scenario', 'stage', 'time', 'peak memory'))
+    results = runBenchmarks(sizes, args.instances, args.vertices,
+                            max(args.repeat, 1), args.data)
+
+    if (args.save):
+        with open(args.save, 'w') as f:
+            f.write(json.dumps(results, sort_keys=True, indent=4))
+
+    if (args.compare):
+        with open(args.compare, 'r') as f:
+            baseline = json.loads(f.read())
+        regressions = compareResults(results, baseline, args.tolerance)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        if (regressions):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,7 +14,7 @@ LUT_DEL_MASK = np.array([[ 8,  4,  2],
                          [32, 64,128]],dtype=np.uint8)
 
 
-def _bwmorph_luts(image, luts, n_iter=None, padding=0):
+def _bwmorph_luts(image, luts, n_iter=None, padding=0, front=False):
     # check parameters
     if n_iter is None:
         n = -1
@@ -25,13 +25,17 @@ def _bwmorph_luts(image, luts, n_iter=None, padding=0):
 
     # check that we have a 2d binary image, and convert it
     # to uint8
+    image = np.asarray(image)
     im = np.array(image).astype(np.uint8)
 
     if im.ndim != 2:
         raise ValueError('2D array required')
-    if not np.all(np.in1d(image.flat,(0,1))):
+    if image.dtype != np.bool and not np.all((image == 0) | (image == 1)):
         raise ValueError('Image contains values other than 0 and 1')
 
+    if front:
+        return _bwmorph_luts_front(im, luts, n, padding)
+
     # iterate either 1) indefinitely or 2) up to iteration limit
     while n != 0:
         before = np.sum(im) # count points before
@@ -57,6 +61,71 @@ def _bwmorph_luts(image, luts, n_iter=None, padding=0):
     return im.astype(np.bool)
 
 
+def _bwmorph_luts_front(im, luts, n, padding=0):
+    """
+    Same as _bwmorph_luts, but a subiteration only looks at the pixels
+    whose neighborhood changed since its LUT was last applied. The
+    decision for any other pixel is the same as last time, i.e. keep it.
+    The first pass of each LUT looks at all set pixels, later passes
+    only at the neighbors of the pixels deleted in between, so on
+    nearly thin images most of the work is the first pass.
+    """
+    rows, cols = im.shape
+    # Pad the image, so that neighbors are never out of bounds
+    padded = np.empty((rows + 2, cols + 2), np.uint8)
+    padded.fill(padding)
+    padded[1:-1, 1:-1] = im
+    width = cols + 2
+    flat = padded.ravel()
+    inner = np.zeros(padded.shape, np.bool)
+    inner[1:-1, 1:-1] = True
+    inner = inner.ravel()
+
+    # Flat offset and LUT_DEL_MASK weight of the 8 neighbors
+    offsets = np.array([(r - 1) * width + (c - 1)
+                        for r in range(3) for c in range(3) if (r, c) != (1, 1)])
+    weights = np.array([LUT_DEL_MASK[r, c]
+                        for r in range(3) for c in range(3) if (r, c) != (1, 1)], np.int32)
+
+    # Pixels deleted since each LUT was last applied, None before its first pass
+    changed = [None] * len(luts)
+    while n != 0:
+        deletedCount = 0
+
+        for k, lut in enumerate(luts):
+            if changed[k] is None:
+                candidates = np.flatnonzero(padded[1:-1, 1:-1])
+                candidates = (candidates // cols + 1) * width + candidates % cols + 1
+            else:
+                if not len(changed[k]):
+                    continue
+                candidates = np.unique((changed[k][:, np.newaxis] + offsets).ravel())
+                candidates = candidates[(flat[candidates] != 0) & inner[candidates]]
+
+            # neighborhood codes of the candidates, as ndi.correlate gives
+            codes = np.zeros(len(candidates), np.int32)
+            for offset, weight in zip(offsets, weights):
+                codes += flat[candidates + offset] * weight
+            # delete all at once, as a subiteration is parallel
+            deleted = candidates[lut[codes]]
+            flat[deleted] = 0
+            deletedCount += len(deleted)
+
+            changed[k] = deleted
+            for m in range(len(luts)):
+                if m != k and changed[m] is not None:
+                    changed[m] = np.concatenate([changed[m], deleted])
+
+        if deletedCount == 0:
+            # iteration had no effect: finish
+            break
+
+        # count down to iteration limit (or endlessly negative)
+        n -= 1
+
+    return padded[1:-1, 1:-1].astype(np.bool)
+
+
 # lookup tables for thin
 
 G123_LUT = np.array([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 0, 1,
@@ -87,7 +156,7 @@ G123P_LUT = np.array([0, 0, 0, 0, 0, 1, 0, 1, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0
 
 THIN_LUTS=[G123_LUT, G123P_LUT]
 
-def thin(image, n_iter=None):
+def thin(image, n_iter=None, front=False):
     """
     Perform morphological thinning of a binary image
 
@@ -102,6 +171,12 @@ def thin(image, n_iter=None):
         If this parameter is specified it thus sets an upper bound on
         the number of iterations performed.
 
+    front : bool, optional
+        Only re-evaluate the neighborhoods of the pixels deleted since
+        the previous pass instead of the whole image. The result is
+        the same, but it is much faster on nearly thin images such as
+        boundary maps.
+
     Returns
     -------
     out : ndarray of bools
@@ -154,7 +229,7 @@ def thin(image, n_iter=None):
            [0, 0, 0, 0, 0, 0, 0],
            [0, 0, 0, 0, 0, 0, 0]], dtype=uint8)
     """
-    return _bwmorph_luts(image, THIN_LUTS, n_iter=n_iter)
+    return _bwmorph_luts(image, THIN_LUTS, n_iter=n_iter, front=front)
 
 
 SPUR_LUT = np.array([1, 1, 1, 1, 1, 1, 0, 0, 1, 0, 0, 0, 1, 0, 1, 0, 1, 0, 0, 0, 1, 0,
@@ -16,8 +16,12 @@ from PyQt4 import QtGui, QtCore
 import getpass
 import numpy as np
 
-from annotation import Point, AnnObjectType, AnnInstance, AnnBoundary, Annotation
+from annotation import Point, PolygonRing, AnnObjectType, AnnInstance, AnnBoundary, Annotation
 from worker import ConvertToBoundariesWorker
+from convert import simplifyCounts, simplifySummary
+from spatialindex import GridIndex, unionBox, boxesIntersect
+from geometry import arrowPolygons, polygonIsValid, polylineCanExtend, EdgeIndex, closestPoint, BoundaryMap
+from sidecar import readLabels, writeLabels
 
 class Canvas(QtGui.QWidget):
     scrollRequest = QtCore.pyqtSignal(int, int)
@@ -37,14 +41,28 @@ class Canvas(QtGui.QWidget):
 
         # Redraw Labels
         self.redraw = True
+        # The box (xmin, ymin, xmax, ymax) of the image to draw again if
+        # not everything is, see markDirty
+        self.dirtyBox = None
+        # The highlighted objects as drawn in the cache image
+        self.cachedHighlightObjIds = []
         
         # A point of this poly that is dragged
         self.draggedPt = (-1, -1)
+        # Whether the polygon of the dragged point was valid when the drag
+        # started, then only the edges at the point are checked
+        self.draggedPolyValid = False
+        # The object whose point is dragged, its box in the object index
+        # is updated when the drag ends. -1 if there is none
+        self.draggedObj = -1
         
         # A polygon that is drawn by the user
         self.drawPoly = QtGui.QPolygonF()
         # The polygons of one object
         self.polygons = []
+        # The edges of self.polygons to check edits with, keyed by their
+        # index, made when a polygon is first edited
+        self.edgeIndexes = {}
         
         # The mouse position
         self.mousePos = None
@@ -56,15 +74,23 @@ class Canvas(QtGui.QWidget):
         self.mouseObj = (-1, -1)
         # The current boundary the mouse points to, It's the index in self.annotation.boundaries
         self.mouseBdry = -1
+        # The boundaries self.boundaryMap was made for and the map to find
+        # the boundary under the mouse, see getBoundaryAt
+        self.boundaryMapSource = None
+        self.boundaryMap = None
         # The currently selected objects. Their index in self.annotation.objects
         self.selObjs = []
+        # The bounding boxes of the objects, keyed by their index in self.annotation.objects
+        self.objectIndex = GridIndex()
 
         # Current image as QImage
         self.image = QtGui.QImage()
 
-        # Cache image, if there are no labels changed, we draw cache image
-        self.cacheImage = QtGui.QImage()
+        # Cache images of the labels and of the occlusion boundaries, drawn
+        # over the image at paint time. They are kept and only drawn again
+        # where something changed
         self.cacheLabelImage = QtGui.QImage()
+        self.cacheBoundaryImage = QtGui.QImage()
         
         # Current selected label
         self.curLabel = ""
@@ -77,6 +103,14 @@ class Canvas(QtGui.QWidget):
 
         # Change flag
         self.changes = False
+        # Keyword arguments of Annotation.toJsonFile when saving
+        self.saveOptions = {}
+        # Tolerance in pixels to simplify converted boundaries with, 0
+        # keeps a point per boundary pixel
+        self.simplifyTolerance = 0.0
+        # LabelSaveWorker writing the label files on another thread,
+        # they are written here if None
+        self.labelSaver = None
 
         # Occlusion boundary convert thread
         self.convertThread = None
@@ -99,16 +133,23 @@ class Canvas(QtGui.QWidget):
         qp.begin(self)
         #qp.setRenderHint(QtGui.QPainter.Antialiasing)
         #qp.setRenderHint(QtGui.QPainter.HighQualityAntialiasing)
-        self.drawCanvas(qp)
+        self.drawCanvas(qp, event.rect())
         qp.end()	
         
         # Forward the paint event
         QtGui.QMainWindow.paintEvent(self, event)
 
-    def drawCanvas(self, qp):
+    # Draw the part of the canvas inside the widget rect exposed, all of
+    # it if None
+    def drawCanvas(self, qp, exposed=None):
         # Return if no image available
         if self.image.isNull():
             return
+        if (exposed is None):
+            exposed = self.rect()
+        # The part of the image that is shown, zoomed in it is only a small
+        # window of the scroll area
+        visible = self.widgetToImageRect(exposed)
 
         # Save the painters current setting to a stack
         qp.save()
@@ -117,51 +158,128 @@ class Canvas(QtGui.QWidget):
         qp.translate(self.offsetToCenter())
         # Determine the object ID to highlight
         self.getHighlightedObjectIds()
+        self.markHighlightChanges()
         if (self.redraw):
-            self.drawCacheImage(qp)
-            self.redraw = False
-        qp.drawImage(0, 0, self.cacheImage)
+            self.drawCacheImage()
+        elif (self.dirtyBox is not None):
+            self.drawCacheImage(self.dirtyBox)
+        self.redraw = False
+        self.dirtyBox = None
+        self.cachedHighlightObjIds = list(self.highlightObjIds)
+        # Only scale the pixels that are shown
+        source = visible.toAlignedRect().intersected(self.image.rect())
+        if (not source.isEmpty()):
+            self.drawLayers(qp, QtCore.QRectF(source))
 		# Draw the user drawn polygon
-        self.drawPolygons(qp)
+        self.drawPolygons(qp, visible)
         # Draw the label name next to the mouse
         self.drawLabelAtMouse()
         # Restore the saved setting from the stack
         qp.restore()
 
-    def drawCacheImage(self, qp):
-        self.cacheImage = QtGui.QImage(self.image.width(), self.image.height(), QtGui.QImage.Format_ARGB32_Premultiplied)
-        qp = QtGui.QPainter()
-        qp.begin(self.cacheImage)
+    # Draw the image, the labels with the current transparency and the
+    # boundaries inside the image rect source
+    def drawLayers(self, qp, source):
         # Draw the image first
-        qp.drawImage(0, 0, self.image)
+        qp.drawImage(source, self.image, source)
 
-        # Redraw label image
-        if (self.redraw):
-            self.cacheLabelImage = self.drawLabels()
-
-        if (self.cacheLabelImage and not self.transpTempZero):
+        if (self.annotation and self.annotation.objects and not self.transpTempZero):
             qp.save()
             # Define transparency
             qp.setOpacity(self.transp)
             # Draw the overlay image
-            qp.drawImage(0, 0, self.cacheLabelImage)
+            qp.drawImage(source, self.cacheLabelImage, source)
             # Restore settings
             qp.restore()
 
-        if (self.redraw and
-            self.curDrawType == AnnObjectType.OCCLUSION_BOUNDARY):
-            self.drawOcclusionBoundary(qp)
+        if (self.curDrawType == AnnObjectType.OCCLUSION_BOUNDARY and
+            self.annotation and self.annotation.boundaries):
+            qp.drawImage(source, self.cacheBoundaryImage, source)
+
+    # Draw the cache images again inside box, or all of them
+    def drawCacheImage(self, box=None):
+        # Keep the buffers while the image size does not change
+        if (self.cacheLabelImage.size() != self.image.size()):
+            self.cacheLabelImage = QtGui.QImage(self.image.size(), QtGui.QImage.Format_ARGB32_Premultiplied)
+            box = None
+        # The boundaries are only shown when labeling them
+        drawBoundaries = self.curDrawType == AnnObjectType.OCCLUSION_BOUNDARY
+        if (drawBoundaries and self.cacheBoundaryImage.size() != self.image.size()):
+            self.cacheBoundaryImage = QtGui.QImage(self.image.size(), QtGui.QImage.Format_ARGB32_Premultiplied)
+            box = None
+        rect = self.image.rect()
+        if (box is not None):
+            rect = self.boxToRect(box).intersected(rect)
+            if (rect.isEmpty()):
+                return
+
+        # Redraw label image
+        self.drawLabels(rect)
+
+        if (drawBoundaries):
+            qp = QtGui.QPainter()
+            qp.begin(self.cacheBoundaryImage)
+            qp.setClipRect(rect)
+            qp.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+            qp.fillRect(rect, QtCore.Qt.transparent)
+            qp.setCompositionMode(QtGui.QPainter.CompositionMode_SourceOver)
+            self.drawOcclusionBoundary(qp, rect)
+            qp.end()
+
+    # The pixels of the image covered by box (xmin, ymin, xmax, ymax)
+    def boxToRect(self, box):
+        xmin, ymin, xmax, ymax = [int(v) for v in np.floor(box[:2]).tolist() + np.ceil(box[2:]).tolist()]
+        return QtCore.QRect(xmin, ymin, xmax - xmin + 1, ymax - ymin + 1)
+
+    # The box (xmin, ymin, xmax, ymax) of a QRect
+    def rectToBox(self, rect):
+        return (rect.left(), rect.top(), rect.right() + 1, rect.bottom() + 1)
+
+    # Mark box (xmin, ymin, xmax, ymax) of the image to be drawn again at
+    # the next paint, grown by margin for the outlines
+    def markDirty(self, box, margin=2):
+        if (box is None):
+            return
+        xmin, ymin, xmax, ymax = box
+        self.dirtyBox = unionBox(self.dirtyBox, (xmin - margin, ymin - margin, xmax + margin, ymax + margin))
 
-        qp.end()
+    # Mark the area of an object to be drawn again. Call it before and
+    # after changing the polygon to cover where it was and where it is
+    def markObjectDirty(self, obj):
+        self.markDirty(self.getObjectBox(obj))
 
-    # Draw all polygons of one object
-    def drawPolygons(self, qp):
+    # Mark the area of the boundary idx to be drawn again, with the arrows
+    def markBoundaryDirty(self, idx):
+        if (idx < 0 or not self.annotation or not self.annotation.boundaries):
+            return
+        points = self.annotation.boundaries.polygon[idx].points
+        if (len(points)):
+            (xmin, ymin), (xmax, ymax) = points.min(axis=0).tolist(), points.max(axis=0).tolist()
+            self.markDirty((xmin, ymin, xmax, ymax), margin=8)
+
+    # Mark the objects that got or lost the highlight since the cache
+    # image was drawn
+    def markHighlightChanges(self):
+        if (not self.annotation):
+            return
+        changed = set(self.highlightObjIds).symmetric_difference(self.cachedHighlightObjIds)
+        for idx in changed:
+            if (idx < len(self.annotation.objects)):
+                self.markObjectDirty(self.annotation.objects[idx])
+
+    # Draw all polygons of one object, skipping those outside the
+    # image rect visible if given
+    def drawPolygons(self, qp, visible=None):
         if (not self.image):
             return
 
-        # The closed polygons
-        for poly in self.polygons:
-            self.drawPolygon(qp, poly, True)
+        # The closed polygons, their points are kept by the edge indexes
+        for idx, poly in enumerate(self.polygons):
+            # Leave room for the points around the outline
+            if (visible is not None and
+                not poly.boundingRect().adjusted(-3, -3, 3, 3).intersects(visible)):
+                continue
+            self.drawPolygon(qp, poly, True, points=self.getEdgeIndex(idx).points)
         
         # If current drawing polygon is empty, do nothing
         if (self.drawPoly.isEmpty()):
@@ -174,7 +292,8 @@ class Canvas(QtGui.QWidget):
         self.drawPolygon(qp, poly, False)
 
     # Draw  polygon
-    def drawPolygon(self, qp, poly, polygonClosed, fill=True):
+    # points: the points of poly as an (N, 2) array, if at hand
+    def drawPolygon(self, qp, poly, polygonClosed, fill=True, points=None):
         if (not self.image):
             return
         if (poly.isEmpty()):
@@ -201,7 +320,7 @@ class Canvas(QtGui.QWidget):
             qp.drawPolygon(poly)
 
         # Get the ID of the closest point to the mouse
-        closestPt = self.getClosestPoint(poly, self.mousePos, polygonClosed)
+        closestPt = self.getClosestPoint(poly if points is None else points, self.mousePos, polygonClosed)
         # If a polygon edge is selected, draw in bold
         if (closestPt[0] != closestPt[1]):
             thickPen = QtGui.QPen(polyColor)
@@ -241,19 +360,32 @@ class Canvas(QtGui.QWidget):
         # Draw
         qp.drawEllipse(pt, r, r)
 
-    # Draw the labels in the given QPainter qp
+    # Draw the labels inside rect into the label cache image, without
+    # transparency, it is applied at paint time by drawLayers
     # optionally provide a list of labels to ignore
-    def drawLabels(self, ignore = []):
+    def drawLabels(self, rect, ignore = []):
         if (self.image.isNull()):
             return
-        if (not self.annotation or not self.annotation.objects):
-            return
 
-        overlay = QtGui.QImage(self.image.width(), self.image.height(), QtGui.QImage.Format_ARGB32_Premultiplied)
+        # Only the objects that reach into rect need to be drawn
+        rectBox = self.rectToBox(rect)
+        def visible(obj):
+            box = self.getObjectBox(obj)
+            return box is not None and boxesIntersect(box, rectBox)
+
+        overlay = self.cacheLabelImage
         col = QtGui.QColor(0, 0, 0)
-        overlay.fill(col)
         qp = QtGui.QPainter()
         qp.begin(overlay)
+        qp.setClipRect(rect)
+        # Cleared even without objects, the first ones added are only
+        # drawn inside their own box
+        qp.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+        qp.fillRect(rect, col)
+        qp.setCompositionMode(QtGui.QPainter.CompositionMode_SourceOver)
+        if (not self.annotation or not self.annotation.objects):
+            qp.end()
+            return
         qp.save() 
         
         # The color of the outlines
@@ -270,6 +402,9 @@ class Canvas(QtGui.QWidget):
             # If we ignore this label, ski
             if (labelName in ignore):
                 continue
+
+            if (not visible(obj)):
+                continue
             
             polygon = self.getPolygon(obj)
 
@@ -298,6 +433,8 @@ class Canvas(QtGui.QWidget):
         qp.setBrush(brush)
         qp.setPen(QtCore.Qt.DashLine)
         for idx in self.highlightObjIds:
+            if (not visible(self.annotation.objects[idx])):
+                continue
             polygon = self.getPolygon(self.annotation.objects[idx])
             for poly in polygon:
                 qp.drawPolygon(poly)
@@ -305,8 +442,6 @@ class Canvas(QtGui.QWidget):
         # Restore settings
         qp.restore()
         qp.end()
-        
-        return overlay
 
     # Draw the label name next to the mouse
     def drawLabelAtMouse(self):
@@ -365,98 +500,75 @@ class Canvas(QtGui.QWidget):
         qp.restore()
         qp.end()
 
-    # Draw a arrow at given point and direction
-    # pt: arrow center point coordinate
-    # dx, dy: arrow direction, unit vector
-    # arrowLen: arrow length
-    # color: arrow edge and fill color
-    # fill: whether fill arrow or not
-    # front: whether arrow center at head or rear
-    def drawArrow(self, qp, pt, dx, dy, arrowLen, color=None, fill=True, front=True):
-        cos = 0.866
-        sin = 0.500
-        cos2 = 0.500
-        sin2 = 0.866
-        if (front):
-            x = pt.x()
-            y = pt.y()
-        else:
-            x = pt.x() + cos * arrowLen * dx
-            y = pt.y() + cos * arrowLen * dy
-
-        # calculate Point1 coordinate
-        x1 = x - arrowLen * (dx * cos + dy * -sin)
-        y1 = y - arrowLen * (dx * sin + dy * cos)
-
-        # calculate Point2 coordinate
-        x2 = x - arrowLen * (dx * cos + dy * sin)
-        y2 = y - arrowLen * (dx * -sin + dy * cos)
-
-        # calculate Point3 coordinate
-        x3 = x1 + 0.577 * arrowLen * (dx * cos2 + dy * -sin2)
-        y3 = y1 + 0.577 * arrowLen * (dx * sin2 + dy * cos2)
-
-        pt = QtCore.QPointF(x, y)
-        pt1 = QtCore.QPointF(x1, y1)
-        pt2 = QtCore.QPointF(x2, y2)
-        pt3 = QtCore.QPointF(x3, y3)
-
-        # Save setting
-        qp.save()
-        if (color):
-            col = QtGui.QColor(*color)
-            qp.setPen(col)
-            if (fill):
-                qp.setBrush(QtGui.QBrush(col, QtCore.Qt.SolidPattern))
-            else:
-                qp.setBrush(QtGui.QBrush(QtCore.Qt.NoBrush))
-
-        # Draw arrow polygon
-        poly = QtGui.QPolygonF()
-        poly.append(pt)
-        poly.append(pt1)
-        poly.append(pt3)
-        poly.append(pt2)
-        qp.drawPolygon(poly)
-
-        # Restore setting
-        qp.restore()
-
-    # Draw Occlusion boundary
-    def drawOcclusionBoundary(self, qp):
+    # Draw Occlusion boundary, only those reaching into rect if given
+    def drawOcclusionBoundary(self, qp, rect=None):
         if (self.image.isNull()):
             return
         if (not self.annotation or not self.annotation.boundaries):
             return
-        qp.save()
-        # we draw an arrow every arrowDistance pixel
-        arrowDistance = 5
         boundaries = self.getPolygon(self.annotation.boundaries)
-        for idx, boundary in enumerate(boundaries):
-            # If a polygon edge is selected, draw in bold
-            color = (255, 0, 0)
-            if (idx == self.mouseBdry):
-                color = (0, 255, 0)
-            thickPen = QtGui.QPen(QtGui.QColor(*color))
-            thickPen.setWidth(1.7)
-            qp.setPen(thickPen)
-            qp.drawPolyline(boundary)
+        arrows = self.getArrowPaths(self.annotation.boundaries)
+        shown = range(len(boundaries))
+        if (rect is not None):
+            # The arrows reach a few pixels beyond the line
+            rectF = QtCore.QRectF(rect)
+            shown = [idx for idx in shown
+                     if boundaries[idx].boundingRect().adjusted(-8, -8, 8, 8).intersects(rectF)]
+        qp.save()
+        # All in red, one path for the arrows of all boundaries if they are
+        # all shown
+        red = QtGui.QColor(255, 0, 0)
+        thickPen = QtGui.QPen(red)
+        thickPen.setWidth(1.7)
+        qp.setPen(thickPen)
+        for idx in shown:
+            qp.drawPolyline(boundaries[idx])
+        qp.setPen(red)
+        qp.setBrush(QtGui.QBrush(red, QtCore.Qt.SolidPattern))
+        if (len(shown) == len(boundaries)):
+            qp.drawPath(self.getArrowPaths(self.annotation.boundaries, merged=True))
+        else:
+            for idx in shown:
+                qp.drawPath(arrows[idx])
 
-            thickPen.setWidth(1)
+        # The boundary under the mouse in green on top
+        if (self.mouseBdry in shown):
+            green = QtGui.QColor(0, 255, 0)
+            thickPen = QtGui.QPen(green)
+            thickPen.setWidth(1.7)
             qp.setPen(thickPen)
-            for i in range(len(boundary) / arrowDistance):
-                idx = i * arrowDistance
-                pt1 = boundary[idx]
-                idx = (i + 1) * arrowDistance
-                if (idx >= len(boundary)):
-                    idx = -1
-                pt2 = boundary[idx]
-                midPt = (pt1 + pt2) / 2.0
-                unitVector = QtCore.QLineF(pt1, pt2).unitVector()
-                unitVector = unitVector.normalVector()
-                self.drawArrow(qp, midPt, unitVector.dx(), unitVector.dy(), 5, color=color, fill=True, front=False)
+            qp.drawPolyline(boundaries[self.mouseBdry])
+            qp.setPen(green)
+            qp.setBrush(QtGui.QBrush(green, QtCore.Qt.SolidPattern))
+            qp.drawPath(arrows[self.mouseBdry])
         qp.restore()
 
+    # The arrows of the boundaries as a QPainterPath per polygon, or one
+    # for all of them if merged. They are cached in the boundaries object
+    # until its polygon changes
+    def getArrowPaths(self, boundaries, merged=False):
+        paths = boundaries.geometry.get('arrows')
+        if (paths is None):
+            paths = []
+            for polygon in boundaries.polygon:
+                path = QtGui.QPainterPath()
+                # Overlapping arrows must not cancel out
+                path.setFillRule(QtCore.Qt.WindingFill)
+                for arrow in arrowPolygons(polygon.points).tolist():
+                    path.addPolygon(QtGui.QPolygonF([QtCore.QPointF(x, y) for x, y in arrow]))
+                    path.closeSubpath()
+                paths.append(path)
+            boundaries.geometry['arrows'] = paths
+        if (not merged):
+            return paths
+        if ('arrowsMerged' not in boundaries.geometry):
+            path = QtGui.QPainterPath()
+            path.setFillRule(QtCore.Qt.WindingFill)
+            for arrows in paths:
+                path.addPath(arrows)
+            boundaries.geometry['arrowsMerged'] = path
+        return boundaries.geometry['arrowsMerged']
+
     # Determine the highlighted object for drawing
     def getHighlightedObjectIds(self):
         self.highlightObjIds = []
@@ -508,19 +620,29 @@ class Canvas(QtGui.QWidget):
         if (self.curDrawType == AnnObjectType.INSTANCE):
             if (self.draggedPt[0] >= 0):
                 # Update the dragged point
-                pt = QtCore.QPointF(self.polygons[self.draggedPt[0]][self.draggedPt[1]])
-                self.polygons[self.draggedPt[0]].replace(self.draggedPt[1], self.mousePos)
-                valid = self.checkPolygonValidation(self.polygons[self.draggedPt[0]])
-                if (not valid):
-                    self.polygons[self.draggedPt[0]].replace(self.draggedPt[1], pt)
+                edges = self.getEdgeIndex(self.draggedPt[0])
+                pt = (self.mousePos.x(), self.mousePos.y())
+                if (self.draggedPolyValid):
+                    valid = edges.moveIsValid(self.draggedPt[1], pt)
                 else:
-                    self.redraw = True
+                    points = edges.points.copy()
+                    points[self.draggedPt[1]] = pt
+                    valid = polygonIsValid(points)
+                    self.draggedPolyValid = valid
+                if (valid):
+                    self.polygons[self.draggedPt[0]].replace(self.draggedPt[1], self.mousePos)
+                    edges.move(self.draggedPt[1], pt)
 
                 # If the polygon is the polygon of the selected object
                 # update the object polygon
                 if (valid and self.selObjs):
                     obj = self.annotation.objects[self.selObjs[-1]]
+                    self.markObjectDirty(obj)
                     obj.polygon[self.draggedPt[0]][self.draggedPt[1]] = Point(self.mousePos.x(), self.mousePos.y())
+                    obj.invalidateGeometry()
+                    self.markObjectDirty(obj)
+                    # Indexed once the drag ends, not on every move
+                    self.draggedObj = self.selObjs[-1]
                     self.setChanges()
 
 
@@ -562,41 +684,55 @@ class Canvas(QtGui.QWidget):
                         if (idxPoly >= 0 and closestPt[1] == closestPt[2]):
                             del self.polygons[idxPoly][closestPt[1]]
                             clearFlag = len(self.polygons[idxPoly]) == 2 or not self.polygons[idxPoly]
+                            if (clearFlag):
+                                self.clearEdgeIndexes()
+                            elif (idxPoly in self.edgeIndexes):
+                                self.edgeIndexes[idxPoly].delete(closestPt[1])
                             # If the polygon is the polygon of the selected object, update the object
                             if (self.selObjs):
                                 self.setChanges()
                                 obj = self.annotation.objects[self.selObjs[-1]]
+                                # The object only shrinks, its old area covers the change
+                                self.markObjectDirty(obj)
                                 del obj.polygon[idxPoly][closestPt[1]]
                                 if (clearFlag):
                                     del obj.polygon[idxPoly]
                                     del self.polygons[idxPoly]
+                                obj.invalidateGeometry()
                                 if (not obj.polygon):
                                     del self.annotation.objects[self.selObjs[-1]]
                                     del self.selObjs[-1]
                                     self.mouseObj = (-1, -1)
+                                    self.rebuildObjectIndex()
+                                    # The indices of the objects above changed
+                                    self.redraw = True
+                                else:
+                                    self.updateObjectIndex(self.selObjs[-1])
                             elif (clearFlag):
                                 del self.polygons[idxPoly]
 
-                            # Redraw labels
-                            self.redraw = True
-
                     elif (self.drawPoly.isEmpty()):
                         # If we got a point, we make it dragged
                         if (closestPt[1] == closestPt[2]):
                             self.draggedPt = (closestPt[0], closestPt[1])
+                            self.draggedPolyValid = self.getEdgeIndex(closestPt[0]).isValid()
                         # If we got an edge, we insert a point and make it dragged
                         else:
+                            edges = self.getEdgeIndex(closestPt[0])
                             self.polygons[closestPt[0]].insert(closestPt[2], self.mousePos)
+                            edges.insert(closestPt[2], (self.mousePos.x(), self.mousePos.y()))
                             self.draggedPt = (closestPt[0], closestPt[2])
-
-                            # Redraw labels
-                            self.redraw = True
+                            self.draggedPolyValid = edges.isValid()
 
                             # If the polygon is the polygon of the selected object, update the object
                             if (self.selObjs):
                                 self.setChanges()
                                 obj = self.annotation.objects[self.selObjs[-1]]
+                                self.markObjectDirty(obj)
                                 obj.polygon[closestPt[0]].insert(closestPt[2], Point(self.mousePos.x(), self.mousePos.y()))
+                                obj.invalidateGeometry()
+                                self.markObjectDirty(obj)
+                                self.updateObjectIndex(self.selObjs[-1])
 
             elif (self.curDrawType == AnnObjectType.OCCLUSION_BOUNDARY):
                 pass
@@ -625,7 +761,8 @@ class Canvas(QtGui.QWidget):
                     # Make the current mouse object the selected and process the selection
                     self.selectObject()
                 elif (self.draggedPt[0] >= 0):
-                    self.draggedPt = (-1, -1)
+                    self.stopDragging()
+                    self.updateMouseObject()
                 else:
                     # If the mouse would close the poly make sure to do so
                     if (self.ptClosesPoly()):
@@ -637,15 +774,13 @@ class Canvas(QtGui.QWidget):
                             self.addPtToPoly(self.mousePos)
 
             elif (self.curDrawType == AnnObjectType.OCCLUSION_BOUNDARY):
-                boundaries = self.getPolygon(self.annotation.boundaries)
-                for idx, boundary in enumerate(boundaries):
-                    # Get the ID of the closest point to the mouse
-                    closestPt = self.getClosestPoint(boundary, self.mousePos, polygonClosed=False)
-                    if (closestPt[0] != -1):
-                        self.redraw = True
-                        self.annotation.boundaries.polygon[idx].reverse()
-                        self.setChanges()
-                        break
+                # Reverse the boundary the mouse is on
+                idx = self.getBoundaryAt(self.mousePos)
+                if (idx >= 0):
+                    self.markBoundaryDirty(idx)
+                    self.annotation.boundaries.polygon[idx].reverse()
+                    self.annotation.boundaries.invalidateGeometry()
+                    self.setChanges()
 
         # Quickly delete the last added point of current polygon
         elif (event.button() == QtCore.Qt.RightButton):
@@ -666,7 +801,9 @@ class Canvas(QtGui.QWidget):
             self.mouseObj = (-1, -1)
             if (not self.annotation or not self.annotation.objects or not self.mousePos):
                 return 
-            for idx in reversed(range(len(self.annotation.objects))):
+            # Only the objects whose bounding box contains the mouse, topmost first
+            candidates = self.objectIndex.query(self.mousePos.x(), self.mousePos.y())
+            for idx in sorted(candidates, reverse=True):
                 obj = self.annotation.objects[idx]
                 if (obj.draw):
                     polygons = self.getPolygon(obj)
@@ -678,23 +815,17 @@ class Canvas(QtGui.QWidget):
                             break
                     if (found):
                         break
-            if (self.mouseObj != oldMouseObj):
-                self.redraw = True
+            # A changed highlight is drawn again by markHighlightChanges
 
         elif (self.curDrawType == AnnObjectType.OCCLUSION_BOUNDARY):
             oldMouseBdry = self.mouseBdry
             self.mouseBdry = -1
             if (not self.annotation or not self.annotation.boundaries or not self.mousePos):
                 return
-            boundaries = self.getPolygon(self.annotation.boundaries)
-            for idx, boundary in enumerate(boundaries):
-                # Get the ID of the closest point to the mouse
-                closestPt = self.getClosestPoint(boundary, self.mousePos, polygonClosed=False)
-                if (closestPt[0] != -1):
-                    self.mouseBdry = idx
-                    break
+            self.mouseBdry = self.getBoundaryAt(self.mousePos)
             if (self.mouseBdry != oldMouseBdry):
-                self.redraw = True
+                self.markBoundaryDirty(oldMouseBdry)
+                self.markBoundaryDirty(self.mouseBdry)
 
     def keyPressEvent(self, event):
         key = event.key()
@@ -716,8 +847,8 @@ class Canvas(QtGui.QWidget):
                 self.closePolygon()
                 self.update()
         elif (key == QtCore.Qt.Key_0):
+            # The labels are only hidden at paint time by drawLayers
             self.transpTempZero = True
-            self.redraw = True
             self.update()
 
     def keyReleaseEvent(self, event):
@@ -729,7 +860,6 @@ class Canvas(QtGui.QWidget):
             self.draggingCanvas = False
         elif (key == QtCore.Qt.Key_0):
             self.transpTempZero = False
-            self.redraw = True
             self.update()
 
     def offsetToCenter(self):
@@ -745,6 +875,12 @@ class Canvas(QtGui.QWidget):
     def transformPos(self, point):
         return point / self.zoomFactor - self.offsetToCenter() 
 
+    # The image rect shown in the widget rect, as QRectF
+    def widgetToImageRect(self, rect):
+        rect = QtCore.QRectF(rect)
+        return QtCore.QRectF(self.transformPos(rect.topLeft()),
+                             QtCore.QSizeF(rect.width() / self.zoomFactor, rect.height() / self.zoomFactor))
+
 
     def ptClosesPoly(self):
         if (self.drawPoly.isEmpty()):
@@ -752,57 +888,38 @@ class Canvas(QtGui.QWidget):
         closestPt = self.getClosestPoint(self.drawPoly, self.mousePos, False)
         return closestPt == (0, 0)
 
-    # Get distance between tow points
-    def ptDist(self, pt1, pt2):
-        # A line between both
-        line = QtCore.QLineF(pt1, pt2)
-        # Length
-        return line.length()
-
     # Get the point/edge index within the given polygon that is close to the given point
     # Returns (-1, -1) if none is close enough
     # Returns (i, i) if the point with index i is closed
     # Returns (i, i+1) if the edge from points i to i+1 is closest
+    # The polygon is a QPolygonF or an (N, 2) array of its points
     def getClosestPoint(self, poly, pt, polygonClosed = True):
-        closest = (-1, -1)
-        if (not poly or not pt):
-            return closest
-        distTh    = 4.0
-        dist      = 1e9 # should be enough
-        for i in range(poly.size()):
-            curDist = self.ptDist(poly[i], pt)
-            if curDist < dist:
-                closest = (i, i)
-                dist = curDist
-        # Close enough?
-        if (dist <= distTh):
-            return closest
-
-        # Otherwise see if the polygon is closed, but a line is close enough
-        if (polygonClosed and poly.size() >= 2):
-            for i in range(poly.size()):
-                pt1 = poly[i]
-                j = i+1
-                if (j == poly.size()):
-                    j = 0
-                pt2 = poly[j]
-                edge = QtCore.QLineF(pt1, pt2)
-                normal = edge.normalVector()
-                normalThroughMouse = QtCore.QLineF(pt.x(), pt.y(), pt.x() + normal.dx(), pt.y() + normal.dy())
-                intersectionPt = QtCore.QPointF()
-                intersectionType = edge.intersect(normalThroughMouse, intersectionPt)
-                if (intersectionType == QtCore.QLineF.BoundedIntersection):
-                    curDist = self.ptDist(intersectionPt, pt)
-                    if (curDist < dist):
-                        closest = (i, j)
-                        dist = curDist
-
-        # Close enough?
-        if (dist <= distTh):
-            return closest
-
-        # If we didnt return yet, we didn't find anything
-        return (-1, -1)
+        if (not isinstance(poly, np.ndarray)):
+            poly = self.polygonToArray(poly)
+        if (not len(poly) or not pt):
+            return (-1, -1)
+        return closestPoint(poly, (pt.x(), pt.y()), polygonClosed, threshold=4.0)
+
+    # The map to find the boundary under the mouse, made for the
+    # boundaries of the annotation when the mouse first moves over them.
+    # Reversing a boundary keeps it valid
+    def getBoundaryMap(self):
+        boundaries = self.annotation.boundaries if self.annotation else None
+        if (not boundaries):
+            self.boundaryMapSource = None
+            self.boundaryMap = None
+        elif (self.boundaryMapSource is not boundaries):
+            self.boundaryMapSource = boundaries
+            self.boundaryMap = BoundaryMap([ring.points for ring in boundaries.polygon], threshold=4.0)
+        return self.boundaryMap
+
+    # The index of the first boundary passing within 4 pixels of pt.
+    # Returns -1 if none is close enough
+    def getBoundaryAt(self, pt):
+        boundaryMap = self.getBoundaryMap()
+        if (boundaryMap is None or not pt):
+            return -1
+        return boundaryMap.lookup(pt.x(), pt.y())
 
     # Get the first polygon index and the point/edge index within the given polygons that is close to the given point
     # Return (-1, -1, -1) if none is close enough
@@ -810,6 +927,9 @@ class Canvas(QtGui.QWidget):
     # Return (k, i, i+1) if the edge from points i to i+1 of the kth polygon is closest
     def getClosestPointFromPolygons(self, polygons, pt):
         for idx, poly in enumerate(polygons):
+            # The edited polygons have their points at hand
+            if (polygons is self.polygons and idx in self.edgeIndexes):
+                poly = self.edgeIndexes[idx].points
             closestPt = self.getClosestPoint(poly, pt)
             if (closestPt != (-1, -1)):
                 return (idx, closestPt[0], closestPt[1])
@@ -823,71 +943,36 @@ class Canvas(QtGui.QWidget):
         canClose = self.checkPolygonValidation(self.drawPoly)
         return canClose
 
-    # Check if two lines intersect with each other
-    def checkLineIntersect(self, line1, line2):
-        intersectionPt = QtCore.QPointF()
-        intersectionType = line1.intersect(line2, intersectionPt)
-        # The two lines intersect with each other within the start and end points of each line
-        if (intersectionType == QtCore.QLineF.BoundedIntersection):
-            return True
-
-        # Otherwise
-        return False
-        
-    # If two lines are parallel and have reverse direction, we regard as intersection
-    def checkLineReverseParallel(self, line1, line2):
-        intersectionPt = QtCore.QPointF()
-        intersectionType = line1.intersect(line2, intersectionPt)
-        # If two lines are parallel and have reverse direction, we regard as intersection
-        if (intersectionType == QtCore.QLineF.NoIntersection and 
-            line1.dx() * line2.dx() + line1.dy() * line2.dy() < 0):
-            return True
-
-        # Otherwise
-        return False
-
     # Check if valid polygon
+    # The edge pairs are tested with geometry.lineIntersection and
+    # geometry.reverseParallel, but only those that can intersect
     def checkPolygonValidation(self, poly, polygonClosed = True, mousePos = None):
         # Cannot do with points less than 2 
         if (not polygonClosed and len(poly) < 2):
             return True
 
+        points = self.polygonToArray(poly)
         # When user is drawing the polygon
         if (not polygonClosed and mousePos):
-            # Get current draw line
-            testLine = QtCore.QLineF(poly[-1], mousePos)
-            line = QtCore.QLineF(poly[-2], poly[-1])
-            if (self.checkLineReverseParallel(line, testLine)):
-                return False
-
-            for i in range(poly.size()-2):
-                pt1 = poly[i]
-                pt2 = poly[i+1]
-                # Construct a line and do the intersection operation
-                line = QtCore.QLineF(pt1, pt2)
-                if (self.checkLineIntersect(line, testLine)):
-                    return False
+            return polylineCanExtend(points, (mousePos.x(), mousePos.y()))
 
         # When user is editing the polygon
-        else:
-            for i in range(poly.size()-1):
-                pt1 = poly[i]
-                pt2 = poly[i+1]
-                line1 = QtCore.QLineF(pt1, pt2)
-                for j in range(i+1, poly.size()):
-                    pt3 = poly[j]
-                    k = j + 1
-                    if (k == poly.size()):
-                        k = 0
-                    pt4 = poly[k]
-                    line2 = QtCore.QLineF(pt3, pt4)
-                    if (j == i+1 or (k == 0 and i == 0)):
-                        if (self.checkLineReverseParallel(line1, line2)):
-                            return False
-                    elif (self.checkLineIntersect(line1, line2)):
-                        return False
-        # Otherwise
-        return True
+        return polygonIsValid(points)
+
+    # The points of a QPolygonF as an (N, 2) array
+    def polygonToArray(self, poly):
+        return np.array([(p.x(), p.y()) for p in poly], np.float64).reshape(-1, 2)
+
+    # The edge index of self.polygons[idx], it has to be updated with every
+    # change of the polygon
+    def getEdgeIndex(self, idx):
+        if (idx not in self.edgeIndexes):
+            self.edgeIndexes[idx] = EdgeIndex(self.polygonToArray(self.polygons[idx]))
+        return self.edgeIndexes[idx]
+
+    # Drop the edge indexes when self.polygons is replaced or reordered
+    def clearEdgeIndexes(self):
+        self.edgeIndexes = {}
 
 	# We just closed the polygon and need to deal with this situation
     def closePolygon(self):
@@ -898,7 +983,10 @@ class Canvas(QtGui.QWidget):
         # Update the selected object
         if (self.selObjs):
             obj = self.annotation.objects[self.selObjs[-1]]
-            obj.polygon.append([Point(p.x(), p.y()) for p in poly])
+            obj.polygon.append(PolygonRing([(p.x(), p.y()) for p in poly]))
+            obj.invalidateGeometry()
+            self.markObjectDirty(obj)
+            self.updateObjectIndex(self.selObjs[-1])
 
         # When edit an object, we prohibit to new an object
         if (not self.selObjs):
@@ -913,21 +1001,62 @@ class Canvas(QtGui.QWidget):
     def addPtToPoly(self, pt):
         self.drawPoly.append(pt)
 
-    # Return a copy polygon form annotated object
+    # Return the polygons of an annotated object. They are cached in the
+    # object until its polygon changes, so do not modify them
     def getPolygon(self, obj):
-        polygons = []
-        for polygon in obj.polygon:
-            poly = QtGui.QPolygonF()
-            for pt in polygon:
-                point = QtCore.QPointF(pt.x, pt.y)
-                poly.append(point)
-            polygons.append(poly)
+        polygons = obj.geometry.get('polygons')
+        if (polygons is None):
+            polygons = []
+            for polygon in obj.polygon:
+                poly = QtGui.QPolygonF()
+                for x, y in polygon.points.tolist():
+                    poly.append(QtCore.QPointF(x, y))
+                polygons.append(poly)
+            obj.geometry['polygons'] = polygons
         return polygons
 
+    # Return a copy polygon form annotated object
+    def copyPolygon(self, obj):
+        return [QtGui.QPolygonF(poly) for poly in self.getPolygon(obj)]
+
+    # Bounding box of all polygons of an object, None if it has no points
+    def getObjectBox(self, obj):
+        if ('box' not in obj.geometry):
+            points = [polygon.points for polygon in obj.polygon if len(polygon)]
+            box = None
+            if (points):
+                points = np.concatenate(points)
+                (xmin, ymin), (xmax, ymax) = points.min(axis=0).tolist(), points.max(axis=0).tolist()
+                box = (xmin, ymin, xmax, ymax)
+            obj.geometry['box'] = box
+        return obj.geometry['box']
+
+    # Update the bounding box of the object at idx in the object index
+    def updateObjectIndex(self, idx):
+        self.objectIndex.update(idx, self.getObjectBox(self.annotation.objects[idx]))
+
+    # Stop dragging a point and index the box of the dragged object
+    def stopDragging(self):
+        self.draggedPt = (-1, -1)
+        if (self.draggedObj >= 0 and self.annotation and
+            self.draggedObj < len(self.annotation.objects)):
+            self.updateObjectIndex(self.draggedObj)
+        self.draggedObj = -1
+
+    # Index the bounding boxes of all objects again
+    def rebuildObjectIndex(self):
+        self.objectIndex.clear()
+        self.draggedObj = -1
+        if (not self.annotation):
+            return
+        for idx in range(len(self.annotation.objects)):
+            self.updateObjectIndex(idx)
+
     # Clear the drawn polygon
     def clearPolygon(self):
         # We do not clear, since the drawPoly might be a reference on an object one
         self.polygons = list()
+        self.clearEdgeIndexes()
         self.drawPoly = QtGui.QPolygonF()
 
         for act in self.actClosedPoly:
@@ -952,7 +1081,8 @@ class Canvas(QtGui.QWidget):
         # The seleted object that is used for init
         obj = self.annotation.objects[self.selObjs[-1]]
         # Make a copy to the polygon
-        self.polygons = self.getPolygon(obj)
+        self.polygons = self.copyPolygon(obj)
+        self.clearEdgeIndexes()
 
         # Enable actions that need a closed polygon
         for act in self.actClosedPoly:
@@ -992,11 +1122,15 @@ class Canvas(QtGui.QWidget):
             return
         
         self.polygons = self.mergePolygonsHelper(self.polygons)
+        self.clearEdgeIndexes()
 
         if (self.selObjs):
             obj = self.annotation.objects[self.selObjs[-1]]
-            polygons = self.mergePolygonsHelper(self.getPolygon(obj))
+            self.markObjectDirty(obj)
+            polygons = self.mergePolygonsHelper(self.copyPolygon(obj))
             obj.polygon = [[Point(p.x(), p.y()) for p in poly] for poly in polygons]
+            self.markObjectDirty(obj)
+            self.updateObjectIndex(self.selObjs[-1])
 
 
 
@@ -1018,7 +1152,7 @@ class Canvas(QtGui.QWidget):
         for act in self.actSelObj:
             act.setEnabled(True)
 
-        self.draggedPt = (-1, -1)
+        self.stopDragging()
 
     # Deselect object
     def deselectObject(self):
@@ -1053,9 +1187,13 @@ class Canvas(QtGui.QWidget):
     # Clear the current labels
     def clearAnnotation(self):
         self.annotation = None
+        self.boundaryMapSource = None
+        self.boundaryMap = None
+        self.redraw = True
         self.clearPolygon()
         self.clearChanges()
         self.deselectAllObjects()
+        self.rebuildObjectIndex()
 
     # Setting changes
     def setChanges(self):
@@ -1071,28 +1209,34 @@ class Canvas(QtGui.QWidget):
         for act in self.actChanges:
             act.setEnabled(False)
 
-    # Load an image 
-    def loadImage(self, filename):
+    # Load an image, image is the already decoded QImage of filename if any
+    def loadImage(self, filename, image=None):
         success = True
         self.deselectAllObjects()
         self.clearPolygon()
-        self.image = QtGui.QImage(filename)
+        self.image = image if image is not None else QtGui.QImage(filename)
         if (self.image.isNull()):
             success = False
         # redraw cache image
         self.redraw = True
         return success
         
-    # Load the labels from json file
-    def loadLabels(self, filename):
+    # Load the labels from json file, annotation is the already
+    # parsed content of filename if any
+    def loadLabels(self, filename, annotation=None):
         self.clearAnnotation()
 
         try:
-            self.annotation = Annotation()
-            self.annotation.fromJsonFile(filename)
+            if (annotation is not None):
+                self.annotation = annotation
+            else:
+                self.annotation = Annotation()
+                # Prefer the binary sidecar if it is up to date
+                readLabels(filename, self.annotation)
         except StandardError  as e:
             message = "Error parsing labels in {0}".format(filename)
             self.showMessage.emit(message)
+        self.rebuildObjectIndex()
         self.updateMouseObject()
         if (self.curDrawType == AnnObjectType.OCCLUSION_BOUNDARY and 
             self.annotation and self.annotation.objects and
@@ -1123,13 +1267,19 @@ class Canvas(QtGui.QWidget):
             self.annotation.imgWidth = self.image.width()
             self.annotation.imgHeight = self.image.height()
 
-            # save to json file
-            try:
-                self.annotation.toJsonFile(filename)
+            # save to json file, keeping an existing binary sidecar up to date
+            if (self.labelSaver is not None):
+                # Written on the saver thread, which reports when done
+                self.labelSaver.save(filename, self.annotation.copy(), self.saveOptions)
                 saved = True
-                message += "Saved labels to {0}".format(filename)
-            except IOError as e:
-                message += "Error writting labels to {0}. Message: {1}".format(filename, e.strerror)
+                message += "Saving labels to {0}".format(filename)
+            else:
+                try:
+                    writeLabels(filename, self.annotation, **self.saveOptions)
+                    saved = True
+                    message += "Saved labels to {0}".format(filename)
+                except (IOError, OSError) as e:
+                    message += "Error writting labels to {0}. Message: {1}".format(filename, e.strerror)
             if (saved):
                 self.clearChanges()
         else:
@@ -1152,9 +1302,11 @@ class Canvas(QtGui.QWidget):
             self.convertThread.quit()
             self.convertThread.wait()
         self.convertThread = QtCore.QThread()
-        self.worker = ConvertToBoundariesWorker(self.annotation.objects, height, width)
+        self.worker = ConvertToBoundariesWorker(self.annotation.objects, height, width,
+                                                self.simplifyTolerance)
         self.worker.finishedSignal.connect( 
             self.boundariesConversionCompleted)
+        self.worker.statsSignal.connect(self.boundariesConversionStats)
         self.worker.moveToThread(self.convertThread)
         self.convertThread.started.connect(self.worker.convertToBoundaries)
         self.busyWaiting.emit(True)
@@ -1181,6 +1333,14 @@ class Canvas(QtGui.QWidget):
 
         self.redraw = True
 
+    # Show how long each stage of the boundaries conversion took
+    def boundariesConversionStats(self, timer):
+        message = 'Converted to boundaries. {0}'.format(timer.summary())
+        points, kept = simplifyCounts(timer.toDict())
+        if (points):
+            message += '. {0}'.format(simplifySummary(points, kept))
+        self.showMessage.emit(message)
+
     # Create a new object from the current polygons
     def newObject(self):
         if (len(self.selObjs) > 0):
@@ -1194,9 +1354,6 @@ class Canvas(QtGui.QWidget):
             # Append and create the new object
             self.appendObject(label, self.polygons)
 
-        # Redraw labels
-        self.redraw = True
-
         # Redraw
         self.update()
 
@@ -1223,6 +1380,8 @@ class Canvas(QtGui.QWidget):
         obj.updateDate()
         obj.color = ((np.random.random((1, 3)))*255).astype(np.int32).tolist()[0]
         self.annotation.objects.append(obj)
+        self.updateObjectIndex(len(self.annotation.objects) - 1)
+        self.markObjectDirty(obj)
 
         # Clear the drawn polygon
         self.clearPolygon()
@@ -1252,6 +1411,9 @@ class Canvas(QtGui.QWidget):
             del self.annotation.objects[idx]
 
         self.deselectAllObjects()
+        self.rebuildObjectIndex()
+        # The indices of the objects above changed
+        self.redraw = True
 
         # setting change flag
         self.setChanges()
@@ -1307,6 +1469,10 @@ class Canvas(QtGui.QWidget):
 
         # Update the selected object to the new index
         self.selObjs[-1] = newidx
+        self.updateObjectIndex(oldidx)
+        self.updateObjectIndex(newidx)
+        self.markObjectDirty(self.annotation.objects[oldidx])
+        self.markObjectDirty(self.annotation.objects[newidx])
         
         self.showMessage.emit('Move object {0} with label {1} to layer {2}'.format(obj.id, obj.label, newidx))
 
@@ -1325,15 +1491,13 @@ class Canvas(QtGui.QWidget):
 	# Increase label transparency
     def minus(self):
         self.transp = max(self.transp - 0.1, 0.0)
-        # Redraw labels
-        self.redraw = True
+        # The transparency is applied when drawing, the labels stay cached
         self.update()
 
     # Decrease label transparency
     def plus(self):
         self.transp = min(self.transp + 0.1, 1.0)
-        # Redraw labels
-        self.redraw = True
+        # The transparency is applied when drawing, the labels stay cached
         self.update()
 
 
@@ -0,0 +1,494 @@
+"""
+Convert instance labels to occlusion boundary labels without a GUI.
+
+Usage: python -m lib.convert imagelist.json [--jobs N]
+                                            [--overwrite | --skip-existing]
+                                            [--compact] [--precision P]
+                                            [--simplify TOLERANCE]
+
+Copyright (c) 2018- Guoxia Wang
+mingzilaochongtu at gmail com
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+The Software is provided "as is", without warranty of any kind.
+
+"""
+import numpy as np
+import cv2
+import os
+import sys
+import json
+import getpass
+import logging
+import signal
+import argparse
+import multiprocessing
+
+from edgelink import edgelink
+from geometry import simplifyPolylines
+from stagetimer import StageTimer
+from sidecar import writeLabels
+
+from annotation import PolygonRing, Annotation, AnnBoundary
+
+logger = logging.getLogger(__name__)
+
+# Status of a converted label file
+CONVERTED = 'converted'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+# Skipped because it has occlusion boundary labels and overwrite is off
+EXISTS = 'exists'
+
+# Pixels kept around the objects when cropping the segment map, more than
+# the reach of the closing, thinning and direction check near an edge
+CROP_MARGIN = 8
+
+class BoundariesConverter(object):
+    """
+    Convert the instance polygons of one image to occlusion boundaries.
+    It has no Qt dependency, ConvertToBoundariesWorker wraps it for the GUI.
+    Only the bounding box of the objects, grown by CROP_MARGIN and clipped
+    to the image, is rasterized and processed. segmentMap holds that crop
+    and offset is the (x, y) of its top left corner in the image. With a
+    tolerance in pixels the boundaries are simplified, 0 keeps a point
+    per boundary pixel.
+    """
+    def __init__(self, objects=None, height=0, width=0, tolerance=0.0):
+        self.objects = objects
+        self.tolerance = tolerance
+        self.setSegmentMap(height, width)
+
+    def setObjects(self, objects):
+        self.objects = objects
+
+    def setSegmentMap(self, height, width):
+        self.height = height
+        self.width = width
+        # Allocated by rasterize for the crop of the objects
+        self.offset = (0, 0)
+        self.segmentMap = np.zeros((0, 0), np.uint8)
+
+    # Rounded polygons of all objects, a list of point arrays per object
+    def objectPolygons(self):
+        polygons = []
+        for obj in self.objects:
+            polygons.append([np.around(poly.points).astype(np.int32) for poly in obj.polygon])
+        return polygons
+
+    # Union bounding box (x0, y0, x1, y1) of the polygons grown by margin
+    # and clipped to the image, x1 and y1 are exclusive
+    def cropBox(self, polygons, margin=CROP_MARGIN):
+        pts = [pts for polys in polygons for pts in polys if len(pts)]
+        if (not pts):
+            return (0, 0, 0, 0)
+        pts = np.concatenate(pts)
+        x0, y0 = np.maximum(pts.min(axis=0) - margin, 0)
+        x1 = min(pts[:, 0].max() + margin + 1, self.width)
+        y1 = min(pts[:, 1].max() + margin + 1, self.height)
+        return (int(x0), int(y0), max(int(x1), int(x0)), max(int(y1), int(y0)))
+
+    # Fill the polygons of all objects to the segment map,
+    # the k-th object is labeled k
+    def rasterize(self):
+        polygons = self.objectPolygons()
+        x0, y0, x1, y1 = self.cropBox(polygons)
+        self.offset = (x0, y0)
+        self.segmentMap = np.zeros((y1 - y0, x1 - x0), np.uint8)
+        count = 1
+        for polys in polygons:
+            for pts in polys:
+                if (len(pts)):
+                    cv2.fillPoly(self.segmentMap, [pts], count, offset=(-x0, -y0))
+            count += 1
+        return self.segmentMap
+
+    # Segment map convert to boundary list. Pass a StageTimer to record
+    # the duration and pixel/edge counts of each stage
+    def convertToBoundaries(self, timer=None):
+        if (timer is None):
+            timer = StageTimer()
+
+        # First, we fill all labels to numpy ndarray
+        with timer.stage('rasterize') as stats:
+            self.rasterize()
+            stats['objects'] = len(self.objects)
+            stats['pixels'] = int(np.count_nonzero(self.segmentMap))
+            stats['bytes'] = self.segmentMap.nbytes
+        if (not self.segmentMap.size):
+            return []
+
+        # Second, we convert to boundary map from segment map
+        with timer.stage('boundaryMap') as stats:
+            edgeMap = self.segmentationMapToBoundaryMap(self.segmentMap)
+            stats['pixels'] = int(np.count_nonzero(edgeMap))
+            stats['bytes'] = edgeMap.nbytes
+        # Third, we get edge fragments
+        edgelist, edgeim, etype = edgelink(edgeMap, timer=timer)
+        edgelist = [edge for edge in edgelist if len(edge) >= 5]
+        # Auto correct occlusion boundary direction
+        with timer.stage('direction') as stats:
+            needReverse = self.edgesNeedReverse(edgelist)
+            polylines = []
+            for edge, reverse in zip(edgelist, needReverse):
+                if (reverse):
+                    edge.reverse()
+                # Convert to polygon points (x, y) in image coordinates
+                polylines.append(np.asarray(edge)[:, ::-1] + self.offset)
+            stats['edges'] = len(polylines)
+            stats['reversed'] = int(np.count_nonzero(needReverse))
+        # Last, drop the points the boundaries do not need, after the
+        # direction check that samples the pixels along them
+        if (self.tolerance > 0):
+            with timer.stage('simplify') as stats:
+                stats['points'] = sum(len(points) for points in polylines)
+                polylines = simplifyPolylines(polylines, self.tolerance)
+                stats['kept'] = sum(len(points) for points in polylines)
+        return [PolygonRing(points) for points in polylines]
+
+    # Label segmentation map to boundary map. A pixel is on the boundary
+    # if a label changes between it and its right or lower neighbour, or
+    # between its lower neighbour and the one right of that, or between
+    # its right neighbour and the one below. The last row and column only
+    # look at their own row or column, and the bottom right pixel is 0
+    def segmentationMapToBoundaryMap(self, segment):
+        height, width = segment.shape
+        boundary = np.zeros((height, width), np.uint8)
+        if (not segment.size):
+            return boundary
+        inner = boundary[:-1, :-1]
+
+        # Find horizontal direction difference
+        edgelsH = segment[:, :-1] != segment[:, 1:]
+        inner[...] = edgelsH[:-1]
+        inner |= edgelsH[1:]
+        boundary[-1, :-1] = edgelsH[-1]
+        del edgelsH
+
+        # Find vertical direction difference
+        edgelsV = segment[:-1, :] != segment[1:, :]
+        inner |= edgelsV[:, :-1]
+        inner |= edgelsV[:, 1:]
+        boundary[:-1, -1] = edgelsV[:, -1]
+        return boundary
+
+    # Same as segmentationMapToBoundaryMap, through a boundary map of twice
+    # the resolution with the edgels between the pixels. Kept as reference
+    def segmentationMapToBoundaryMapFull(self, segment):
+        height, width = segment.shape
+        boundary = np.zeros((2*height+1, 2*width+1), np.uint8)
+        # Find vertical direction difference
+        edgelsV = (segment[0:-1, :] != segment[1:, :]).astype(np.uint8)
+        # Add a zero row
+        edgelsV = np.vstack([edgelsV, np.zeros((1, width), dtype=np.uint8)])
+        # Find horizontal direction difference
+        edgelsH = (segment[:,0:-1] != segment[:, 1:]).astype(np.uint8)
+        # Append a zero column
+        edgelsH = np.hstack([edgelsH, np.zeros((height, 1), dtype=np.uint8)])
+
+        # Assign to boundary
+        boundary[2::2, 1::2] = edgelsV
+        boundary[1::2, 2::2] = edgelsH
+
+        # Get boundary
+        boundary[2:-1:2, 2:-1:2] = np.maximum(
+            np.maximum(edgelsH[0:-1, 0:-1], edgelsH[1:, 0:-1]),
+            np.maximum(edgelsV[0:-1, 0:-1], edgelsV[0:-1, 1:]))
+
+        boundary[0, :] = boundary[1, :]
+        boundary[:, 0] = boundary[:, 1]
+        boundary[-1, :] = boundary[-2, :]
+        boundary[:, -1] = boundary[:, -2]
+
+        boundary = boundary[2::2, 2::2]
+        return boundary
+
+    # Check one edge occluison direction, and return true if need reverse
+    def isNeedReverse(self, edge):
+        height, width = self.segmentMap.shape
+
+        step = 3
+        posDirCount = 0
+        totalCount = len(edge) // step
+        for i in range(totalCount):
+            idx = i * step
+            x1, y1 = edge[idx][1], edge[idx][0]
+            idx = (i + 1) * step
+            if (idx >= len(edge)):
+                idx = -1
+            x2, y2 = edge[idx][1], edge[idx][0]
+
+            # The two points on the normal of the segment, one on each side
+            dx = x2 - x1
+            dy = y2 - y1
+            x3 = min(max(x1 + dy, 0), width-1)
+            y3 = min(max(y1 - dx, 0), height-1)
+            x4 = min(max(x1 - dy, 0), width-1)
+            y4 = min(max(y1 + dx, 0), height-1)
+
+            if (self.segmentMap[int(y3), int(x3)] >=
+                self.segmentMap[int(y4), int(x4)]):
+                posDirCount += 1
+        ratio = float(posDirCount) / np.ceil(float(totalCount))
+        # If ratio greater than the threshold, we dont need to reverse the edge
+        if (ratio > 0.3):
+            return False
+        else:
+            return True
+
+    # Check the occlusion direction of all edges at once, same as calling
+    # isNeedReverse on each edge. Returns a boolean array, one per edge
+    def edgesNeedReverse(self, edges):
+        height, width = self.segmentMap.shape
+        if (not len(edges)):
+            return np.zeros(0, np.bool)
+
+        step = 3
+        # All edges as one (row, col) array, each edge starts at starts[k]
+        lengths = np.array([len(edge) for edge in edges], np.int64)
+        starts = np.cumsum(lengths) - lengths
+        points = np.concatenate([np.reshape(edge, (-1, 2)) for edge in edges])
+
+        # Sample i of edge k goes from point i * step to point (i + 1) * step,
+        # or to the last point if that is past the end
+        totalCounts = lengths // step
+        edgeIds = np.repeat(np.arange(len(edges)), totalCounts)
+        i = np.arange(totalCounts.sum()) - np.repeat(np.cumsum(totalCounts) - totalCounts, totalCounts)
+        idx1 = i * step
+        idx2 = np.minimum((i + 1) * step, lengths[edgeIds] - 1)
+        y1, x1 = points[starts[edgeIds] + idx1].T
+        y2, x2 = points[starts[edgeIds] + idx2].T
+
+        # The two points on the normal of each segment, one on each side
+        dx = x2 - x1
+        dy = y2 - y1
+        x3 = np.clip(x1 + dy, 0, width-1).astype(np.intp)
+        y3 = np.clip(y1 - dx, 0, height-1).astype(np.intp)
+        x4 = np.clip(x1 - dy, 0, width-1).astype(np.intp)
+        y4 = np.clip(y1 + dx, 0, height-1).astype(np.intp)
+
+        posDir = self.segmentMap[y3, x3] >= self.segmentMap[y4, x4]
+        posDirCounts = np.bincount(edgeIds, weights=posDir, minlength=len(edges))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = posDirCounts / np.ceil(totalCounts.astype(np.float64))
+        # If ratio greater than the threshold, we dont need to reverse the edge
+        return np.logical_not(ratio > 0.3)
+
+# Create a new occlusion boundary label from a converted polygon list
+def newBoundaries(polygon):
+    boundaries = AnnBoundary()
+    boundaries.polygon = polygon
+    boundaries.deleted = 0
+    boundaries.verified = 0
+    boundaries.user = getpass.getuser()
+    boundaries.updateDate()
+    return boundaries
+
+# Write the conversion statistics of a label file as one json log line
+def logStats(filename, stats):
+    if (stats):
+        logger.info("Stats %s", json.dumps(dict(stats, file=filename), sort_keys=True))
+
+# The (points, kept) counts of the simplify stage in StageTimer.toDict()
+# stats, (0, 0) if the boundaries were not simplified
+def simplifyCounts(stats):
+    for stage in (stats or {}).get('stages', []):
+        if (stage['name'] == 'simplify'):
+            return (stage['points'], stage['kept'])
+    return (0, 0)
+
+# One line on how many boundary points simplification kept
+def simplifySummary(points, kept):
+    return "Simplified boundaries kept {0} of {1} points ({2:.0f}%)".format(
+        kept, points, 100.0 * kept / points if points else 100.0)
+
+# Convert the instance labels of an annotation to occlusion boundaries
+# and write the result to filename. saveOptions are keyword arguments of
+# Annotation.toJsonFile, tolerance simplifies the boundaries. The file is
+# replaced only once it is fully written, and an existing sidecar is
+# updated. Returns an error message or None
+def convertAnnotation(annotation, filename, timer=None, saveOptions=None, tolerance=0.0):
+    converter = BoundariesConverter(tolerance=tolerance)
+    converter.setObjects(annotation.objects)
+    converter.setSegmentMap(annotation.imgHeight, annotation.imgWidth)
+    polygon = converter.convertToBoundaries(timer)
+    annotation.boundaries = newBoundaries(polygon)
+    try:
+        writeLabels(filename, annotation, **(saveOptions or {}))
+    except StandardError as e:
+        return "Error writting labels to {0}".format(filename)
+    return None
+
+def convertAnnotationFile(task):
+    """
+    Process pool job: load one label file, convert its instance labels
+    to occlusion boundaries and write them back. It is defined at module
+    level so that it can be pickled, and it only takes and returns plain
+    values.
+
+    task is (idx, filename, overwrite, saveOptions, tolerance). Files that
+    already have boundary labels are skipped with status EXISTS unless
+    overwrite is set, files without instance labels with SKIPPED. Returns (idx, filename, status, message, stats), stats
+    is StageTimer.toDict() of the conversion or None if nothing was
+    converted.
+    """
+    idx, filename, overwrite, saveOptions, tolerance = task
+    try:
+        annotation = Annotation()
+        annotation.fromJsonFile(filename)
+    except StandardError as e:
+        return (idx, filename, FAILED, "Error parsing labels in {0}".format(filename), None)
+
+    if (not annotation.objects):
+        return (idx, filename, SKIPPED, "No instance labels", None)
+    if (annotation.boundaries and not overwrite):
+        return (idx, filename, EXISTS, "Occlusion boundary labels exist", None)
+
+    timer = StageTimer()
+    error = convertAnnotation(annotation, filename, timer, saveOptions, tolerance)
+    if (error):
+        return (idx, filename, FAILED, error, timer.toDict())
+    return (idx, filename, CONVERTED, "", timer.toDict())
+
+# Get the label file names of an image list file
+def labelFilenames(imageListFile, gtExt):
+    imageDir = os.path.dirname(os.path.abspath(imageListFile))
+    with open(imageListFile, 'r') as f:
+        imageList = json.loads(f.read())
+    if (not isinstance(imageList, list)):
+        raise ValueError("Invalid image list, please check json format")
+
+    filenames = []
+    for filename in imageList:
+        imageExt = os.path.splitext(filename)[1]
+        gtfilename = filename.replace(imageExt, gtExt)
+        filenames.append(os.path.normpath(os.path.join(imageDir, gtfilename)))
+    return filenames
+
+# Process pool initializer. Ctrl+C only stops the parent, which lets the
+# running jobs finish their files
+def ignoreInterrupt():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Run convertAnnotationFile on the tasks in a pool of jobs processes and
+# yield the results as they complete. Only a few tasks are queued at a
+# time, so that when the generator is closed early, e.g. on Ctrl+C, the
+# queued jobs are waited for instead of killed in the middle of writing
+def poolResults(tasks, jobs):
+    pool = multiprocessing.Pool(processes=jobs, initializer=ignoreInterrupt)
+    maxPending = 2 * jobs
+    tasks = iter(tasks)
+    pending = []
+    try:
+        while (True):
+            while (len(pending) < maxPending):
+                task = next(tasks, None)
+                if (task is None):
+                    break
+                pending.append(pool.apply_async(convertAnnotationFile, [task]))
+            if (not pending):
+                return
+            ready = [result for result in pending if result.ready()]
+            if (not ready):
+                # Wait with a timeout, an endless wait does not see Ctrl+C
+                pending[0].wait(0.1)
+                continue
+            for result in ready:
+                pending.remove(result)
+                yield result.get()
+    finally:
+        pool.close()
+        pool.join()
+
+# Convert all label files, returns the number of each status
+def batchConvert(filenames, jobs=1, overwrite=False, saveOptions=None, tolerance=0.0):
+    counts = {CONVERTED: 0, SKIPPED: 0, FAILED: 0}
+    # Boundary points before and after simplification
+    points = kept = 0
+    tasks = []
+    for idx, filename in enumerate(filenames):
+        if (not os.path.isfile(filename)):
+            logger.warning("%s not exist", filename)
+            counts[FAILED] += 1
+            continue
+        tasks.append((idx, filename, overwrite, saveOptions, tolerance))
+
+    if (jobs > 1 and len(tasks) > 1):
+        results = poolResults(tasks, jobs)
+    else:
+        results = (convertAnnotationFile(task) for task in tasks)
+
+    try:
+        for done, (idx, filename, status, message, stats) in enumerate(results):
+            if (status == EXISTS):
+                status = SKIPPED
+            counts[status] += 1
+            logStats(filename, stats)
+            if (status == CONVERTED):
+                filePoints, fileKept = simplifyCounts(stats)
+                points += filePoints
+                kept += fileKept
+            if (status == FAILED):
+                logger.error("[%d/%d] %s", done + 1, len(tasks), message)
+            elif (status == SKIPPED):
+                logger.info("[%d/%d] Skipped %s: %s", done + 1, len(tasks), filename, message)
+            else:
+                logger.info("[%d/%d] Converted %s", done + 1, len(tasks), filename)
+    finally:
+        # Waits for the running jobs
+        results.close()
+    if (tolerance > 0):
+        logger.info(simplifySummary(points, kept))
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert instance labels to occlusion boundary labels")
+    parser.add_argument('imagelist', help="imagelist.json in the same folder as the images")
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes (default: number of cores)")
+    policy = parser.add_mutually_exclusive_group()
+    policy.add_argument('--overwrite', dest='overwrite', action='store_true',
+                        help="replace existing occlusion boundary labels")
+    policy.add_argument('--skip-existing', dest='overwrite', action='store_false',
+                        help="keep existing occlusion boundary labels (default)")
+    parser.add_argument('--gt-ext', default='.polygons.json',
+                        help="label file extension (default: .polygons.json)")
+    parser.add_argument('--compact', action='store_true',
+                        help="write the label files without whitespace")
+    parser.add_argument('--precision', type=int,
+                        help="round the coordinates to this many decimals")
+    parser.add_argument('--simplify', type=float, default=0.0, metavar='TOLERANCE',
+                        help="simplify the boundaries, dropping points closer than "
+                             "TOLERANCE pixels to the simplified line (default: 0, keep all)")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="only report errors")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    try:
+        filenames = labelFilenames(args.imagelist, args.gt_ext)
+    except (IOError, ValueError) as e:
+        logger.error("Cannot read %s: %s", args.imagelist, e)
+        return 2
+
+    saveOptions = {'compact': args.compact, 'precision': args.precision}
+    try:
+        counts = batchConvert(filenames, max(args.jobs, 1), args.overwrite, saveOptions, args.simplify)
+    except KeyboardInterrupt:
+        logger.error("Interrupted, the label files already started were finished")
+        return 130
+    logger.info("Converted %d, skipped %d, failed %d",
+                counts[CONVERTED], counts[SKIPPED], counts[FAILED])
+    return 1 if counts[FAILED] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
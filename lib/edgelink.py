@@ -19,12 +19,17 @@ The Software is provided "as is", without warranty of any kind.
 import numpy as np
 import scipy.ndimage
 import bwmorph
+from stagetimer import StageTimer
 
-def edgelink(im):
+def edgelink(im, fast=True, timer=None):
     """
     EDGELINK - Link edge points in an image into lists
     Arguments:  im         - Binary edge image, it is assumed that edges
                              have been thinned (or are nearly thin).
+                fast       - Optional, use the table based tracker linkEdges.
+                timer      - Optional StageTimer, records the duration and
+                             pixel/edge counts of the close, thin, junctions
+                             and track stages.
 
     Returns:  edgelist - a edge lists in row, column coords
 
@@ -49,23 +54,46 @@ def edgelink(im):
     This function links edge points together into lists of coordinate pairs.
     Where an edge junction is encountered the list is terminated and a separate
     list is generated for each of the branches.
+
+    By default the edges are tracked by linkEdges, which works on precomputed
+    neighbour tables and gives the same result as the pixel by pixel tracker
+    below (trackEdge/availablePixels). Pass fast=False to use the latter.
     """
     
-    # Make sure image is binary.
-    edgeim = (im != 0).astype(np.int8)
-
-    # Fill one pixel hole 
-    edgeim = scipy.ndimage.binary_closing(edgeim, structure=np.ones((2, 2))).astype(np.int8)
-    # Make sure edges are thinned.
-    edgeim = bwmorph.thin(edgeim).astype(np.int8)
+    if (timer is None):
+        timer = StageTimer()
+
+    with timer.stage('close') as stats:
+        # Make sure image is binary.
+        edgeim = (im != 0).astype(np.int8)
+
+        # Fill one pixel hole 
+        edgeim = scipy.ndimage.binary_closing(edgeim, structure=np.ones((2, 2))).astype(np.int8)
+        stats['pixels'] = int(np.count_nonzero(edgeim))
+        stats['bytes'] = edgeim.nbytes
+    with timer.stage('thin') as stats:
+        # Make sure edges are thinned.
+        # Edges are labeled with -edgeNo, so use a type that does not overflow
+        edgeim = bwmorph.thin(edgeim, front=True).astype(np.int32)
+        stats['pixels'] = int(np.count_nonzero(edgeim))
+        stats['bytes'] = edgeim.nbytes
     rows, cols = edgeim.shape
 
-    # Find endings and junctions in edge data
-    # RJ, CJ, re, ce = findEndsJunctions(edgeim)
-    # We use bwmorph.branches and endpoints to avoid too long time 
-    # so that it can lead to freeze pyqt GUI main thread
-    RJ, CJ = np.where(bwmorph.branches(edgeim))
-    re, ce = np.where(bwmorph.endpoints(edgeim))
+    with timer.stage('junctions') as stats:
+        # Find endings and junctions in edge data
+        # RJ, CJ, re, ce = findEndsJunctions(edgeim)
+        # We use bwmorph.branches and endpoints to avoid too long time 
+        # so that it can lead to freeze pyqt GUI main thread
+        RJ, CJ = np.where(bwmorph.branches(edgeim))
+        re, ce = np.where(bwmorph.endpoints(edgeim))
+        stats['junctions'] = len(RJ)
+        stats['endpoints'] = len(re)
+
+    if (fast):
+        with timer.stage('track') as stats:
+            edgelist, edgeim, etype = linkEdges(edgeim, RJ, CJ, re, ce)
+            stats['edges'] = len(edgelist)
+        return edgelist, edgeim, etype
 
     # Create a dictionary to mark junction locations. This makes junction
     # testing much faster.  A value of 1 indicates a junction, a value of 2
@@ -452,3 +480,230 @@ def unitVector(v):
 
 def intersect(A, B):
     return np.array([x for x in set(tuple(x) for x in A) & set(tuple(x) for x in B)])
+
+# row and column offsets for the eight neighbours of a point, in the order
+# availablePixels visits them
+NEIGHBOUR_ROFF = (-1,  0,  1, 1, 1, 0, -1, -1)
+NEIGHBOUR_COFF = (-1, -1, -1, 0, 1, 1,  1,  0)
+
+# Bit of each neighbour in the bwmorph neighbourhood code, see LUT_DEL_MASK
+NEIGHBOUR_BITS = [int(bwmorph.LUT_DEL_MASK[1 + NEIGHBOUR_ROFF[k], 1 + NEIGHBOUR_COFF[k]])
+                  for k in range(8)]
+
+# Lookup table from a neighbourhood code to the neighbours that are set,
+# in availablePixels order
+NEIGHBOUR_LUT = [tuple(k for k in range(8) if code & NEIGHBOUR_BITS[k])
+                 for code in range(256)]
+
+# Dot products between the unit vectors of the eight moves, the last
+# row is the zero vector we start with when there is no direction yet
+_dirns = [unitVector([NEIGHBOUR_ROFF[k], NEIGHBOUR_COFF[k]]) for k in range(8)]
+MOVE_DOT = [[float(np.dot(np.ravel(d1), np.ravel(d2).T)) for d2 in _dirns]
+            for d1 in _dirns]
+MOVE_DOT.append([0.0] * 8)
+NO_DIRN = 8
+# City block length of each move
+MOVE_DIST = [abs(NEIGHBOUR_ROFF[k]) + abs(NEIGHBOUR_COFF[k]) for k in range(8)]
+del _dirns
+
+def linkEdges(edgeim, RJ, CJ, re, ce):
+    """
+    LINKEDGES - Table based version of the tracking part of EDGELINK
+
+    Gives the same edgelist, edgeim and etype as the pixel by pixel
+    tracker, but computes the neighbourhood of every edge pixel once. Each
+    edge pixel gets a compact index, its neighbours come from the bwmorph
+    neighbourhood code through NEIGHBOUR_LUT, and the labels and junction
+    flags are flat lists indexed by the compact index.
+
+    Arguments:  edgeim - Thinned binary edge image
+                RJ, CJ - Row and column coordinates of junctions
+                re, ce - Row and column coordinates of end points
+
+    Returns:    edgelist, edgeim, etype as EDGELINK
+    """
+    rows, cols = edgeim.shape
+    # Pad with a zero border, so that neighbours are never out of bounds
+    padded = np.zeros((rows + 2, cols + 2), np.uint8)
+    padded[1:-1, 1:-1] = edgeim != 0
+    width = cols + 2
+
+    # Compact index of each edge pixel, -1 for the background
+    pix = np.flatnonzero(padded)
+    compact = np.empty(padded.size, np.int64)
+    compact.fill(-1)
+    compact[pix] = np.arange(len(pix))
+    offsets = np.array([NEIGHBOUR_ROFF[k] * width + NEIGHBOUR_COFF[k] for k in range(8)])
+    neighbours = compact[pix[:, np.newaxis] + offsets[np.newaxis, :]].tolist()
+    codes = scipy.ndimage.correlate(padded, bwmorph.LUT_DEL_MASK, mode='constant')
+    codes = codes.ravel()[pix].tolist()
+    pr = (pix // width - 1).tolist()
+    pc = (pix % width - 1).tolist()
+
+    # 1 for unlabeled pixels, -edgeNo once tracked
+    label = [1] * len(pix)
+    # 0 for no junction, 1 for a junction, 2 for a visited junction
+    junct = [0] * len(pix)
+    def toCompact(r, c):
+        return int(compact[(r + 1) * width + c + 1])
+    for n in range(len(RJ)):
+        junct[toCompact(RJ[n], CJ[n])] = 1
+
+    # Same as availablePixels, but returns (move, pixel) pairs
+    def available(p, edgeNo=0):
+        a = []
+        j = []
+        nbrs = neighbours[p]
+        for k in NEIGHBOUR_LUT[codes[p]]:
+            q = nbrs[k]
+            if (junct[q]):
+                if (label[q] != -edgeNo):
+                    j.append((k, q))
+            elif (label[q] == 1):
+                a.append((k, q))
+        return (a, j)
+
+    # Same as trackEdge, p and p2 are compact indices
+    def track(p, edgeNo, p2=-1, avoidJunction=0):
+        edgepoints = [[pr[p], pc[p]]]
+        label[p] = -edgeNo
+        preferredDirection = 0
+        dirn = NO_DIRN
+        if (p2 >= 0):
+            edgepoints.append([pr[p2], pc[p2]])
+            label[p2] = -edgeNo
+            dirn = moveIndex(pr[p2] - pr[p], pc[p2] - pc[p])
+            p = p2
+            preferredDirection = 1
+
+        a, j = available(p, edgeNo)
+        while (a or j):
+            if (j and (not avoidJunction or not a)):
+                if (preferredDirection):
+                    # Junction closest to the current direction
+                    dots = MOVE_DOT[dirn]
+                    best = j[0]
+                    for move in j[1:]:
+                        if (dots[move[0]] > dots[best[0]]):
+                            best = move
+                else:
+                    # Prefer a 4-connected junction
+                    best = j[0]
+                    for move in j[1:]:
+                        if (MOVE_DIST[move[0]] < MOVE_DIST[best[0]]):
+                            best = move
+                    preferredDirection = 1
+            else:
+                # Pixel closest to the current direction
+                dots = MOVE_DOT[dirn]
+                best = a[0]
+                for move in a[1:]:
+                    if (dots[move[0]] > dots[best[0]]):
+                        best = move
+                avoidJunction = 0
+
+            dirn, p = best
+            edgepoints.append([pr[p], pc[p]])
+            label[p] = -edgeNo
+
+            # If this point is a junction exit here
+            if (junct[p]):
+                return (edgepoints, 1)
+            a, j = available(p, edgeNo)
+
+        # Close loops the same way as trackEdge
+        endType = 0
+        if (len(edgepoints) >= 4):
+            if (np.abs(edgepoints[0][0] - edgepoints[-1][0]) <= 1
+                and np.abs(edgepoints[0][1] - edgepoints[-1][1] <= 1)):
+                edgepoints.append(edgepoints[0])
+                endType = 4
+        return (edgepoints, endType)
+
+    edgeNo = 0
+    edgelist = []
+    etype = []
+
+    # 1) Form tracks from each unlabeled endpoint
+    for n in range(len(re)):
+        p = toCompact(re[n], ce[n])
+        if (label[p] == 1):
+            edgeNo += 1
+            edgepoints, endType = track(p, edgeNo)
+            edgelist.append(edgepoints)
+            etype.append(endType)
+
+    # 2) Handle junctions, see edgelink for the details
+    for n in range(len(RJ)):
+        pj = toCompact(RJ[n], CJ[n])
+        if (junct[pj] == 2):
+            continue
+        junct[pj] = 2
+        aj, jj = available(pj, 0)
+
+        for kk, pk in jj:
+            # Create a 2-element edgetrack to each adjacent junction
+            edgeNo += 1
+            edgelist.append([[pr[pj], pc[pj]], [pr[pk], pc[pk]]])
+            etype.append(3)
+            label[pj] = -edgeNo
+            label[pk] = -edgeNo
+
+            ak, jk = available(pk, 0)
+
+            # Untracked neighbours common to both junctions
+            if (aj and ak):
+                raca = np.array([[pr[q], pc[q]] for k, q in aj])
+                rakcak = np.array([[pr[q], pc[q]] for k, q in ak])
+                commonrc = intersect(raca, rakcak)
+                for m in range(commonrc.shape[0]):
+                    distj = norm(commonrc[m] - np.array([pr[pj], pc[pj]]))
+                    distk = norm(commonrc[m] - np.array([pr[pk], pc[pk]]))
+                    q = toCompact(commonrc[m][0], commonrc[m][1])
+                    edgeNo += 1
+                    if (distj < distk):
+                        edgepoints, endType = track(pj, edgeNo, q, 1)
+                    else:
+                        edgepoints, endType = track(pk, edgeNo, q, 1)
+                    edgelist.append(edgepoints)
+                    etype.append(3)
+
+            # Track any remaining unlabeled pixels adjacent to junction k
+            for k, q in ak:
+                if (label[q] == 1):
+                    edgeNo += 1
+                    edgepoints, endType = track(pk, edgeNo, q)
+                    edgelist.append(edgepoints)
+                    etype.append(3)
+
+            junct[pk] = 2
+
+        # Track any remaining unlabeled pixels adjacent to junction j
+        for k, q in aj:
+            if (label[q] == 1):
+                edgeNo += 1
+                edgepoints, endType = track(pj, edgeNo, q)
+                edgelist.append(edgepoints)
+                etype.append(3)
+
+    # 3) Isolated loops, every pixel still unlabeled at this point
+    # starts a track, as in edgelink
+    for p in [q for q in range(len(pix)) if label[q] == 1]:
+        edgeNo += 1
+        edgepoints, endType = track(p, edgeNo)
+        edgelist.append(edgepoints)
+        etype.append(endType)
+
+    # Write the labels back, negated to make edge encodings +ve
+    labeled = np.zeros(padded.size, np.int32)
+    labeled[pix] = label
+    edgeim = -labeled.reshape(padded.shape)[1:-1, 1:-1]
+
+    return (edgelist, edgeim, etype)
+
+# Index of the move (dr, dc) in NEIGHBOUR_ROFF/NEIGHBOUR_COFF
+def moveIndex(dr, dc):
+    for k in range(8):
+        if (NEIGHBOUR_ROFF[k] == dr and NEIGHBOUR_COFF[k] == dc):
+            return k
+    raise ValueError("({0}, {1}) is not a move to a neighbour".format(dr, dc))
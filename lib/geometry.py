@@ -0,0 +1,647 @@
+"""
+Vectorized geometry of the polygons and boundaries drawn by the canvas.
+
+Copyright (c) 2018- Guoxia Wang
+mingzilaochongtu at gmail com
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+The Software is provided "as is", without warranty of any kind.
+
+"""
+import numpy as np
+import math
+import scipy.ndimage
+
+from spatialindex import GridIndex
+
+# The arrows along a boundary showing its occlusion direction, as an
+# (K, 4, 2) array of the corners tip, left, notch, right. An arrow is put
+# in the middle of every spacing points, pointing to the right of the
+# boundary, length is the length of its sides
+def arrowPolygons(points, spacing=5, length=5.0):
+    points = np.asarray(points, np.float64).reshape(-1, 2)
+    count = len(points) // spacing
+    if (count == 0):
+        return np.zeros((0, 4, 2))
+    starts = np.arange(count) * spacing
+    ends = starts + spacing
+    # The last arrow ends at the last point
+    ends[ends >= len(points)] = len(points) - 1
+    pt1 = points[starts]
+    pt2 = points[ends]
+    mid = (pt1 + pt2) / 2.0
+
+    # Unit normal of the segment, the segment direction turned right
+    delta = pt2 - pt1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        unit = delta / np.hypot(delta[:, 0], delta[:, 1])[:, None]
+    dx = unit[:, 1]
+    dy = -unit[:, 0]
+
+    cos, sin = 0.866, 0.500
+    cos2, sin2 = 0.500, 0.866
+    x = mid[:, 0] + cos * length * dx
+    y = mid[:, 1] + cos * length * dy
+    x1 = x - length * (dx * cos - dy * sin)
+    y1 = y - length * (dx * sin + dy * cos)
+    x2 = x - length * (dx * cos + dy * sin)
+    y2 = y - length * (-dx * sin + dy * cos)
+    x3 = x1 + 0.577 * length * (dx * cos2 - dy * sin2)
+    y3 = y1 + 0.577 * length * (dx * sin2 + dy * cos2)
+
+    arrows = np.stack([np.column_stack([x, y]), np.column_stack([x1, y1]),
+                       np.column_stack([x3, y3]), np.column_stack([x2, y2])], axis=1)
+    # Segments of zero length have no direction
+    return arrows[np.isfinite(arrows).all(axis=(1, 2))]
+
+# QLineF(p1, p2).intersect(QLineF(q1, q2)) for arrays of lines, with the
+# same floating point operations as Qt. Returns the arrays (noIntersection,
+# na, nb), the intersection is at p1 + na * (p2 - p1) and q1 + nb * (q2 - q1)
+def lineIntersectionParameters(p1, p2, q1, q2):
+    a = p2 - p1
+    b = q1 - q2
+    c = p1 - q1
+    with np.errstate(all='ignore'):
+        denominator = a[..., 1] * b[..., 0] - a[..., 0] * b[..., 1]
+        noIntersection = (denominator == 0) | ~np.isfinite(denominator)
+        reciprocal = 1 / denominator
+        na = (b[..., 1] * c[..., 0] - b[..., 0] * c[..., 1]) * reciprocal
+        nb = (a[..., 0] * c[..., 1] - a[..., 1] * c[..., 0]) * reciprocal
+    return noIntersection, na, nb
+
+# The boolean arrays (noIntersection, bounded) of lineIntersectionParameters,
+# lines that are neither intersect unbounded
+def lineIntersection(p1, p2, q1, q2):
+    noIntersection, na, nb = lineIntersectionParameters(p1, p2, q1, q2)
+    with np.errstate(invalid='ignore'):
+        # Written as Qt does, NaN counts as inside
+        bounded = ~(noIntersection | (na < 0) | (na > 1) | (nb < 0) | (nb > 1))
+    return noIntersection, bounded
+
+# QLineF(p1, p2).length() for arrays of points, NaN is taken as infinite
+def pointDistance(p1, p2):
+    delta = p2 - p1
+    with np.errstate(invalid='ignore', over='ignore'):
+        dist = np.sqrt(delta[..., 0] * delta[..., 0] + delta[..., 1] * delta[..., 1])
+    dist[np.isnan(dist)] = np.inf
+    return dist
+
+# Distance of the points to the segments from starts to ends, the arrays
+# broadcast against each other. NaN is taken as infinite
+def segmentDistance(points, starts, ends):
+    delta = ends - starts
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        lengthSquared = (delta * delta).sum(axis=-1)
+        t = ((points - starts) * delta).sum(axis=-1) / lengthSquared
+        t = np.where(lengthSquared > 0, np.clip(t, 0, 1), 0)
+        feet = starts + delta * t[..., None]
+    return pointDistance(feet, points)
+
+# The point or edge of a polygon the point pt is within threshold of, the
+# way the canvas looked for it point by point. Returns (i, i) for point i,
+# else (i, i + 1) for the edge from point i to the next one, or (-1, -1).
+# A point is preferred to an edge, the first of equally close ones is
+# taken. An edge counts if the foot of the normal from pt lies on it and
+# pt is no further from it than its length on its right in the image, as the
+# intersection with QLineF.normalVector found. Edges are only searched if
+# the polygon is closed, the last one goes back to the first point
+def closestPoint(points, pt, closed=True, threshold=4.0):
+    points = np.asarray(points, np.float64).reshape(-1, 2)
+    pt = np.asarray(pt, np.float64)
+    n = len(points)
+    if (n == 0):
+        return (-1, -1)
+    dist = pointDistance(points, pt)
+    i = int(np.argmin(dist))
+    if (dist[i] <= threshold):
+        return (i, i)
+
+    if (closed and n >= 2):
+        starts, ends = points, np.roll(points, -1, axis=0)
+        delta = ends - starts
+        # QLineF.normalVector ends at start + (dy, -dx), moved to pt
+        normal = np.column_stack([(starts[:, 0] + delta[:, 1]) - starts[:, 0],
+                                  (starts[:, 1] - delta[:, 0]) - starts[:, 1]])
+        noIntersection, na, nb = lineIntersectionParameters(starts, ends, pt, pt + normal)
+        with np.errstate(invalid='ignore', over='ignore'):
+            inside = ~(noIntersection | (na < 0) | (na > 1) | (nb < 0) | (nb > 1))
+            feet = starts + delta * na[:, None]
+        dist = pointDistance(feet, pt)
+        dist[~inside] = np.inf
+        i = int(np.argmin(dist))
+        if (dist[i] <= threshold):
+            return (i, (i + 1) % n)
+    return (-1, -1)
+
+# Lines that do not intersect and point in opposite directions, which
+# counts as an intersection of neighbouring edges
+def reverseParallel(p1, p2, q1, q2):
+    noIntersection, bounded = lineIntersection(p1, p2, q1, q2)
+    a = p2 - p1
+    b = q2 - q1
+    return noIntersection & (a[..., 0] * b[..., 0] + a[..., 1] * b[..., 1] < 0)
+
+# Pairs (i, j), i < j, of the intervals [lo, hi] that overlap, found by
+# sweeping over lo. Yields them in chunks of about chunkSize pairs
+def overlappingPairs(lo, hi, chunkSize=1 << 20):
+    order = np.argsort(lo, kind='mergesort')
+    lo = lo[order]
+    ends = np.searchsorted(lo, hi[order], side='right')
+    counts = np.maximum(ends - np.arange(len(lo)) - 1, 0)
+    cumulative = np.cumsum(counts)
+    start = 0
+    while (start < len(lo)):
+        stop = int(np.searchsorted(cumulative, (cumulative[start - 1] if start else 0) + chunkSize, side='right'))
+        stop = min(max(stop, start + 1), len(lo))
+        chunkCounts = counts[start:stop]
+        total = int(chunkCounts.sum())
+        if (total):
+            rows = np.repeat(np.arange(start, stop), chunkCounts)
+            firsts = np.repeat(np.cumsum(chunkCounts) - chunkCounts, chunkCounts)
+            cols = rows + 1 + np.arange(total) - firsts
+            i, j = order[rows], order[cols]
+            yield np.minimum(i, j), np.maximum(i, j)
+        start = stop
+
+class EdgeSet(object):
+    """
+    The edges of a polygon or polyline as arrays, for finding the pairs of
+    edges that QLineF.intersect could report as intersecting without
+    testing every pair.
+
+    A pair is only left out if rounding cannot make Qt report it: the
+    edges are further apart than a tolerance far above the rounding error,
+    and they are not nearly collinear. Nearly collinear edges are paired
+    by a sweep over the offsets of their lines instead.
+    """
+    # Edges closer in angle than this (radians) count as parallel
+    PARALLEL = 1e-4
+    # Shorter edges have no reliable direction and pair with all others
+    TINY = 1e-100
+
+    def __init__(self, starts, ends):
+        self.starts = np.asarray(starts, np.float64).reshape(-1, 2)
+        self.ends = np.asarray(ends, np.float64).reshape(-1, 2)
+        points = np.concatenate([self.starts, self.ends])
+        if (len(points)):
+            lo, hi = points.min(axis=0), points.max(axis=0)
+        else:
+            lo = hi = np.zeros(2)
+        # The size of the polygon sets all tolerances
+        self.center = (lo + hi) / 2.0
+        self.size = float(np.hypot(*(hi - lo))) + 1.0
+        self.tolerance = 1e-6 * self.size
+
+    def __len__(self):
+        return len(self.starts)
+
+    # Pairs (i, j), i < j, that overlap in x and y within the tolerance
+    def boxPairs(self):
+        lo = np.minimum(self.starts, self.ends) - self.tolerance
+        hi = np.maximum(self.starts, self.ends) + self.tolerance
+        # Sweep along the longer side
+        axis = int(np.argmax(hi.max(axis=0) - lo.min(axis=0))) if len(self) else 0
+        other = 1 - axis
+        for i, j in overlappingPairs(lo[:, axis], hi[:, axis]):
+            keep = (lo[i, other] <= hi[j, other]) & (lo[j, other] <= hi[i, other])
+            yield i[keep], j[keep]
+
+    # Pairs (i, j), i < j, of nearly collinear edges, and of tiny edges
+    # with all others
+    def collinearPairs(self):
+        delta = self.ends - self.starts
+        length = np.hypot(delta[:, 0], delta[:, 1])
+        tiny = length < self.TINY
+        angle = np.arctan2(delta[:, 1], delta[:, 0]) % np.pi
+        normal = np.column_stack([-np.sin(angle), np.cos(angle)])
+        offset = ((self.starts - self.center) * normal).sum(axis=1)
+
+        # Angles close to pi are also close to 0, with the opposite offset
+        index = np.arange(len(self))
+        wrap = angle > np.pi - self.PARALLEL
+        index = np.concatenate([index, index[wrap]])
+        angle = np.concatenate([angle, angle[wrap] - np.pi])
+        offset = np.concatenate([offset, -offset[wrap]])
+
+        # A parallel line passing within the tolerance of an edge, seen
+        # from the center, is at most this far in offset
+        reach = 4 * self.PARALLEL * self.size + self.tolerance
+        for k, l in overlappingPairs(offset - reach, offset + reach):
+            keep = np.abs(angle[k] - angle[l]) < self.PARALLEL
+            i, j = index[k[keep]], index[l[keep]]
+            keep = i != j
+            yield np.minimum(i, j)[keep], np.maximum(i, j)[keep]
+
+        for i in np.flatnonzero(tiny):
+            j = np.delete(np.arange(len(self)), i)
+            yield np.minimum(i, j), np.maximum(i, j)
+
+    # All pairs that need testing, possibly with repetitions
+    def candidatePairs(self):
+        for pairs in self.boxPairs():
+            yield pairs
+        for pairs in self.collinearPairs():
+            yield pairs
+
+    # Whether any of the pairs (i, j) intersect bounded, edge i taken as
+    # the line intersect is called on
+    def anyBounded(self, i, j):
+        noIntersection, bounded = lineIntersection(self.starts[i], self.ends[i],
+                                                   self.starts[j], self.ends[j])
+        return bool(bounded.any())
+
+# The edges of a closed polygon, edge i goes from point i to point i + 1
+def polygonEdges(points):
+    points = np.asarray(points, np.float64).reshape(-1, 2)
+    return EdgeSet(points, np.roll(points, -1, axis=0))
+
+# Whether the closed polygon is valid the way the canvas checked it edge
+# pair by edge pair: neighbouring edges must not run back on each other,
+# other edges must not intersect
+def polygonIsValid(points):
+    edges = polygonEdges(points)
+    n = len(edges)
+    if (n < 2):
+        return True
+    # Neighbouring edges i, i + 1 and the last with the first
+    first = np.arange(n - 1)
+    second = first + 1
+    if (n > 2):
+        first = np.append(first, 0)
+        second = np.append(second, n - 1)
+    if (reverseParallel(edges.starts[first], edges.ends[first],
+                        edges.starts[second], edges.ends[second]).any()):
+        return False
+
+    for i, j in edges.candidatePairs():
+        keep = (j != i + 1) & ~((i == 0) & (j == n - 1))
+        if (edges.anyBounded(i[keep], j[keep])):
+            return False
+    return True
+
+# Whether the line from the last point of the open polyline to pt may be
+# added: it must not run back on the last edge or intersect another one
+def polylineCanExtend(points, pt):
+    points = np.asarray(points, np.float64).reshape(-1, 2)
+    if (len(points) < 2):
+        return True
+    pt = np.asarray(pt, np.float64)
+    if (reverseParallel(points[-2], points[-1], points[-1], pt)):
+        return False
+    noIntersection, bounded = lineIntersection(points[:-2], points[1:-1], points[-1], pt)
+    return not bounded.any()
+
+class EdgeIndex(object):
+    """
+    The edges of a closed polygon that is edited one point at a time. The
+    edges are kept in a grid over the image and in a grid over the angles
+    and offsets of their lines, so that the edges an edge could intersect
+    are found without looking at all of them. Then moving a point of a
+    valid polygon only tests the two edges at the point against their
+    candidates, the same pairs polygonIsValid would test. The edges have
+    ids that do not change when points are inserted or deleted.
+    """
+    def __init__(self, points):
+        self.build(np.array(points, np.float64).reshape(-1, 2))
+
+    def __len__(self):
+        return len(self.points)
+
+    def build(self, points):
+        self.points = points
+        n = len(points)
+        # Edge ids by position and positions by edge id
+        self.ids = np.arange(n)
+        self.position = np.arange(n)
+        self.nextId = n
+        # The tolerances hold while the points stay in this region, the
+        # polygon grown by its size on all sides
+        lo, hi = (points.min(axis=0), points.max(axis=0)) if n else (np.zeros(2), np.zeros(2))
+        extent = hi - lo + 1.0
+        self.lo, self.hi = lo - extent, hi + extent
+        self.center = (self.lo + self.hi) / 2.0
+        self.size = float(np.hypot(*(self.hi - self.lo))) + 1.0
+        self.tolerance = 1e-6 * self.size
+        self.reach = 4 * EdgeSet.PARALLEL * self.size + self.tolerance
+
+        # About one cell per edge over the polygon, long edges that would
+        # cover many cells are kept aside by the grid
+        self.grid = GridIndex(max(float((hi - lo).max()) / math.sqrt(n), 1.0) if n else 1.0, maxCells=16)
+        # Angles in units of EdgeSet.PARALLEL, offsets in units of reach
+        self.lines = GridIndex(1.0)
+        # Ids of the edges too short to have a direction
+        self.tiny = set()
+        for edgeId in range(n):
+            self.updateEdge(edgeId)
+
+    # Whether pt is in the region the tolerances were made for
+    def covers(self, pt):
+        return bool(np.all(pt >= self.lo) and np.all(pt <= self.hi))
+
+    # Start and end point of the edge at position k
+    def edge(self, k):
+        return self.points[k], self.points[(k + 1) % len(self.points)]
+
+    # The box of the edge from start to end in the image, its boxes in
+    # the line grid and whether it is tiny
+    def edgeBoxes(self, start, end):
+        tol = self.tolerance
+        box = (min(start[0], end[0]) - tol, min(start[1], end[1]) - tol,
+               max(start[0], end[0]) + tol, max(start[1], end[1]) + tol)
+        dx, dy = float(end[0] - start[0]), float(end[1] - start[1])
+        tiny = math.hypot(dx, dy) < EdgeSet.TINY
+        angle = math.atan2(dy, dx) % math.pi
+        offset = (-math.sin(angle) * (start[0] - self.center[0]) +
+                  math.cos(angle) * (start[1] - self.center[1]))
+        # Two lines are as close as EdgeSet.collinearPairs pairs them if
+        # their boxes overlap
+        lineBoxes = [self.lineBox(angle, offset)]
+        # Angles close to pi are also close to 0, with the opposite offset
+        if (angle > math.pi - EdgeSet.PARALLEL):
+            lineBoxes.append(self.lineBox(angle - math.pi, -offset))
+        return box, lineBoxes, tiny
+
+    def lineBox(self, angle, offset):
+        a = angle / EdgeSet.PARALLEL
+        o = offset / self.reach
+        return (a - 0.5, o - 1.0, a + 0.5, o + 1.0)
+
+    # Put the edge with the given id in the grids at its current place
+    def updateEdge(self, edgeId):
+        box, lineBoxes, tiny = self.edgeBoxes(*self.edge(self.position[edgeId]))
+        self.grid.update(edgeId, box)
+        for k in range(2):
+            self.lines.update((edgeId, k), lineBoxes[k] if k < len(lineBoxes) else None)
+        if (tiny):
+            self.tiny.add(edgeId)
+        else:
+            self.tiny.discard(edgeId)
+
+    def removeEdge(self, edgeId):
+        self.grid.remove(edgeId)
+        for k in range(2):
+            self.lines.remove((edgeId, k))
+        self.tiny.discard(edgeId)
+
+    # Positions of the edges an edge from start to end could intersect
+    def candidates(self, start, end):
+        box, lineBoxes, tiny = self.edgeBoxes(start, end)
+        if (tiny):
+            return np.arange(len(self))
+        ids = self.grid.queryBox(box)
+        for lineBox in lineBoxes:
+            ids.update(key[0] for key in self.lines.queryBox(lineBox))
+        ids.update(self.tiny)
+        return self.position[np.array(sorted(ids), np.int64)]
+
+    def isValid(self):
+        return polygonIsValid(self.points)
+
+    # Whether the polygon stays valid if point v moves to pt. The polygon
+    # must be valid now, only the pairs with the two edges at v are tested
+    def moveIsValid(self, v, pt):
+        n = len(self)
+        v = v % n
+        pt = np.asarray(pt, np.float64)
+        if (n < 4 or not self.covers(pt)):
+            points = self.points.copy()
+            points[v] = pt
+            return polygonIsValid(points)
+
+        before, after = (v - 1) % n, v
+        moved = {before: (self.points[before], pt),
+                 after: (pt, self.points[(v + 1) % n])}
+        def edge(k):
+            return moved[k] if k in moved else self.edge(k)
+
+        # Neighbouring edges must not run back on each other
+        for k in ((v - 2) % n, before, after):
+            i, j = sorted((k, (k + 1) % n))
+            if (reverseParallel(edge(i)[0], edge(i)[1], edge(j)[0], edge(j)[1])):
+                return False
+
+        # The other edges must not intersect, the one at the lower
+        # position is the line intersect is called on
+        for k in (before, after):
+            start, end = moved[k]
+            q = self.candidates(start, end)
+            q = q[(q != before) & (q != after) & (q != (k - 1) % n) & (q != (k + 1) % n)]
+            starts, ends = self.points[q], self.points[(q + 1) % n]
+            first = (q > k)[:, None]
+            noIntersection, bounded = lineIntersection(
+                np.where(first, start, starts), np.where(first, end, ends),
+                np.where(first, starts, start), np.where(first, ends, end))
+            if (bounded.any()):
+                return False
+        return True
+
+    # Move point v to pt
+    def move(self, v, pt):
+        n = len(self)
+        v = v % n
+        self.points[v] = pt
+        if (not self.covers(self.points[v])):
+            self.build(self.points)
+            return
+        self.updateEdge(self.ids[(v - 1) % n])
+        self.updateEdge(self.ids[v])
+
+    # Insert pt before point v as QPolygonF.insert does, it splits the
+    # edge from point v - 1 to point v
+    def insert(self, v, pt):
+        self.points = np.insert(self.points, v, pt, axis=0)
+        self.ids = np.insert(self.ids, v, self.nextId)
+        self.nextId += 1
+        self.updatePositions()
+        if (not self.covers(self.points[v])):
+            self.build(self.points)
+            return
+        n = len(self)
+        self.updateEdge(self.ids[(v - 1) % n])
+        self.updateEdge(self.ids[v])
+
+    # Delete point v, its two edges become one
+    def delete(self, v):
+        v = v % len(self)
+        self.points = np.delete(self.points, v, axis=0)
+        self.removeEdge(self.ids[v])
+        self.ids = np.delete(self.ids, v)
+        self.updatePositions()
+        if (len(self)):
+            self.updateEdge(self.ids[(v - 1) % len(self)])
+
+    def updatePositions(self):
+        self.position = np.zeros(self.nextId, np.int64)
+        self.position[self.ids] = np.arange(len(self.ids))
+
+class BoundaryMap(object):
+    """
+    Lookup rasters to find the first boundary passing within threshold of
+    the mouse, as testing every boundary in turn would. The rasters have
+    a cell for every threshold by threshold pixels. For each cell they
+    hold the lowest and one past the highest index of the boundaries
+    passing a few cells around it, so that at most those boundaries need
+    the exact test. Away from the boundaries and where only one is close,
+    that is a lookup. The distance is taken to the segments of the
+    boundaries, so that simplified ones with few points can be picked.
+    """
+    def __init__(self, polylines, threshold=4.0):
+        self.polylines = [np.asarray(points, np.float64).reshape(-1, 2) for points in polylines]
+        self.threshold = threshold
+        count = len(self.polylines)
+        self.cellSize = max(int(math.ceil(threshold)), 1)
+        spacing = self.cellSize / 2.0
+        points, index, vertexCount = self.samplePoints(spacing)
+
+        # The boxes of the boundaries grown by threshold, to pick the
+        # candidates where several boundaries are close. The points of a
+        # boundary come first in the samples, in the order of the boundaries
+        self.boxes = np.zeros((count, 4))
+        self.boxes[:, :2] = np.inf
+        self.boxes[:, 2:] = -np.inf
+        if (vertexCount):
+            present, starts = np.unique(index[:vertexCount], return_index=True)
+            self.boxes[present, :2] = np.minimum.reduceat(points[:vertexCount], starts) - threshold
+            self.boxes[present, 2:] = np.maximum.reduceat(points[:vertexCount], starts) + threshold
+
+        # Every point of a boundary is within half the spacing of a
+        # sample, so a boundary within threshold of a position in cell
+        # (col, row) has a sample in a cell at most radius cells away in
+        # x and y
+        radius = int(math.floor((threshold + spacing / 2.0) / self.cellSize)) + 1
+        size = 2 * radius + 1
+        # The rasters cover the samples with radius cells around them
+        cells = np.floor(points / self.cellSize).astype(np.int64)
+        if (len(cells)):
+            self.origin = cells.min(axis=0) - radius
+            shape = tuple((cells.max(axis=0) - self.origin + radius + 1)[::-1])
+        else:
+            self.origin = np.zeros(2, np.int64)
+            shape = (0, 0)
+        cols, rows = (cells - self.origin).T
+
+        # The lowest and highest index of the samples in each cell, from
+        # the samples sorted by cell and index
+        key = np.sort((rows * shape[1] + cols) * max(count, 1) + index)
+        cell, key = np.divmod(key, max(count, 1))
+        isFirst = np.ones(len(cell), np.bool)
+        isFirst[1:] = cell[1:] != cell[:-1]
+        isLast = np.roll(isFirst, -1)
+
+        dtype = np.uint16 if count < 1 << 16 else np.uint32
+        first = np.full(shape, count, dtype)
+        first.flat[cell[isFirst]] = key[isFirst]
+        self.first = scipy.ndimage.minimum_filter(first, size=size, mode='constant', cval=count)
+        del first
+        end = np.zeros(shape, dtype)
+        end.flat[cell[isLast]] = key[isLast] + 1
+        self.end = scipy.ndimage.maximum_filter(end, size=size, mode='constant', cval=0)
+
+    # The points of the boundaries and points on their segments at most
+    # spacing apart, with the index of their boundary and the number of
+    # points of the boundaries, which come first. Every point of a
+    # boundary is within half the spacing of one of them
+    def samplePoints(self, spacing=1.0):
+        count = len(self.polylines)
+        if (not count):
+            return np.zeros((0, 2)), np.zeros(0, np.int64), 0
+        index = np.repeat(np.arange(count), [len(points) for points in self.polylines])
+        points = np.concatenate(self.polylines)
+
+        sameBoundary = index[:-1] == index[1:]
+        starts, ends = points[:-1][sameBoundary], points[1:][sameBoundary]
+        segmentIndex = index[:-1][sameBoundary]
+        delta = ends - starts
+        with np.errstate(invalid='ignore', over='ignore'):
+            length = np.sqrt((delta * delta).sum(axis=1))
+        finite = np.isfinite(length)
+        starts, delta, segmentIndex = starts[finite], delta[finite], segmentIndex[finite]
+        steps = np.ceil(length[finite] / spacing).astype(np.int64)
+        # Sample k of a segment is at k / steps along it, 0 < k < steps
+        counts = np.maximum(steps - 1, 0)
+        segment = np.repeat(np.arange(len(steps)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+        between = starts[segment] + delta[segment] * (k / steps[segment].astype(np.float64))[:, None]
+
+        finite = np.isfinite(points).all(axis=1)
+        return (np.concatenate([points[finite], between]),
+                np.concatenate([index[finite], segmentIndex[segment]]),
+                int(finite.sum()))
+
+    # Whether boundary idx passes within threshold of pt
+    def isClose(self, idx, pt):
+        points = self.polylines[idx]
+        if ((pointDistance(points, pt) <= self.threshold).any()):
+            return True
+        return bool((segmentDistance(pt, points[:-1], points[1:]) <= self.threshold).any())
+
+    # Index of the first boundary passing within threshold of (x, y), -1
+    # if there is none
+    def lookup(self, x, y):
+        if (not (np.isfinite(x) and np.isfinite(y))):
+            return -1
+        col = int(math.floor(x / self.cellSize)) - self.origin[0]
+        row = int(math.floor(y / self.cellSize)) - self.origin[1]
+        if (not (0 <= row < self.first.shape[0] and 0 <= col < self.first.shape[1])):
+            return -1
+        first, last = int(self.first[row, col]), int(self.end[row, col]) - 1
+        if (first > last):
+            return -1
+        candidates = [first]
+        if (last > first):
+            boxes = self.boxes[first:last + 1]
+            inside = ((boxes[:, 0] <= x) & (x <= boxes[:, 2]) &
+                      (boxes[:, 1] <= y) & (y <= boxes[:, 3]))
+            candidates = first + np.flatnonzero(inside)
+        pt = np.array([x, y], np.float64)
+        for idx in candidates:
+            if (self.isClose(idx, pt)):
+                return int(idx)
+        return -1
+
+# The polylines with the points Douglas-Peucker simplification keeps: a
+# polyline is replaced by the segment from its first to its last point
+# if no point is further than tolerance from that, else it is split at
+# the furthest point and both parts are simplified. All parts of all
+# polylines are split at once, one level at a time. The first and last
+# point are always kept, a tolerance of 0 or less keeps all points
+def simplifyPolylines(polylines, tolerance):
+    polylines = [np.asarray(points).reshape(-1, 2) for points in polylines]
+    if (tolerance <= 0 or not polylines):
+        return polylines
+    lengths = np.array([len(points) for points in polylines], np.int64)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    points = np.concatenate(polylines).astype(np.float64)
+    keep = np.zeros(len(points), np.bool)
+    keep[starts[lengths > 0]] = True
+    keep[ends[lengths > 0] - 1] = True
+
+    # The parts (first, last) with points between them
+    first, last = starts[lengths > 2], ends[lengths > 2] - 1
+    while (len(first)):
+        counts = last - first - 1
+        part = np.repeat(np.arange(len(first)), counts)
+        offsets = np.cumsum(counts) - counts
+        idx = first[part] + 1 + np.arange(counts.sum()) - offsets[part]
+        dist = segmentDistance(points[idx], points[first[part]], points[last[part]])
+        furthest = np.maximum.reduceat(dist, offsets)
+        # The first of the furthest points of each part
+        isFurthest = np.flatnonzero(dist == furthest[part])
+        pivot = idx[isFurthest[np.unique(part[isFurthest], return_index=True)[1]]]
+
+        split = furthest > tolerance
+        pivot = pivot[split]
+        keep[pivot] = True
+        first, last = np.concatenate([first[split], pivot]), np.concatenate([pivot, last[split]])
+        inner = last - first > 1
+        first, last = first[inner], last[inner]
+
+    # Each polyline keeps its type, also among polylines of other types
+    return [polyline[keep[start:end]] for polyline, start, end in zip(polylines, starts, ends)]
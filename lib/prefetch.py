@@ -0,0 +1,94 @@
+"""
+A small cache of images and labels loaded ahead of time, so that going to
+the next or previous image does not wait for the disk and the decoder.
+
+Copyright (c) 2018- Guoxia Wang
+mingzilaochongtu at gmail com
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+The Software is provided "as is", without warranty of any kind.
+
+"""
+import os
+import threading
+from collections import OrderedDict
+
+# The key of the current content of a file, None if it does not exist
+def fileKey(filename):
+    try:
+        return (os.path.normpath(filename), os.stat(filename).st_mtime)
+    except OSError:
+        return None
+
+# The indices around idx to load ahead, nearest first and the next one
+# before the previous one at the same distance
+def neighbourIndices(idx, count, length):
+    indices = []
+    for distance in range(1, count + 1):
+        for k in (idx + distance, idx - distance):
+            if (0 <= k < length):
+                indices.append(k)
+    return indices
+
+class PrefetchCache(object):
+    """
+    Least recently used cache of loaded files keyed by fileKey, safe to
+    share between the loading thread and the GUI thread. An entry is
+    removed when it is taken, the caller owns and may change it.
+    """
+    def __init__(self, capacity=8):
+        self.capacity = max(int(capacity), 0)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # Add an entry, dropping the least recently used ones beyond capacity
+    def put(self, key, value):
+        if (key is None):
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while (len(self.entries) > self.capacity):
+                self.entries.popitem(last=False)
+
+    # Mark an entry as used, returns whether it is cached
+    def touch(self, key):
+        with self.lock:
+            if (key not in self.entries):
+                return False
+            self.entries[key] = self.entries.pop(key)
+            return True
+
+    # Remove and return the entry of key, or None
+    def take(self, key):
+        with self.lock:
+            return self.entries.pop(key, None)
+
+    # Remove and return the entry for the current content of filename
+    def takeFile(self, filename):
+        key = fileKey(filename)
+        return None if key is None else self.take(key)
+
+    # Remove all entries of filename, e.g. after it was written
+    def discard(self, filename):
+        path = os.path.normpath(filename)
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == path]:
+                del self.entries[key]
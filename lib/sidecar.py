@@ -0,0 +1,253 @@
+"""
+Binary sidecar of a label file, e.g. 000000000063.polygons.bin next to
+000000000063.polygons.json. It is memory-mapped when read, so the points
+are only paged in when a polygon is used.
+
+Usage: python -m lib.sidecar file.polygons.json ... [--to-json] [--check]
+
+Layout, little endian:
+    magic 'OBSC', uint32 version
+    uint64 length M of the metadata, uint64 number R of rings
+    M bytes of metadata json, zero padded to 8 bytes
+    (R + 1) uint64 byte offsets of the rings in the data
+    R uint8 ring types (0 float64, 1 int64), zero padded to 8 bytes
+    the data, each ring as N x 2 values of its type
+
+The metadata holds the image size, the attributes and ring counts of the
+objects and the boundaries, and the size and mtime of the json file the
+sidecar was made from. A sidecar is only used while those still match.
+
+Copyright (c) 2018- Guoxia Wang
+mingzilaochongtu at gmail com
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+The Software is provided "as is", without warranty of any kind.
+
+"""
+import numpy as np
+import os
+import sys
+import json
+import struct
+import argparse
+import functools
+
+from annotation import PolygonRing, Annotation, AnnInstance, AnnBoundary
+
+MAGIC = 'OBSC'
+VERSION = 1
+HEADER = struct.Struct('<4sIQQ')
+JSON_EXT = '.json'
+SIDECAR_EXT = '.bin'
+
+# Ring types
+RING_FLOAT = 0
+RING_INT = 1
+RING_DTYPES = {RING_FLOAT: np.dtype('<f8'), RING_INT: np.dtype('<i8')}
+
+# Attributes of the objects and the boundaries kept in the metadata
+INSTANCE_ATTRS = ['label', 'id', 'deleted', 'verified', 'user', 'date']
+BOUNDARY_ATTRS = ['deleted', 'verified', 'user', 'date']
+
+# The sidecar file name of a json label file
+def sidecarFilename(jsonFile):
+    return os.path.splitext(jsonFile)[0] + SIDECAR_EXT
+
+# The json label file name of a sidecar
+def jsonFilename(sidecarFile):
+    return os.path.splitext(sidecarFile)[0] + JSON_EXT
+
+# Size and mtime identifying the content of a file
+def fileStamp(filename):
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+def padding(length):
+    return '\0' * (-length % 8)
+
+# Rename tmpFile to filename, replacing it
+def replaceFile(tmpFile, filename):
+    # Windows cannot rename over an existing file
+    if (os.name == 'nt' and os.path.exists(filename)):
+        os.remove(filename)
+    os.rename(tmpFile, filename)
+
+# Write annotation to a sidecar file. source is the json file it
+# corresponds to, its stamp is stored to detect later changes. The file
+# is written next to it and renamed, so that a sidecar that is still
+# memory-mapped is not truncated
+def writeSidecar(annotation, sidecarFile, source=None):
+    objects = []
+    rings = []
+    for obj in annotation.objects:
+        meta = dict((attr, getattr(obj, attr)) for attr in INSTANCE_ATTRS)
+        meta['rings'] = len(obj.polygon)
+        objects.append(meta)
+        rings.extend(obj.polygon)
+    meta = {'imgWidth': annotation.imgWidth,
+            'imgHeight': annotation.imgHeight,
+            'objects': objects,
+            'source': fileStamp(source) if source else None}
+    if (annotation.boundaries):
+        boundaries = dict((attr, getattr(annotation.boundaries, attr)) for attr in BOUNDARY_ATTRS)
+        boundaries['rings'] = len(annotation.boundaries.polygon)
+        meta['boundaries'] = boundaries
+        rings.extend(annotation.boundaries.polygon)
+    metaText = json.dumps(meta, sort_keys=True, separators=(',', ':'))
+
+    types = np.array([RING_INT if ring.points.dtype.kind == 'i' else RING_FLOAT
+                      for ring in rings], np.uint8)
+    offsets = np.zeros(len(rings) + 1, '<u8')
+    offsets[1:] = np.cumsum([ring.points.size * 8 for ring in rings])
+
+    tmpFile = sidecarFile + '.tmp'
+    with open(tmpFile, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(metaText), len(rings)))
+        f.write(metaText + padding(len(metaText)))
+        f.write(offsets.tobytes())
+        f.write(types.tobytes() + padding(len(types)))
+        for ring, ringType in zip(rings, types):
+            f.write(ring.points.astype(RING_DTYPES[ringType], copy=False).tobytes())
+    replaceFile(tmpFile, sidecarFile)
+
+# Read a sidecar file into annotation. The points stay in the
+# memory-mapped file until they are used, writing to them does not change
+# the file. Returns the metadata
+def readSidecar(sidecarFile, annotation):
+    data = np.memmap(sidecarFile, dtype=np.uint8, mode='c')
+    magic, version, metaLength, ringCount = HEADER.unpack(data[:HEADER.size].tobytes())
+    if (magic != MAGIC or version != VERSION):
+        raise ValueError("{0} is not a label sidecar file".format(sidecarFile))
+    pos = HEADER.size
+    meta = json.loads(data[pos:pos + metaLength].tobytes())
+    pos += metaLength + len(padding(metaLength))
+    # Offsets in values, not bytes
+    offsets = (np.frombuffer(data[pos:pos + (ringCount + 1) * 8].tobytes(), '<u8') // 8).tolist()
+    pos += (ringCount + 1) * 8
+    types = np.asarray(data[pos:pos + ringCount]).tolist()
+    pos += ringCount + len(padding(ringCount))
+    values = dict((ringType, np.asarray(data[pos:]).view(dtype))
+                  for ringType, dtype in RING_DTYPES.items())
+
+    # The rings first to first + count - 1 as views into the file. The
+    # objects call it when their polygon is first used
+    def rings(first, count):
+        return [PolygonRing(values[types[k]][offsets[k]:offsets[k + 1]])
+                for k in range(first, first + count)]
+
+    annotation.imgWidth = int(meta['imgWidth'])
+    annotation.imgHeight = int(meta['imgHeight'])
+    annotation.objects = []
+    k = 0
+    for objMeta in meta['objects']:
+        obj = AnnInstance()
+        for attr in INSTANCE_ATTRS:
+            setattr(obj, attr, objMeta[attr])
+        obj.label = str(obj.label)
+        obj.setPolygonLoader(functools.partial(rings, k, objMeta['rings']))
+        obj.draw = obj.deleted != 1
+        k += objMeta['rings']
+        annotation.objects.append(obj)
+    annotation.boundaries = None
+    if (meta.get('boundaries') is not None):
+        annotation.boundaries = AnnBoundary()
+        for attr in BOUNDARY_ATTRS:
+            setattr(annotation.boundaries, attr, meta['boundaries'][attr])
+        annotation.boundaries.setPolygonLoader(functools.partial(rings, k, meta['boundaries']['rings']))
+        annotation.boundaries.draw = annotation.boundaries.deleted != 1
+    return meta
+
+# Whether the sidecar of jsonFile exists and was made from its current content
+def sidecarIsCurrent(jsonFile, sidecarFile=None):
+    sidecarFile = sidecarFile or sidecarFilename(jsonFile)
+    if (not os.path.isfile(sidecarFile) or not os.path.isfile(jsonFile)):
+        return False
+    try:
+        with open(sidecarFile, 'rb') as f:
+            magic, version, metaLength, ringCount = HEADER.unpack(f.read(HEADER.size))
+            if (magic != MAGIC or version != VERSION):
+                return False
+            meta = json.loads(f.read(metaLength))
+    except (IOError, ValueError, struct.error):
+        return False
+    return meta.get('source') == fileStamp(jsonFile)
+
+# Read a json label file into annotation, from its sidecar if that is current
+def readLabels(jsonFile, annotation):
+    if (sidecarIsCurrent(jsonFile)):
+        readSidecar(sidecarFilename(jsonFile), annotation)
+    else:
+        annotation.fromJsonFile(jsonFile)
+
+# Write annotation to a json label file and update its sidecar if there
+# is one. The json file is written next to it and renamed, so that it is
+# never left half written
+def writeLabels(jsonFile, annotation, compact=False, precision=None):
+    tmpFile = jsonFile + '.tmp'
+    try:
+        annotation.toJsonFile(tmpFile, compact, precision)
+        replaceFile(tmpFile, jsonFile)
+    finally:
+        if (os.path.exists(tmpFile)):
+            os.remove(tmpFile)
+    if (os.path.isfile(sidecarFilename(jsonFile))):
+        writeSidecar(annotation, sidecarFilename(jsonFile), source=jsonFile)
+
+# Convert a json label file to its sidecar, returns the sidecar file name
+def jsonToSidecar(jsonFile, sidecarFile=None):
+    sidecarFile = sidecarFile or sidecarFilename(jsonFile)
+    annotation = Annotation()
+    annotation.fromJsonFile(jsonFile)
+    writeSidecar(annotation, sidecarFile, source=jsonFile)
+    return sidecarFile
+
+# Convert a sidecar back to a json label file, returns the json file name
+def sidecarToJson(sidecarFile, jsonFile=None, compact=False, precision=None):
+    jsonFile = jsonFile or jsonFilename(sidecarFile)
+    annotation = Annotation()
+    readSidecar(sidecarFile, annotation)
+    annotation.toJsonFile(jsonFile, compact, precision)
+    return jsonFile
+
+# Whether the json file and its sidecar give the same json text
+def checkRoundTrip(jsonFile, sidecarFile=None):
+    sidecarFile = sidecarFile or sidecarFilename(jsonFile)
+    fromJson = Annotation()
+    fromJson.fromJsonFile(jsonFile)
+    fromSidecar = Annotation()
+    readSidecar(sidecarFile, fromSidecar)
+    return fromJson.toJsonText() == fromSidecar.toJsonText()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert label files to binary sidecars and back")
+    parser.add_argument('files', nargs='+', help="label files (.polygons.json, or sidecars with --to-json)")
+    parser.add_argument('--to-json', action='store_true',
+                        help="write the json label files from the sidecars")
+    parser.add_argument('--check', action='store_true',
+                        help="check that the json file and the sidecar give the same labels")
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for filename in args.files:
+        try:
+            if (args.to_json):
+                filename = sidecarToJson(filename)
+            else:
+                jsonToSidecar(filename)
+            if (args.check and not checkRoundTrip(filename)):
+                print('{0}: sidecar and json differ'.format(filename))
+                failed += 1
+        except (IOError, ValueError) as e:
+            print('{0}: {1}'.format(filename, e))
+            failed += 1
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
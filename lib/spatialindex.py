@@ -0,0 +1,124 @@
+"""
+A uniform grid over bounding boxes, to find the objects under a point or
+the edges near an edge without testing every one.
+
+Copyright (c) 2018- Guoxia Wang
+mingzilaochongtu at gmail com
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+The Software is provided "as is", without warranty of any kind.
+
+"""
+import math
+
+class GridIndex(object):
+    """
+    Map keys to bounding boxes (xmin, ymin, xmax, ymax). Every box is
+    registered in the grid cells it overlaps, a query only looks at the
+    boxes of the cell of the point. Boxes overlapping more than maxCells
+    cells are not put in the cells but kept aside and always tested, so
+    that adding or moving a big box stays cheap.
+    """
+    def __init__(self, cellSize=64, maxCells=256):
+        self.cellSize = float(cellSize)
+        self.maxCells = maxCells
+        # Cell (col, row) -> set of keys
+        self.cells = {}
+        # Key -> box
+        self.boxes = {}
+        # Keys of the boxes kept aside
+        self.oversized = set()
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def clear(self):
+        self.cells = {}
+        self.boxes = {}
+        self.oversized = set()
+
+    # The first and last column and row of the cells a box overlaps
+    def cellRange(self, box):
+        xmin, ymin, xmax, ymax = box
+        return (int(math.floor(xmin / self.cellSize)), int(math.floor(ymin / self.cellSize)),
+                int(math.floor(xmax / self.cellSize)), int(math.floor(ymax / self.cellSize)))
+
+    # The cells (col, row) a box overlaps
+    def boxCells(self, box):
+        c0, r0, c1, r1 = self.cellRange(box)
+        return [(c, r) for r in range(r0, r1 + 1) for c in range(c0, c1 + 1)]
+
+    # Whether the box overlaps too many cells to be put in them
+    def isOversized(self, box):
+        c0, r0, c1, r1 = self.cellRange(box)
+        return (c1 - c0 + 1) * (r1 - r0 + 1) > self.maxCells
+
+    # Add or replace the box of key, a box of None removes the key
+    def update(self, key, box):
+        self.remove(key)
+        if (box is None):
+            return
+        self.boxes[key] = box
+        if (self.isOversized(box)):
+            self.oversized.add(key)
+            return
+        for cell in self.boxCells(box):
+            self.cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        box = self.boxes.pop(key, None)
+        if (box is None):
+            return
+        if (key in self.oversized):
+            self.oversized.discard(key)
+            return
+        for cell in self.boxCells(box):
+            keys = self.cells[cell]
+            keys.discard(key)
+            if (not keys):
+                del self.cells[cell]
+
+    # Keys whose box overlaps box (xmin, ymin, xmax, ymax), borders included
+    def queryBox(self, box):
+        result = set(key for key in self.oversized if boxesIntersect(self.boxes[key], box))
+        if (self.isOversized(box)):
+            # Fewer boxes than cells to look at
+            result.update(key for key, keyBox in self.boxes.items() if boxesIntersect(keyBox, box))
+            return result
+        for cell in self.boxCells(box):
+            for key in self.cells.get(cell, ()):
+                if (boxesIntersect(self.boxes[key], box)):
+                    result.add(key)
+        return result
+
+    # Keys whose box contains the point (x, y), borders included
+    def query(self, x, y):
+        cell = (int(math.floor(x / self.cellSize)), int(math.floor(y / self.cellSize)))
+        result = []
+        for key in self.cells.get(cell, ()):
+            xmin, ymin, xmax, ymax = self.boxes[key]
+            if (xmin <= x <= xmax and ymin <= y <= ymax):
+                result.append(key)
+        for key in self.oversized:
+            xmin, ymin, xmax, ymax = self.boxes[key]
+            if (xmin <= x <= xmax and ymin <= y <= ymax):
+                result.append(key)
+        return result
+
+# The smallest box containing the boxes a and b, either may be None
+def unionBox(a, b):
+    if (a is None):
+        return b
+    if (b is None):
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+# Whether the boxes a and b overlap, touching borders included
+def boxesIntersect(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
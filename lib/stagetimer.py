@@ -0,0 +1,63 @@
+"""
+Record the duration and some counts of the stages of a computation.
+
+Copyright (c) 2018- Guoxia Wang
+mingzilaochongtu at gmail com
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+The Software is provided "as is", without warranty of any kind.
+
+"""
+import time
+import contextlib
+
+class StageTimer(object):
+    """
+    Collect per stage statistics, e.g.
+
+        timer = StageTimer()
+        with timer.stage('thin') as stats:
+            edgeim = bwmorph.thin(edgeim)
+            stats['pixels'] = int(edgeim.sum())
+            stats['bytes'] = edgeim.nbytes
+
+    The stages are kept in the order they finished as (name, seconds, stats).
+    """
+    def __init__(self):
+        self.stages = []
+
+    # Time the enclosed block, the yielded dict takes the counts of the stage
+    @contextlib.contextmanager
+    def stage(self, name):
+        stats = {}
+        start = time.time()
+        try:
+            yield stats
+        finally:
+            self.stages.append((name, time.time() - start, stats))
+
+    # Total seconds of all stages
+    def total(self):
+        return sum(seconds for name, seconds, stats in self.stages)
+
+    # Plain values, suitable for json and for passing between processes
+    def toDict(self):
+        stages = []
+        for name, seconds, stats in self.stages:
+            stage = dict(stats)
+            stage['name'] = name
+            stage['ms'] = round(seconds * 1000, 3)
+            stages.append(stage)
+        return {'ms': round(self.total() * 1000, 3), 'stages': stages}
+
+    # One line for the status bar
+    def summary(self):
+        text = ', '.join('{0} {1:.0f} ms'.format(name, seconds * 1000)
+                         for name, seconds, stats in self.stages)
+        return 'Total {0:.0f} ms: {1}'.format(self.total() * 1000, text)
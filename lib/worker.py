@@ -13,134 +13,42 @@ The Software is provided "as is", without warranty of any kind.
 
 """
 from PyQt4 import QtCore, QtGui
-import numpy as np
-import cv2
 import os
-import getpass
+import multiprocessing
 
-from edgelink import edgelink
+from annotation import Annotation
+from convert import BoundariesConverter, convertAnnotation, convertAnnotationFile, logStats, ignoreInterrupt, SKIPPED, FAILED, EXISTS
+from stagetimer import StageTimer
+from sidecar import readLabels, writeLabels
+from prefetch import fileKey
 
-from annotation import Point, Annotation, AnnBoundary
-
-class ConvertToBoundariesWorker(QtCore.QObject):
+class ConvertToBoundariesWorker(QtCore.QObject, BoundariesConverter):
     """
     Make a new thread instance to convert to boundaries 
     from a segment map
     """
-    finishedSignal = QtCore.pyqtSignal(list)
-    def __init__(self, objects=None, height=0, width=0):
+    # The converted polygon, a list of PolygonRing
+    finishedSignal = QtCore.pyqtSignal(object)
+    # The StageTimer of the finished conversion
+    statsSignal = QtCore.pyqtSignal(object)
+    def __init__(self, objects=None, height=0, width=0, tolerance=0.0):
         QtCore.QObject.__init__(self)
-        self.objects = objects
-        self.segmentMap = np.zeros((height, width), np.uint8)
-
-    def setObjects(self, objects):
-        self.objects = objects
-
-    def setSegmentMap(self, height, width):
-        self.segmentMap = np.zeros((height, width), np.uint8)
+        BoundariesConverter.__init__(self, objects, height, width, tolerance)
 
     # Segment map convert to boundary list
     def convertToBoundaries(self):
-        # First, we fill all labels to numpy ndarray
-        count = 1
-        for obj in self.objects:
-            for poly in obj.polygon:
-                pts = []
-                for pt in poly:
-                    pts.append([pt.x, pt.y])
-                pts = np.around(pts).astype(np.int32)
-                cv2.fillPoly(self.segmentMap, [pts], count)
-            count += 1
-
-        # Second, we convert to boundary map from segment map
-        edgeMap = self.segmentationMapToBoundaryMap(self.segmentMap)
-        # Third, we get edge fragments
-        edgelist, edgeim, etype = edgelink(edgeMap)
-        polygon = []
-        for edge in edgelist:
-            if (len(edge) < 5):
-                continue
-            # Auto correct occlusion boundary direction
-            if (self.isNeedReverse(edge)):
-                edge.reverse()
-            # Convert to QPolygonF
-            poly = []
-            for pt in edge:
-                point = Point(pt[1], pt[0])
-                poly.append(point)
-            polygon.append(poly)
+        timer = StageTimer()
+        polygon = BoundariesConverter.convertToBoundaries(self, timer)
         self.finishedSignal.emit(polygon)
+        self.statsSignal.emit(timer)
         return polygon
 
-    # Label segmentation map to boundary map
-    def segmentationMapToBoundaryMap(self, segment):
-        height, width = segment.shape
-        boundary = np.zeros((2*height+1, 2*width+1), np.uint8)
-        # Find vertical direction difference
-        edgelsV = (segment[0:-1, :] != segment[1:, :]).astype(np.uint8)
-        # Add a zero row
-        edgelsV = np.vstack([edgelsV, np.zeros((1, width), dtype=np.uint8)])
-        # Find horizontal direction difference
-        edgelsH = (segment[:,0:-1] != segment[:, 1:]).astype(np.uint8)
-        # Append a zero column
-        edgelsH = np.hstack([edgelsH, np.zeros((height, 1), dtype=np.uint8)])
-
-        # Assign to boundary
-        boundary[2::2, 1::2] = edgelsV
-        boundary[1::2, 2::2] = edgelsH
-
-        # Get boundary
-        boundary[2:-1:2, 2:-1:2] = np.maximum(
-            np.maximum(edgelsH[0:-1, 0:-1], edgelsH[1:, 0:-1]),
-            np.maximum(edgelsV[0:-1, 0:-1], edgelsV[0:-1, 1:]))
-
-        boundary[0, :] = boundary[1, :]
-        boundary[:, 0] = boundary[:, 1]
-        boundary[-1, :] = boundary[-2, :]
-        boundary[:, -1] = boundary[:, -2]
-
-        boundary = boundary[2::2, 2::2]
-        return boundary
-
-    # Check one edge occluison direction, and return true if need reverse
-    def isNeedReverse(self, edge):
-        height, width = self.segmentMap.shape
-
-        step = 3
-        posDirCount = 0
-        totalCount = len(edge) / step
-        for i in range(totalCount):
-            idx = i * step
-            pt1 = QtCore.QPointF(edge[idx][1], edge[idx][0])
-            idx = (i + 1) * step
-            if (idx >= len(edge)):
-                idx = -1
-            pt2 = QtCore.QPointF(edge[idx][1], edge[idx][0])
-
-            line1 = QtCore.QLineF(pt1, pt2)
-            line1 = line1.normalVector()
-            pt3 = line1.p2()
-            pt3.setX(min(max(pt3.x(), 0), width-1))
-            pt3.setY(min(max(pt3.y(), 0), height-1))
-
-            pt4 = QtCore.QPointF(line1.x1() - line1.dx(), line1.y1() - line1.dy())
-            pt4.setX(min(max(pt4.x(), 0), width-1))
-            pt4.setY(min(max(pt4.y(), 0), height-1))
-            
-            if (self.segmentMap[int(pt3.y()), int(pt3.x())] >=
-                self.segmentMap[int(pt4.y()), int(pt4.x())]):
-                posDirCount += 1
-        ratio = float(posDirCount) / np.ceil(float(totalCount))
-        # If ratio greater than the threshold, we dont need to reverse the edge
-        if (ratio > 0.3):
-            return False
-        else:
-            return True
-
 class BatchConvertToBoundariesWorker(QtCore.QObject):
     """
     Make a new thread instance to batch convert to occlusion boundary labels
-    from instance labels
+    from instance labels. With jobs > 1 the conversions are fanned out to a
+    process pool and written as they complete, while the user prompts
+    still run one by one on this thread.
     """
     updateProgress = QtCore.pyqtSignal(int, str)
     finished = QtCore.pyqtSignal()
@@ -148,6 +56,8 @@ class BatchConvertToBoundariesWorker(QtCore.QObject):
     
     # Flag indicate cancel by user
     canceled = False
+    # Whether the user chose to overwrite all existing boundary labels
+    overwriteAll = False
     # User selected operation
     userOperationResult = -1
 
@@ -155,23 +65,36 @@ class BatchConvertToBoundariesWorker(QtCore.QObject):
     mutex = QtCore.QMutex()
     waitCondition = QtCore.QWaitCondition()
 
-    def __init__(self, imageList, imageDir, gtExt):
+    def __init__(self, imageList, imageDir, gtExt, jobs=1, saveOptions=None, tolerance=0.0):
         QtCore.QObject.__init__(self)
         self.imageDir = imageDir
         self.imageList = imageList
         self.gtExt = gtExt
+        # Number of worker processes, 1 converts on this thread
+        self.jobs = max(int(jobs), 1)
+        # Keyword arguments of Annotation.toJsonFile
+        self.saveOptions = saveOptions
+        # Boundary simplification tolerance in pixels, 0 keeps all points
+        self.tolerance = tolerance
 
     def stop(self):
         self.canceled = True
 
-    def batchConvertToBoundaries(self):
-        overwriteAll = False
-        annotation = Annotation()
-        worker = ConvertToBoundariesWorker()
-        # Convert each image
+    # Show a message box through the GUI thread and wait for the answer
+    def askUser(self, infoType, text):
+        self.mutex.lock()
+        self.information.emit(infoType, text)
+        self.waitCondition.wait(self.mutex)
+        self.mutex.unlock()
+        return self.userOperationResult
+
+    # Iterate over the label files of the images. Yields (idx, gtfilename,
+    # filename), asking the user about missing files on the way. A yield
+    # of None means the image was skipped.
+    def labelFiles(self):
         for idx, filename in enumerate(self.imageList):
             if (self.canceled):
-                break
+                return
 
             # get label json file name
             imageExt = os.path.splitext(filename)[1]
@@ -179,76 +102,289 @@ class BatchConvertToBoundariesWorker(QtCore.QObject):
             filename = os.path.join(self.imageDir, gtfilename)
             filename = os.path.normpath(filename)
 
-            # Update progress dialog
-            self.updateProgress.emit(idx + 1, "Converting {0}".format(gtfilename))
-
             # Check if label json file exist
             if (not os.path.isfile(filename)):
                 text = "{0} not exist. Continue?".format(filename)
-                self.mutex.lock()
-                self.information.emit("IOError", text)
-                self.waitCondition.wait(self.mutex)
-                self.mutex.unlock()
-                if (self.userOperationResult == QtGui.QMessageBox.Yes):
+                if (self.askUser("IOError", text) == QtGui.QMessageBox.Yes):
+                    yield None
                     continue
                 else:
-                    break
-                
+                    return
+
+            yield (idx, gtfilename, filename)
+
+    # Ask whether to overwrite the occlusion boundary labels of filename,
+    # unless the user already answered yes to all. Returns whether to
+    def askOverwrite(self, filename):
+        if (self.overwriteAll):
+            return True
+        text = "{0} already exists occlusion boundary labels. Do you want to overwrite?".format(filename)
+        result = self.askUser("Overwrite", text)
+        if (result == QtGui.QMessageBox.YesToAll):
+            self.overwriteAll = True
+        return result != QtGui.QMessageBox.No
+
+    # Iterate over the label files that need converting.
+    # Yields (idx, gtfilename, filename, annotation), asking the user about
+    # missing files, parse errors and existing boundaries on the way.
+    # A yield of None means the image was skipped.
+    def labelFilesToConvert(self):
+        for task in self.labelFiles():
+            if (task is None):
+                yield None
+                continue
+            idx, gtfilename, filename = task
+
             try:
                 annotation = Annotation()
                 annotation.fromJsonFile(filename)
             except StandardError  as e:
                 text = "Error parsing labels in {0}. \nContinue?".format(filename)
-                self.mutex.lock()
-                self.information.emit("IOError", text)
-                self.waitCondition.wait(self.mutex)
-                self.mutex.unlock()
-                if (self.userOperationResult == QtGui.QMessageBox.Yes):
+                if (self.askUser("IOError", text) == QtGui.QMessageBox.Yes):
+                    yield None
                     continue
                 else:
-                    break
+                    return
 
             # Skip all image of has no instance labels
             if (not annotation.objects):
+                yield None
                 continue
 
             # Check if it has occlusion boundary label
-            if (not overwriteAll and annotation.boundaries):
-                text = "{0} already exists occlusion boundary labels. Do you want to overwrite?".format(filename)
-                self.mutex.lock()
-                self.information.emit("Overwrite", text)
-                self.waitCondition.wait(self.mutex)
-                self.mutex.unlock()
-                if (self.userOperationResult == QtGui.QMessageBox.No):
+            if (annotation.boundaries and not self.askOverwrite(filename)):
+                yield None
+                continue
+
+            yield (idx, gtfilename, filename, annotation)
+
+    def batchConvertToBoundaries(self):
+        self.overwriteAll = False
+        if (self.jobs > 1):
+            self.parallelBatchConvertToBoundaries()
+        else:
+            self.serialBatchConvertToBoundaries()
+        self.finished.emit()
+
+    # Convert each image one after another on this thread
+    def serialBatchConvertToBoundaries(self):
+        for task in self.labelFilesToConvert():
+            if (task is None):
+                continue
+            idx, gtfilename, filename, annotation = task
+
+            # Update progress dialog
+            self.updateProgress.emit(idx + 1, "Converting {0}".format(gtfilename))
+
+            timer = StageTimer()
+            error = convertAnnotation(annotation, filename, timer, self.saveOptions, self.tolerance)
+            logStats(filename, timer.toDict())
+            if (error):
+                text = "{0}. \nContinue?".format(error)
+                if (self.askUser("IOError", text) != QtGui.QMessageBox.Yes):
+                    break
+
+    # Fan the conversions out to a process pool and collect the results as
+    # they complete. The label files are only read by the pool jobs, which
+    # report parse errors and existing boundaries for the prompts here
+    def parallelBatchConvertToBoundaries(self):
+        pool = multiprocessing.Pool(processes=self.jobs, initializer=ignoreInterrupt)
+        # Keep the pool busy without queueing the whole list
+        maxPending = 2 * self.jobs
+        pending = []
+        self.done = 0
+        stopped = False
+        try:
+            for n, task in enumerate(self.labelFiles()):
+                if (task is None):
+                    self.done += 1
+                    self.updateProgress.emit(self.done, "Skipped {0}".format(self.imageList[n]))
                     continue
-                elif (self.userOperationResult == QtGui.QMessageBox.YesToAll):
-                    overwriteAll = True
-
-            height = annotation.imgHeight
-            width = annotation.imgWidth
-            worker.setObjects(annotation.objects)
-            worker.setSegmentMap(height, width)
-            polygon = worker.convertToBoundaries()
-
-            # Create a new boundary object
-            boundaries = AnnBoundary()
-            boundaries.polygon = polygon 
-            boundaries.deleted = 0
-            boundaries.verified = 0
-            boundaries.user = getpass.getuser()
-            boundaries.updateDate()
-            annotation.boundaries = boundaries
+                idx, gtfilename, filename = task
+                pending.append(self.submit(pool, idx, filename, self.overwriteAll))
+                # Write out what has finished, wait if the pool is full
+                stopped = not self.collectResults(pool, pending, block=len(pending) >= maxPending)
+                if (stopped or self.canceled):
+                    break
+
+            while (pending and not stopped and not self.canceled):
+                stopped = not self.collectResults(pool, pending, block=True)
+        finally:
+            # Let the queued jobs finish, killing one could leave a temporary
+            # label file behind. There are at most maxPending of them
+            pool.close()
+            pool.join()
+
+    # Queue the conversion of a label file to the pool
+    def submit(self, pool, idx, filename, overwrite):
+        task = (idx, filename, overwrite, self.saveOptions, self.tolerance)
+        return pool.apply_async(convertAnnotationFile, [task])
+
+    # Handle finished jobs and remove them from the pending list.
+    # With block set, wait until at least one job has finished.
+    # Returns False if the user wants to stop.
+    def collectResults(self, pool, pending, block=False):
+        ready = []
+        while (not self.canceled):
+            ready = [r for r in pending if r.ready()]
+            if (ready or not block):
+                break
+            pending[0].wait(0.1)
+        for result in ready:
+            pending.remove(result)
+            idx, filename, status, message, stats = result.get()
+            # Convert it again once the user agrees to overwrite
+            if (status == EXISTS):
+                if (self.askOverwrite(filename)):
+                    pending.append(self.submit(pool, idx, filename, True))
+                    continue
+            logStats(filename, stats)
+            self.done += 1
+            action = "Skipped" if status in (SKIPPED, EXISTS) else "Converted"
+            self.updateProgress.emit(self.done, "{0} {1}".format(action, os.path.basename(filename)))
+            if (status == FAILED):
+                text = "{0}. \nContinue?".format(message)
+                if (self.askUser("IOError", text) != QtGui.QMessageBox.Yes):
+                    return False
+        return True
+
+class PrefetchWorker(QtCore.QObject):
+    """
+    Load images and their labels into a PrefetchCache ahead of time.
+    Lives on its own thread, the GUI thread calls request() with the files
+    it will likely need next. A newer request supersedes the files of an
+    older one that are not loaded yet.
+    """
+    # Emitted with the request when all its files are cached
+    finished = QtCore.pyqtSignal(object)
+    # Queued to this thread by request()
+    requested = QtCore.pyqtSignal(object)
+
+    def __init__(self, cache):
+        QtCore.QObject.__init__(self)
+        self.cache = cache
+        # The latest request, a list of (imageFile, labelFile)
+        self.wanted = []
+        self.canceled = False
+        self.requested.connect(self.prefetch)
+
+    def stop(self):
+        self.canceled = True
+        self.wanted = []
+
+    # Ask to load the given (imageFile, labelFile) pairs, nearest first
+    def request(self, files):
+        files = list(files)
+        self.wanted = files
+        self.requested.emit(files)
+
+    @QtCore.pyqtSlot(object)
+    def prefetch(self, files):
+        for imageFile, labelFile in files:
+            if (self.canceled or files is not self.wanted):
+                return
+            self.loadImage(imageFile)
+            if (self.canceled or files is not self.wanted):
+                return
+            if (labelFile):
+                self.loadLabels(labelFile)
+        self.finished.emit(files)
+
+    # QImage, unlike QPixmap, can be made outside the GUI thread
+    def loadImage(self, filename):
+        key = fileKey(filename)
+        if (key is None or self.cache.touch(key)):
+            return
+        image = QtGui.QImage(filename)
+        if (not image.isNull()):
+            self.cache.put(key, image)
+
+    # Files that fail to parse are left to the GUI thread to report
+    def loadLabels(self, filename):
+        key = fileKey(filename)
+        if (key is None or self.cache.touch(key)):
+            return
+        try:
+            annotation = Annotation()
+            readLabels(filename, annotation)
+        except StandardError as e:
+            return
+        self.cache.put(key, annotation)
+
+class LabelSaveWorker(QtCore.QObject):
+    """
+    Write label files on its own thread. save() takes a copy of the
+    annotation that is not changed afterwards. Only the latest copy of a
+    file waiting to be written is kept, and files are written one at a
+    time, so writes to the same file never overlap or go out of order.
+    """
+    # Emitted with the file name when it was written
+    saved = QtCore.pyqtSignal(str)
+    # Emitted with the file name and the error message
+    failed = QtCore.pyqtSignal(str, str)
+    # Queued to this thread by save()
+    requested = QtCore.pyqtSignal()
+
+    def __init__(self):
+        QtCore.QObject.__init__(self)
+        self.mutex = QtCore.QMutex()
+        # File name -> (annotation, saveOptions) waiting to be written
+        self.pending = {}
+        # File name -> annotation being written
+        self.writing = {}
+        self.requested.connect(self.writePending)
+
+    # Queue annotation to be written to filename
+    def save(self, filename, annotation, saveOptions=None):
+        self.mutex.lock()
+        self.pending[filename] = (annotation, saveOptions or {})
+        self.mutex.unlock()
+        self.requested.emit()
+
+    # The latest annotation queued or being written to filename, or None.
+    # It is what the file will contain once written, do not change it
+    def pendingAnnotation(self, filename):
+        self.mutex.lock()
+        if (filename in self.pending):
+            annotation = self.pending[filename][0]
+        else:
+            annotation = self.writing.get(filename)
+        self.mutex.unlock()
+        return annotation
+
+    def isIdle(self):
+        self.mutex.lock()
+        idle = not self.pending and not self.writing
+        self.mutex.unlock()
+        return idle
+
+    # Write everything queued, also called on the GUI thread to flush
+    # what is left once this thread has stopped
+    @QtCore.pyqtSlot()
+    def writePending(self):
+        while (True):
+            self.mutex.lock()
+            if (not self.pending):
+                self.mutex.unlock()
+                return
+            filename, (annotation, saveOptions) = self.pending.popitem()
+            self.writing[filename] = annotation
+            self.mutex.unlock()
+
             try:
-                annotation.toJsonFile(filename)
-            except StandardError  as e:
-                text = "Error writting labels to {0}. \nContinue?".format(filename)
+                writeLabels(filename, annotation, **saveOptions)
+                error = None
+            except StandardError as e:
+                # Odd data fails as well as the disk, the edits must not
+                # be lost silently either way
+                message = e.strerror if isinstance(e, EnvironmentError) and e.strerror else str(e)
+                error = "Error writting labels to {0}. Message: {1}".format(filename, message)
+            finally:
                 self.mutex.lock()
-                self.information.emit("IOError", text)
-                self.waitCondition.wait(self.mutex)
+                del self.writing[filename]
                 self.mutex.unlock()
-                if (self.userOperationResult == QtGui.QMessageBox.Yes):
-                    continue
-                else:
-                    break
-            
-        self.finished.emit()
+
+            if (error):
+                self.failed.emit(filename, error)
+            else:
+                self.saved.emit(filename)
@@ -0,0 +1,461 @@
+"""
+Equivalence tests of the optimized boundary conversion against the
+implementations it replaced, which are kept as references.
+
+Usage: python -m unittest discover tests
+
+Copyright (c) 2018- Guoxia Wang
+mingzilaochongtu at gmail com
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+The Software is provided "as is", without warranty of any kind.
+
+"""
+import os
+import sys
+import math
+import unittest
+import numpy as np
+import scipy.ndimage
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib.convert import BoundariesConverter
+from lib.edgelink import edgelink
+from lib import bwmorph
+from lib.geometry import polygonIsValid, polylineCanExtend, EdgeIndex, BoundaryMap, simplifyPolylines, closestPoint
+
+# A converter with a segment map of random filled polygons labeled 1..n
+def randomConverter(rng, maxSize=200, maxObjects=8):
+    height, width = rng.randint(20, maxSize, 2)
+    converter = BoundariesConverter(None, height, width)
+    converter.segmentMap = np.zeros((height, width), np.uint8)
+    for k in range(rng.randint(1, maxObjects)):
+        pts = rng.rand(rng.randint(3, 10), 2) * [width * 1.2, height * 1.2] - [width * 0.1, height * 0.1]
+        cv2.fillPoly(converter.segmentMap, [pts.astype(np.int32)], k + 1)
+    return converter
+
+class EdgesNeedReverseTest(unittest.TestCase):
+    def test_same_as_per_edge(self):
+        rng = np.random.RandomState(0)
+        edges = 0
+        for trial in range(30):
+            converter = randomConverter(rng)
+            boundaryMap = converter.segmentationMapToBoundaryMap(converter.segmentMap)
+            edgelist = [edge for edge in edgelink(boundaryMap)[0] if len(edge) >= 3]
+            expected = [converter.isNeedReverse(edge) for edge in edgelist]
+            self.assertEqual(list(converter.edgesNeedReverse(edgelist)), expected)
+            edges += len(edgelist)
+        self.assertGreater(edges, 100)
+
+    def test_no_edges(self):
+        converter = BoundariesConverter(None, 10, 10)
+        self.assertEqual(len(converter.edgesNeedReverse([])), 0)
+
+# Edge lists as nested int lists, whatever the point types
+def edgeLists(edgelist):
+    return [[[int(r), int(c)] for r, c in edge] for edge in edgelist]
+
+class BoundaryMapTest(unittest.TestCase):
+    def test_same_as_full(self):
+        converter = BoundariesConverter()
+        rng = np.random.RandomState(0)
+        for trial in range(1000):
+            height, width = rng.randint(1, 30, 2)
+            segmentMap = rng.randint(0, rng.randint(1, 5), (height, width)).astype(np.uint8)
+            expected = converter.segmentationMapToBoundaryMapFull(segmentMap)
+            boundaryMap = converter.segmentationMapToBoundaryMap(segmentMap)
+            self.assertEqual(boundaryMap.dtype, expected.dtype)
+            self.assertTrue(np.array_equal(boundaryMap, expected))
+
+class EdgelinkTest(unittest.TestCase):
+    def test_fast_same_as_tracking(self):
+        rng = np.random.RandomState(1)
+        for trial in range(40):
+            converter = randomConverter(rng, maxSize=300, maxObjects=15)
+            boundaryMap = converter.segmentationMapToBoundaryMap(converter.segmentMap)
+            if (trial % 4 == 0):
+                # A noisy edge map, with many junctions
+                boundaryMap = (rng.rand(*boundaryMap.shape) < 0.2).astype(np.uint8)
+            slowEdges, slowImage, slowJunctions = edgelink(boundaryMap, fast=False)
+            fastEdges, fastImage, fastJunctions = edgelink(boundaryMap)
+            self.assertEqual(edgeLists(fastEdges), edgeLists(slowEdges))
+            self.assertEqual(fastJunctions, slowJunctions)
+            self.assertEqual(fastImage.dtype, slowImage.dtype)
+            self.assertTrue(np.array_equal(fastImage, slowImage))
+
+class BwmorphTest(unittest.TestCase):
+    def test_front_same_as_full_passes(self):
+        rng = np.random.RandomState(1)
+        for trial in range(150):
+            height, width = rng.randint(1, 60, 2)
+            image = (rng.rand(height, width) < rng.uniform(0.1, 0.9)).astype(np.uint8)
+            if (trial % 3 == 0):
+                image = scipy.ndimage.binary_dilation(image, iterations=2).astype(np.uint8)
+            for n_iter in (None, 1, 2):
+                self.assertTrue(np.array_equal(
+                    bwmorph._bwmorph_luts(image, bwmorph.THIN_LUTS, n_iter, front=True),
+                    bwmorph._bwmorph_luts(image, bwmorph.THIN_LUTS, n_iter)))
+                self.assertTrue(np.array_equal(
+                    bwmorph._bwmorph_luts(image, [bwmorph.SPUR_LUT], n_iter, padding=1, front=True),
+                    bwmorph._bwmorph_luts(image, [bwmorph.SPUR_LUT], n_iter, padding=1)))
+
+# The intersection type QLineF.intersect gives for the lines p1p2 and q1q2:
+# 0 no intersection (parallel), 1 bounded, 2 unbounded
+def qtIntersect(p1, p2, q1, q2):
+    return qtIntersection(p1, p2, q1, q2)[0]
+
+# The intersection type and the intersection point QLineF.intersect
+# gives, the point is None for parallel lines
+def qtIntersection(p1, p2, q1, q2):
+    ax, ay = p2[0] - p1[0], p2[1] - p1[1]
+    bx, by = q1[0] - q2[0], q1[1] - q2[1]
+    cx, cy = p1[0] - q1[0], p1[1] - q1[1]
+    denominator = ay * bx - ax * by
+    if (denominator == 0 or not np.isfinite(denominator)):
+        return 0, None
+    reciprocal = 1 / denominator
+    na = (by * cx - bx * cy) * reciprocal
+    point = (p1[0] + ax * na, p1[1] + ay * na)
+    if (na < 0 or na > 1):
+        return 2, point
+    nb = (ax * cy - ay * cx) * reciprocal
+    if (nb < 0 or nb > 1):
+        return 2, point
+    return 1, point
+
+# Parallel lines of reverse direction, which count as intersecting
+def qtReverseParallel(p1, p2, q1, q2):
+    return (qtIntersect(p1, p2, q1, q2) == 0 and
+            (p2[0] - p1[0]) * (q2[0] - q1[0]) + (p2[1] - p1[1]) * (q2[1] - q1[1]) < 0)
+
+# The polygon check of the canvas before geometry, testing every edge pair
+def loopPolygonIsValid(poly):
+    n = len(poly)
+    for i in range(n - 1):
+        for j in range(i + 1, n):
+            k = (j + 1) % n
+            if (j == i + 1 or (k == 0 and i == 0)):
+                if (qtReverseParallel(poly[i], poly[i + 1], poly[j], poly[k])):
+                    return False
+            elif (qtIntersect(poly[i], poly[i + 1], poly[j], poly[k]) == 1):
+                return False
+    return True
+
+# The check of the canvas before geometry whether the drawn polyline can be
+# extended to pt
+def loopPolylineCanExtend(poly, pt):
+    if (len(poly) < 2):
+        return True
+    if (qtReverseParallel(poly[-2], poly[-1], poly[-1], pt)):
+        return False
+    for i in range(len(poly) - 2):
+        if (qtIntersect(poly[i], poly[i + 1], poly[-1], pt) == 1):
+            return False
+    return True
+
+# Random polygon points, including the degenerate cases of the canvas
+def randomPolygon(rng):
+    kind = rng.randint(6)
+    n = rng.randint(0, 40)
+    if (kind == 0):
+        # Star shaped
+        angles = np.sort(rng.rand(n)) * 2 * np.pi
+        radii = rng.uniform(5, 50, n)
+        return np.column_stack([100 + radii * np.cos(angles), 100 + radii * np.sin(angles)])
+    if (kind == 1):
+        return rng.rand(n, 2) * 100
+    if (kind == 2):
+        # Small integer grid, many collinear and repeated points
+        return rng.randint(0, 6, (n, 2)).astype(float)
+    if (kind == 3):
+        # Nearly collinear
+        origin, direction, t = rng.rand(2) * 1000, rng.randn(2), rng.rand(n) * 20
+        return origin + t[:, None] * direction + rng.randn(n, 2) * 1e-13 * rng.randint(0, 2)
+    if (kind == 4):
+        # Zoomed mouse positions
+        return rng.randint(0, 20, (n, 2)) / 3.0 + 0.1
+    # Star shaped with points inserted on an edge
+    angles = np.sort(rng.rand(n)) * 2 * np.pi
+    radii = rng.uniform(5, 50, n)
+    points = np.column_stack([100.3 + radii * np.cos(angles), 100.7 + radii * np.sin(angles)])
+    if (n > 2):
+        k = rng.randint(n - 1)
+        inserted = points[k] + rng.rand(3)[:, None] * (points[k + 1] - points[k])
+        points = np.concatenate([points[:k + 1], inserted, points[k + 1:]])
+    return points
+
+class PolygonValidationTest(unittest.TestCase):
+    def test_same_as_pair_loop(self):
+        rng = np.random.RandomState(0)
+        counts = [0, 0]
+        for trial in range(2000):
+            points = randomPolygon(rng)
+            poly = [tuple(pt) for pt in points.tolist()]
+            expected = loopPolygonIsValid(poly)
+            self.assertEqual(polygonIsValid(points), expected)
+            counts[expected] += 1
+            if (rng.rand() < 0.5 or not poly):
+                pt = tuple((rng.rand(2) * 100).tolist())
+            else:
+                pt = poly[rng.randint(len(poly))]
+            self.assertEqual(polylineCanExtend(points, pt), loopPolylineCanExtend(poly, pt))
+        self.assertGreater(min(counts), 100)
+
+# The length of the line from p1 to p2 as QLineF.length computes it
+def qtLength(p1, p2):
+    dx, dy = p2[0] - p1[0], p2[1] - p1[1]
+    return math.sqrt(dx * dx + dy * dy)
+
+# The point or edge of poly within 4 pixels of pt as the canvas looked
+# for it point by point and edge by edge: (i, i) for point i, (i, i + 1)
+# for the edge from point i, (-1, -1) if none is close enough. A point
+# wins over an edge and the first of equally close ones is taken
+def loopClosestPoint(poly, pt, polygonClosed=True):
+    closest = (-1, -1)
+    distTh = 4.0
+    dist = 1e9
+    for i in range(len(poly)):
+        curDist = qtLength(poly[i], pt)
+        if (curDist < dist):
+            closest = (i, i)
+            dist = curDist
+    if (dist <= distTh):
+        return closest
+
+    if (polygonClosed and len(poly) >= 2):
+        for i in range(len(poly)):
+            j = (i + 1) % len(poly)
+            pt1, pt2 = poly[i], poly[j]
+            # QLineF.normalVector ends at pt1 + (dy, -dx), moved to pt
+            end = (pt1[0] + (pt2[1] - pt1[1]), pt1[1] - (pt2[0] - pt1[0]))
+            normal = (end[0] - pt1[0], end[1] - pt1[1])
+            intersectionType, intersectionPt = qtIntersection(
+                pt1, pt2, pt, (pt[0] + normal[0], pt[1] + normal[1]))
+            if (intersectionType == 1):
+                curDist = qtLength(intersectionPt, pt)
+                if (curDist < dist):
+                    closest = (i, j)
+                    dist = curDist
+    if (dist <= distTh):
+        return closest
+    return (-1, -1)
+
+class ClosestPointTest(unittest.TestCase):
+    def test_same_as_point_loop(self):
+        rng = np.random.RandomState(0)
+        found = {'none': 0, 'point': 0, 'edge': 0}
+        for trial in range(3000):
+            points = randomPolygon(rng)
+            poly = [tuple(pt) for pt in points.tolist()]
+            lo, hi = (points.min(axis=0) - 10, points.max(axis=0) + 10) if len(points) else (0, 100)
+            pt = lo + rng.rand(2) * (hi - lo)
+            if (len(poly) and rng.rand() < 0.3):
+                # Near a point, on the pixel grid, as close to two points
+                pt = points[rng.randint(len(poly))] + rng.randint(-4, 5, 2)
+            pt = tuple(pt.tolist())
+            polygonClosed = rng.rand() < 0.7
+            expected = loopClosestPoint(poly, pt, polygonClosed)
+            self.assertEqual(closestPoint(points, pt, polygonClosed, threshold=4.0), expected)
+            found['none' if expected[0] < 0 else 'point' if expected[0] == expected[1] else 'edge'] += 1
+        self.assertGreater(min(found.values()), 100)
+
+class EdgeIndexTest(unittest.TestCase):
+    # A valid star shaped polygon, on the pixel or a third pixel grid if
+    # grid is 1 or 2, or closed by a long edge if grid is 3
+    def starPolygon(self, rng, grid):
+        n = rng.randint(3, 40)
+        angles = np.sort(rng.rand(n)) * (np.pi if grid == 3 else 2 * np.pi)
+        radii = rng.uniform(5, 50, n)
+        points = np.column_stack([100.3 + radii * np.cos(angles), 100.7 + radii * np.sin(angles)])
+        return self.snap(points, grid)
+
+    def snap(self, points, grid):
+        if (grid == 1):
+            return np.round(points)
+        if (grid == 2):
+            return np.round(points * 3) / 3.0
+        return points
+
+    # Where the point v may be dragged to: close by, anywhere, onto
+    # another edge or almost onto another point
+    def dragTarget(self, rng, points, v):
+        n = len(points)
+        kind = rng.randint(4)
+        if (kind == 0):
+            return points[v] + rng.randn(2) * 5
+        if (kind == 1):
+            return rng.rand(2) * 200
+        if (kind == 2):
+            k = rng.randint(n)
+            return points[k] + rng.rand() * (points[(k + 1) % n] - points[k])
+        return points[rng.randint(n)] + rng.randn(2) * 1e-12
+
+    def test_same_as_polygon_is_valid(self):
+        rng = np.random.RandomState(0)
+        checked = 0
+        for trial in range(150):
+            grid = rng.randint(4)
+            points = self.starPolygon(rng, grid)
+            edges = EdgeIndex(points)
+            for step in range(40):
+                n = len(points)
+                op = rng.randint(10)
+                if (op < 7):
+                    # Drag a point, invalid moves are mostly refused
+                    v = rng.randint(n)
+                    pt = self.snap(self.dragTarget(rng, points, v), grid)
+                    moved = points.copy()
+                    moved[v] = pt
+                    expected = polygonIsValid(moved)
+                    if (polygonIsValid(points)):
+                        self.assertEqual(edges.moveIsValid(v, pt), expected)
+                        checked += 1
+                    if (expected or rng.rand() < 0.1):
+                        points = moved
+                        edges.move(v, pt)
+                elif (op < 9):
+                    # Insert a point on an edge
+                    v = rng.randint(n + 1)
+                    k = (v - 1) % n
+                    pt = points[k] + rng.rand() * (points[v % n] - points[k])
+                    points = np.insert(points, v, pt, axis=0)
+                    edges.insert(v, pt)
+                elif (n > 3):
+                    v = rng.randint(n)
+                    points = np.delete(points, v, axis=0)
+                    edges.delete(v)
+                self.assertTrue(np.array_equal(edges.points, points))
+        self.assertGreater(checked, 1000)
+
+# The distance of pt to the segment from a to b, to its foot on the
+# segment, rounded the same way as geometry.segmentDistance
+def segmentDistance(pt, a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    lengthSquared = dx * dx + dy * dy
+    t = 0.0
+    if (lengthSquared > 0):
+        t = min(max(((pt[0] - a[0]) * dx + (pt[1] - a[1]) * dy) / float(lengthSquared), 0.0), 1.0)
+    return qtLength((a[0] + dx * t, a[1] + dy * t), pt)
+
+# The first boundary passing within threshold of pt, testing every one in
+# turn, -1 if there is none
+def loopBoundaryAt(polylines, pt, threshold=4.0):
+    for idx, points in enumerate(polylines):
+        points = [tuple(p) for p in points.tolist() if np.isfinite(p).all()]
+        if (any(math.hypot(pt[0] - p[0], pt[1] - p[1]) <= threshold for p in points)):
+            return idx
+        for a, b in zip(points[:-1], points[1:]):
+            if (segmentDistance(pt, a, b) <= threshold):
+                return idx
+    return -1
+
+class BoundaryLookupTest(unittest.TestCase):
+    # Pixel chains as converted, simplified chains with long segments
+    # and random points
+    def randomBoundaries(self, rng):
+        polylines = []
+        for k in range(rng.randint(0, 12)):
+            n = rng.randint(1, 60)
+            kind = rng.randint(3)
+            if (kind < 2):
+                chain = rng.randint(0, 80, 2) + np.cumsum(rng.randint(-1, 2, (n, 2)), axis=0)
+                if (kind == 1):
+                    chain = simplifyPolylines([chain], 1.0)[0]
+                polylines.append(chain)
+            else:
+                polylines.append(rng.rand(n, 2) * 80 - 5)
+        if (polylines and rng.rand() < 0.1):
+            polylines[0] = np.array([[np.nan, 3.0], [10, 10]])
+        return polylines
+
+    def test_same_as_boundary_loop(self):
+        rng = np.random.RandomState(0)
+        hits = 0
+        for trial in range(150):
+            polylines = self.randomBoundaries(rng)
+            boundaryMap = BoundaryMap(polylines, threshold=4.0)
+            for k in range(100):
+                x, y = rng.rand(2) * 100 - 10
+                kind = rng.randint(3)
+                if (kind == 1):
+                    # On and just inside the cell borders
+                    x, y = np.round([x, y]) + rng.choice([0, 0.5, 0.999999])
+                elif (kind == 2 and polylines):
+                    # About threshold away from a point on a boundary
+                    points = polylines[rng.randint(len(polylines))]
+                    k = rng.randint(len(points))
+                    pt = points[k] + rng.rand() * (points[min(k + 1, len(points) - 1)] - points[k])
+                    angle = rng.rand() * 2 * np.pi
+                    x, y = pt + rng.uniform(3.5, 4.5) * np.array([np.cos(angle), np.sin(angle)])
+                expected = loopBoundaryAt(polylines, (x, y))
+                self.assertEqual(boundaryMap.lookup(x, y), expected)
+                hits += expected >= 0
+        self.assertGreater(hits, 1000)
+
+    def test_empty(self):
+        self.assertEqual(BoundaryMap([]).lookup(1.0, 2.0), -1)
+        self.assertEqual(BoundaryMap([np.zeros((0, 2))]).lookup(0.0, 0.0), -1)
+
+# The indices of the points Douglas-Peucker simplification keeps, split
+# at the first of the furthest points
+def recursiveSimplify(points, tolerance):
+    if (len(points) <= 2):
+        return range(len(points))
+    dist = [segmentDistance(pt, points[0], points[-1]) for pt in points[1:-1]]
+    pivot = dist.index(max(dist)) + 1
+    if (dist[pivot - 1] <= tolerance):
+        return [0, len(points) - 1]
+    left = recursiveSimplify(points[:pivot + 1], tolerance)
+    right = recursiveSimplify(points[pivot:], tolerance)
+    return left + [pivot + k for k in right[1:]]
+
+class SimplifyTest(unittest.TestCase):
+    # Pixel chains, random points and points on a line with repetitions
+    def randomPolylines(self, rng):
+        polylines = []
+        for k in range(rng.randint(0, 6)):
+            n = rng.randint(0, 60)
+            kind = rng.randint(3)
+            if (kind == 0):
+                polylines.append(50 + np.cumsum(rng.randint(-1, 2, (n, 2)), axis=0))
+            elif (kind == 1):
+                polylines.append(rng.rand(n, 2) * 20)
+            else:
+                direction = rng.randint(-3, 4, 2)
+                polylines.append(rng.randint(0, 5, 2) + rng.randint(-3, 4, n)[:, None] * direction)
+        return polylines
+
+    def test_same_as_recursive(self):
+        rng = np.random.RandomState(0)
+        removed = 0
+        for trial in range(1000):
+            polylines = self.randomPolylines(rng)
+            tolerance = rng.choice([0.0, 0.5, 1.0, 1.5, 3.0])
+            simplified = simplifyPolylines(polylines, tolerance)
+            self.assertEqual(len(simplified), len(polylines))
+            for points, result in zip(polylines, simplified):
+                if (tolerance > 0):
+                    keep = recursiveSimplify([tuple(pt) for pt in points.tolist()], tolerance)
+                else:
+                    keep = range(len(points))
+                self.assertTrue(np.array_equal(result, points[keep]))
+                self.assertEqual(result.dtype, points.dtype)
+                removed += len(points) - len(result)
+        self.assertGreater(removed, 1000)
+
+    def test_keeps_int_type(self):
+        points = np.array([[0, 0], [1, 0], [2, 1], [3, 0], [9, 0]], np.int32)
+        result = simplifyPolylines([points], 1.0)[0]
+        self.assertEqual(result.dtype, np.int32)
+        self.assertEqual(result.tolist(), [[0, 0], [9, 0]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+Round trip tests of the binary label sidecars.
+
+Usage: python -m unittest discover tests
+
+Copyright (c) 2018- Guoxia Wang
+mingzilaochongtu at gmail com
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+The Software is provided "as is", without warranty of any kind.
+
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from lib.annotation import Annotation
+from lib.sidecar import jsonToSidecar, readSidecar, sidecarIsCurrent, writeLabels
+
+# An annotation with int and float rings, in the objects and the boundaries
+MIXED = {
+    'imgWidth': 64,
+    'imgHeight': 48,
+    'objects': [
+        {'label': 'person', 'deleted': 0, 'verified': 1, 'user': 'a', 'date': '2018-10-27 22:06:47',
+         'polygon': [[1, 2, 30, 2, 30, 40], [0.5, 1.25, 10.1, 3.0, 7, 9.75]]},
+        {'label': 'dog', 'deleted': 1, 'verified': 0, 'user': '', 'date': '',
+         'polygon': [[3.3, 4.4, 5, 6, 7.7, 8]]},
+        {'label': 'cat', 'deleted': 0, 'verified': 1, 'user': '', 'date': '',
+         'polygon': []},
+    ],
+    'boundaries': {'deleted': 0, 'verified': 1, 'user': 'b', 'date': '',
+                   'polygon': [[1, 2, 3, 4, 5, 6], [0.1, 0.2, 0.30000000000000004, 1e-7], []]},
+}
+
+class SidecarTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    # Convert jsonFile to its sidecar and check that both give the same
+    # json text and ring types
+    def checkRoundTrip(self, jsonFile):
+        fromJson = Annotation()
+        fromJson.fromJsonFile(jsonFile)
+        sidecarFile = jsonToSidecar(jsonFile)
+        self.assertTrue(sidecarIsCurrent(jsonFile))
+        fromSidecar = Annotation()
+        readSidecar(sidecarFile, fromSidecar)
+        for compact in (False, True):
+            self.assertEqual(fromSidecar.toJsonText(compact), fromJson.toJsonText(compact))
+        objects = fromJson.objects + ([fromJson.boundaries] if fromJson.boundaries else [])
+        sidecarObjects = fromSidecar.objects + ([fromSidecar.boundaries] if fromSidecar.boundaries else [])
+        for obj, sidecarObj in zip(objects, sidecarObjects):
+            self.assertEqual([poly.points.dtype for poly in sidecarObj.polygon],
+                             [poly.points.dtype for poly in obj.polygon])
+        return fromJson
+
+    def test_data_file(self):
+        jsonFile = os.path.join(self.tmpDir, '000000000063.polygons.json')
+        shutil.copy(os.path.join(ROOT, 'data', '000000000063.polygons.json'), jsonFile)
+        self.checkRoundTrip(jsonFile)
+
+    def test_mixed_types(self):
+        jsonFile = os.path.join(self.tmpDir, 'mixed.polygons.json')
+        with open(jsonFile, 'w') as f:
+            json.dump(MIXED, f)
+        annotation = self.checkRoundTrip(jsonFile)
+        self.assertEqual([poly.points.dtype for poly in annotation.objects[0].polygon],
+                         [np.int64, np.float64])
+
+    def test_changed_json(self):
+        jsonFile = os.path.join(self.tmpDir, 'mixed.polygons.json')
+        with open(jsonFile, 'w') as f:
+            json.dump(MIXED, f)
+        self.checkRoundTrip(jsonFile)
+
+        # Edited by something else than writeLabels
+        with open(jsonFile, 'a') as f:
+            f.write('\n')
+        self.assertFalse(sidecarIsCurrent(jsonFile))
+
+        # writeLabels updates the sidecar with the json file
+        annotation = Annotation()
+        annotation.fromJsonFile(jsonFile)
+        annotation.objects[0].label = 'rider'
+        writeLabels(jsonFile, annotation)
+        self.assertTrue(sidecarIsCurrent(jsonFile))
+        self.assertEqual(self.checkRoundTrip(jsonFile).objects[0].label, 'rider')
+
+if __name__ == '__main__':
+    unittest.main()